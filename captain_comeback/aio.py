@@ -0,0 +1,414 @@
+# coding:utf-8
+import math
+import time
+import asyncio
+import logging
+
+from six.moves import http_client
+from six.moves.urllib.parse import quote
+
+from captain_comeback import metrics
+from captain_comeback.restart.backends import (
+    RestartFailed, SignalBackend, SelectBackend, SIGNAL_TARGET_ALL,
+    SIGNAL_TARGET_LARGEST, RESTART_BACKEND_CLI, RESTART_BACKEND_SIGNAL,
+    RESTART_BACKEND_SIGNAL_LARGEST, RESTART_BACKENDS)
+from captain_comeback.restart.docker_api import (DockerError, check_status,
+                                                 parse_response,
+                                                 RESTART_TIMEOUT_MARGIN)
+from captain_comeback.restart.engine import (RestartEngine, reserve_headroom,
+                                             raise_memory_limit,
+                                             snapshot_tasks,
+                                             lower_memory_limit,
+                                             prepare_frozen,
+                                             grace_period_for)
+from captain_comeback.restart.messages import RestartCompleteMessage
+
+
+logger = logging.getLogger()
+
+
+# The asyncio runtime runs the index, syncs and the restart engine on a single
+# event loop, rather than on a thread each (plus one per restart worker).
+# The index's epoll fd (which has our eventfds and inotify registered on it)
+# is itself registered with the loop, so events are dispatched as soon as the
+# loop notices them. Restarts are coroutines, so they can be cancelled when
+# they take too long.
+#
+# This needs Python 3.5 or later, so the CLI only imports it when asked to.
+
+# How often to run a sync slice when syncing incrementally (same as the
+# threaded runtime).
+SYNC_SLICE_PERIOD = 0.05
+
+
+def new_event_loop():
+    # Queues bind to the current loop when they're created on older Pythons,
+    # so this has to happen before we create any.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+class LoopQueue(object):
+    # The index and restarts give messages to the engine by calling put, so
+    # this lets them do that without awaiting. This is only safe to use from
+    # the loop's thread.
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    def put(self, message):
+        self._queue.put_nowait(message)
+
+    def get(self):
+        return self._queue.get()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class AsyncDockerCliRestart(object):
+    def __init__(self, proc):
+        self.proc = proc
+
+    async def wait(self):
+        try:
+            out, err = await self.proc.communicate()
+        except asyncio.CancelledError:
+            # Don't leave the CLI behind if we gave up on it.
+            if self.proc.returncode is None:
+                self.proc.kill()
+            raise
+
+        ret = self.proc.returncode
+        if ret != 0:
+            e = "status: {0}, stdout: {1}, stderr: {2}".format(ret, out, err)
+            raise RestartFailed(e)
+
+
+class AsyncDockerCliBackend(object):
+    async def start_restart(self, cg, grace_period):
+        restart_cmd = ["docker", "restart", "-t", str(grace_period),
+                       cg.name()]
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *restart_cmd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        except EnvironmentError as e:
+            raise RestartFailed("failed to run docker: {0}".format(e))
+        return AsyncDockerCliRestart(proc)
+
+
+class AsyncDockerApiRestart(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def wait(self):
+        # We ask Docker to close the connection, so the response ends when
+        # the connection does.
+        try:
+            status, body = parse_response(await self.reader.read())
+        except (http_client.HTTPException, EnvironmentError) as e:
+            raise RestartFailed("Docker API request failed: {0}".format(e))
+        finally:
+            self.writer.close()
+
+        try:
+            check_status(status, body)
+        except DockerError as e:
+            raise RestartFailed(str(e))
+
+
+class AsyncDockerApiBackend(object):
+    # Unlike the threaded client, we don't pool connections: opening a unix
+    # socket is cheap, and not reusing them means we never have to deal with
+    # connections Docker closed while they were idle.
+    def __init__(self, socket_path, fallback=None):
+        self.socket_path = socket_path
+        self.fallback = fallback
+
+    async def start_restart(self, cg, grace_period):
+        path = "/containers/{0}/restart?t={1}".format(
+            quote(cg.name()), int(grace_period))
+        request = ("POST {0} HTTP/1.1\r\n"
+                   "Host: localhost\r\n"
+                   "Content-Length: 0\r\n"
+                   "Connection: close\r\n"
+                   "\r\n").format(path).encode("ascii")
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                self.socket_path)
+        except EnvironmentError as e:
+            # We couldn't even send the request, so it's safe to try
+            # something else.
+            if self.fallback is None:
+                raise RestartFailed("Docker API request failed: {0}"
+                                    .format(e))
+            logger.warning("%s: Docker API unavailable (%s), falling back",
+                           cg.name(), e)
+            return await self.fallback.start_restart(cg, grace_period)
+
+        try:
+            writer.write(request)
+            await writer.drain()
+        except EnvironmentError as e:
+            writer.close()
+            raise RestartFailed("Docker API request failed: {0}".format(e))
+
+        return AsyncDockerApiRestart(reader, writer)
+
+
+class ExecutorRestart(object):
+    def __init__(self, pending_restart):
+        self.pending_restart = pending_restart
+
+    async def wait(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.pending_restart.wait)
+
+
+class ExecutorBackend(object):
+    # Runs a threaded backend (e.g. signals, which need to poll tasks) in the
+    # loop's executor. If we time out, the thread finishes the restart in the
+    # background, but we stop waiting for it.
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def start_restart(self, cg, grace_period):
+        loop = asyncio.get_event_loop()
+        pending_restart = await loop.run_in_executor(
+            None, self.backend.start_restart, cg, grace_period)
+        return ExecutorRestart(pending_restart)
+
+
+class AsyncSelectBackend(SelectBackend):
+    async def start_restart(self, cg, grace_period):
+        return await self.backend_for(cg).start_restart(cg, grace_period)
+
+
+async def restart(queue, grace_period, cg, backend, headroom, limits,
+                  snapshotter, timeout, freezer=None, preemption=False):
+    # This mirrors engine.restart, but the restart itself is awaited (and
+    # cancelled if it takes longer than timeout), and anything that might
+    # block on I/O (e.g. writing the limit journal) runs in the executor.
+    loop = asyncio.get_event_loop()
+    logger.info("%s: restarting", cg.name())
+    metrics.RESTARTS.inc()
+    started_at = time.time()
+
+    prepared = None
+    if freezer is not None and not preemption:
+        # Freezing polls for the tasks to be frozen, so this blocks too.
+        prepared = await loop.run_in_executor(
+            None, prepare_frozen, cg, headroom, limits, snapshotter, freezer)
+        metrics.PHASE_SECONDS.observe(time.time() - started_at, "freeze")
+    memory_limit, extra = prepared or (None, 0)
+
+    try:
+        pending_restart = await asyncio.wait_for(
+            backend.start_restart(cg, grace_period), timeout)
+    except BaseException as e:
+        # If we froze the container, it already has its extra memory. We
+        # take it back right away, since we might be getting cancelled.
+        if extra > 0:
+            headroom.release(extra)
+            lower_memory_limit(cg, memory_limit, memory_limit + extra, limits)
+        if isinstance(e, asyncio.TimeoutError):
+            e = "timed out after {0}s".format(timeout)
+        elif not isinstance(e, RestartFailed):
+            raise
+        logger.error("%s: failed to restart: %s", cg.name(), e)
+        metrics.RESTARTS_FAILED.inc()
+        queue.put(RestartCompleteMessage(cg))
+        return
+
+    if prepared is None and not preemption:
+        memory_limit, extra = reserve_headroom(cg, headroom)
+
+    try:
+        if prepared is None:
+            if extra > 0:
+                await loop.run_in_executor(None, raise_memory_limit, cg,
+                                           memory_limit, memory_limit + extra,
+                                           limits)
+
+            await loop.run_in_executor(None, snapshot_tasks, cg, snapshotter)
+
+        remaining = max(0, started_at + timeout - time.time())
+        try:
+            await asyncio.wait_for(pending_restart.wait(), remaining)
+        except asyncio.TimeoutError:
+            logger.error("%s: failed to restart: timed out after %ss",
+                         cg.name(), timeout)
+            metrics.RESTARTS_FAILED.inc()
+        except RestartFailed as e:
+            logger.error("%s: failed to restart: %s", cg.name(), e)
+            metrics.RESTARTS_FAILED.inc()
+
+        metrics.PHASE_SECONDS.observe(time.time() - started_at, "restart")
+    finally:
+        headroom.release(extra)
+
+    if extra > 0:
+        await loop.run_in_executor(None, lower_memory_limit, cg,
+                                   memory_limit, memory_limit + extra, limits)
+
+    logger.info("%s: restart complete", cg.name())
+    queue.put(RestartCompleteMessage(cg))
+
+
+class AsyncRestartEngine(RestartEngine):
+    # Same bookkeeping as the threaded engine, but workers are tasks, and
+    # backends are coroutines (see AsyncDockerApiBackend and friends).
+    def __init__(self, *args, **kwargs):
+        super(AsyncRestartEngine, self).__init__(*args, **kwargs)
+        self._pending_restarts = asyncio.PriorityQueue()
+        self._worker_tasks = []
+
+    def start_workers(self):
+        if self._worker_tasks:
+            return
+
+        for _ in range(self.workers):
+            self._worker_tasks.append(asyncio.ensure_future(self._work()))
+
+    async def _work(self):
+        while True:
+            _, scheduled_at, cg = await self._pending_restarts.get()
+            metrics.PENDING_RESTARTS.set(self._pending_restarts.qsize())
+            if not self._still_needs_restart(cg):
+                continue
+            delay = self._rate_limit_delay(cg)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            metrics.PHASE_SECONDS.observe(time.time() - scheduled_at,
+                                          "schedule")
+            try:
+                await self._restart(cg)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Don't let this cgroup get stuck as "being restarted", or
+                # this worker die.
+                logger.exception("%s: restart failed", cg.name())
+                self.queue.put(RestartCompleteMessage(cg))
+
+    def _defer(self, delay, message):
+        loop = asyncio.get_event_loop()
+        return loop.call_later(delay, self.queue.put, message)
+
+    async def _restart(self, cg):
+        grace_period = grace_period_for(cg, self.grace_period)
+        await restart(self.queue, grace_period, cg, self.backend,
+                      self.headroom, self.limits, self.snapshotter,
+                      grace_period + RESTART_TIMEOUT_MARGIN, self.freezer,
+                      cg in self._preemptions)
+
+    async def run(self):
+        self.start_workers()
+        logger.info("ready to restart containers")
+        try:
+            while True:
+                self._handle_message(await self.queue.get())
+        finally:
+            for task in self._worker_tasks:
+                task.cancel()
+
+
+def make_restart_backend(name, docker_socket):
+    # See cli.make_restart_backend
+    if name == RESTART_BACKEND_CLI:
+        return AsyncDockerCliBackend()
+    if name == RESTART_BACKEND_SIGNAL:
+        return ExecutorBackend(SignalBackend(SIGNAL_TARGET_ALL))
+    if name == RESTART_BACKEND_SIGNAL_LARGEST:
+        return ExecutorBackend(SignalBackend(SIGNAL_TARGET_LARGEST))
+    return AsyncDockerApiBackend(docker_socket, AsyncDockerCliBackend())
+
+
+def make_restart_backends(default, container_backends, docker_socket):
+    backends = dict((name, make_restart_backend(name, docker_socket))
+                    for name in RESTART_BACKENDS)
+    overrides = [(pattern, backends[name])
+                 for pattern, name in container_backends or []]
+    return AsyncSelectBackend(backends[default], overrides, backends)
+
+
+async def run_full_sync(index, sync_target_interval, memory_watch=None):
+    while True:
+        index.sync()
+        if memory_watch is not None:
+            memory_watch.check()
+        await asyncio.sleep(sync_target_interval)
+
+
+async def run_incremental_sync(index, sync_target_interval,
+                               sync_slice_budget, memory_watch=None):
+    # See cli.run_incremental_sync. Events are dispatched by the loop in
+    # between slices.
+    while True:
+        round_end = time.time() + sync_target_interval
+        index.begin_sync()
+        if memory_watch is not None:
+            memory_watch.check()
+
+        while True:
+            now = time.time()
+            if now >= round_end:
+                break
+
+            slices_left = max(1, int((round_end - now) / SYNC_SLICE_PERIOD))
+            quota = int(math.ceil(index.sync_pending() / float(slices_left)))
+            if quota:
+                index.sync_slice(quota, sync_slice_budget)
+
+            await asyncio.sleep(max(0, min(round_end - time.time(),
+                                           SYNC_SLICE_PERIOD)))
+
+
+def run_sync(index, sync_target_interval, sync_slice_budget,
+             memory_watch=None):
+    if sync_slice_budget > 0:
+        return run_incremental_sync(index, sync_target_interval,
+                                    sync_slice_budget, memory_watch)
+    return run_full_sync(index, sync_target_interval, memory_watch)
+
+
+def _poll(index):
+    # The index might have been closed by the time we get here.
+    if index.epl is not None:
+        index.poll(0)
+
+
+async def serve(index, engine, sync_target_interval, sync_slice_budget,
+                memory_watch=None):
+    loop = asyncio.get_event_loop()
+    loop.add_reader(index.epl.fileno(), _poll, index)
+    try:
+        # If either of these fails, the other is cancelled, and we exit
+        # (unlike the threaded runtime, which would keep going without a
+        # restart engine).
+        tasks = [asyncio.ensure_future(engine.run()),
+                 asyncio.ensure_future(run_sync(index, sync_target_interval,
+                                                sync_slice_budget,
+                                                memory_watch))]
+        try:
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+    finally:
+        loop.remove_reader(index.epl.fileno())
+
+
+def run(loop, index, engine, sync_target_interval, sync_slice_budget,
+        memory_watch=None):
+    loop.run_until_complete(serve(index, engine, sync_target_interval,
+                                  sync_slice_budget, memory_watch))
@@ -0,0 +1,287 @@
+# coding:utf-8
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from six.moves import queue
+
+from captain_comeback.index import CgroupIndex
+
+if sys.version_info >= (3, 4):
+    import tracemalloc
+else:
+    tracemalloc = None
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_CGROUP_COUNTS = [10, 100, 1000, 10000, 20000]
+DEFAULT_SYNC_ROUNDS = 5
+DEFAULT_EVENTS = 200
+
+MEMORY_LIMIT = 1024 * 1024 * 1024
+
+# We hold the oom_control file, memory.limit_in_bytes (once we've read it) and
+# an eventfd open for each cgroup, plus a few for ourselves.
+FDS_PER_CGROUP = 3
+FDS_RESERVED = 64
+
+
+class FakeCgroupTree(object):
+    # A directory that looks enough like a cgroup v1 memory hierarchy for the
+    # index to monitor it. Since everything happens in this process, the
+    # "kernel" here is us: to deliver an OOM event, we flip under_oom and
+    # signal the eventfd that was registered in cgroup.event_control.
+    def __init__(self, root):
+        self.root = root
+
+    def create(self, name):
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+
+        self._write(path, "memory.oom_control",
+                    "oom_kill_disable 1\nunder_oom 0\n")
+        self._write(path, "memory.limit_in_bytes",
+                    "{0}\n".format(MEMORY_LIMIT))
+        self._write(path, "memory.usage_in_bytes", "0\n")
+        self._write(path, "tasks", "")
+        self._write(path, "cgroup.procs", "")
+        self._write(path, "cgroup.event_control", "")
+
+        return path
+
+    def set_under_oom(self, path, under_oom):
+        self._write(path, "memory.oom_control",
+                    "oom_kill_disable 1\nunder_oom {0}\n".format(
+                        int(under_oom)))
+
+    def fire(self, path):
+        # cgroup.event_control holds the last registration that was written
+        # to it, formatted as "<event fd> <control fd> [args]".
+        with open(os.path.join(path, "cgroup.event_control")) as f:
+            efd = int(f.read().split()[0])
+        os.write(efd, struct.pack("=Q", 1))
+
+    @staticmethod
+    def _write(path, filename, contents):
+        with open(os.path.join(path, filename), "w") as f:
+            f.write(contents)
+
+
+def rw_syscalls():
+    # Count of read and write syscalls this process has made. This doesn't
+    # account for e.g. open or lseek, but it's cheap and available without
+    # strace.
+    counts = {}
+    with open("/proc/self/io") as f:
+        for line in f:
+            key, value = line.split(":")
+            counts[key] = int(value)
+    return counts["syscr"] + counts["syscw"]
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here,
+                                      stderr=open(os.devnull, "w"))
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+    return out.decode("ascii").strip()
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def measure_event_latency(tree, index, job_queue, paths, events):
+    latencies = []
+
+    for path in random.sample(paths, min(events, len(paths))):
+        tree.set_under_oom(path, True)
+
+        fired_at = time.time()
+        tree.fire(path)
+        while job_queue.empty():
+            index.poll(1)
+
+        msg = job_queue.get_nowait()
+        latencies.append(msg.created_at - fired_at)
+        # Like the engine would once it's done, so it can ask again.
+        msg.cg.restart_in_flight = False
+
+        tree.set_under_oom(path, False)
+
+    return latencies
+
+
+def measure_oom_path_allocations(tree, index, job_queue, paths, events):
+    # What dispatching OOM events allocates, as Python's allocator sees it
+    # (the hardened mode's RSS growth can't tell us that, since Python reuses
+    # memory it freed). Returns the most a dispatch had allocated once it
+    # was done, and what they still held on to after we took their
+    # messages, in total. We don't count our own work (e.g. writing to the
+    # fake cgroups).
+    if tracemalloc is None:
+        return None, None
+
+    allocated_max = 0
+    retained = 0
+    tracemalloc.start()
+    try:
+        for path in random.sample(paths, min(events, len(paths))):
+            tree.set_under_oom(path, True)
+            tree.fire(path)
+
+            before, _ = tracemalloc.get_traced_memory()
+            while job_queue.empty():
+                index.poll(1)
+            dispatched, _ = tracemalloc.get_traced_memory()
+            job_queue.get_nowait().cg.restart_in_flight = False
+            after, _ = tracemalloc.get_traced_memory()
+
+            allocated_max = max(allocated_max, dispatched - before)
+            retained += after - before
+
+            tree.set_under_oom(path, False)
+    finally:
+        tracemalloc.stop()
+
+    return allocated_max, retained
+
+
+def run_benchmark(root, cgroup_count, sync_rounds=DEFAULT_SYNC_ROUNDS,
+                  events=DEFAULT_EVENTS):
+    tree = FakeCgroupTree(root)
+    paths = [tree.create("cg-{0:06d}".format(i)) for i in range(cgroup_count)]
+
+    job_queue = queue.Queue()
+    # We rescan explicitly below, and don't want syncs to do it behind our
+    # back.
+    index = CgroupIndex(root, job_queue, rescan_interval=sys.maxsize)
+
+    rss_before = rss_bytes()
+    index.open()
+    try:
+        t = time.time()
+        index.rescan()
+        register_seconds = time.time() - t
+        assert len(index._path_hash) == cgroup_count, len(index._path_hash)
+
+        sync_seconds = []
+        syscalls_before = rw_syscalls()
+        for _ in range(sync_rounds):
+            t = time.time()
+            index.sync()
+            sync_seconds.append(time.time() - t)
+        syscalls = rw_syscalls() - syscalls_before
+
+        # Memory taken on the OOM path once we're warmed up (e.g. by the
+        # syncs above) is memory we might not get when we need it most.
+        rss_warm = rss_bytes()
+        latencies = measure_event_latency(tree, index, job_queue, paths,
+                                          events)
+        rss_after = rss_bytes()
+
+        allocated_max, retained = measure_oom_path_allocations(
+            tree, index, job_queue, paths, events)
+    finally:
+        index.close()
+
+    return {
+        "cgroups": cgroup_count,
+        "register_seconds": register_seconds,
+        "sync_seconds_min": min(sync_seconds),
+        "sync_seconds_median": percentile(sync_seconds, 50),
+        "rw_syscalls_per_sync": float(syscalls) / sync_rounds,
+        "event_latency_seconds_p50": percentile(latencies, 50),
+        "event_latency_seconds_p99": percentile(latencies, 99),
+        "event_latency_seconds_max": max(latencies) if latencies else None,
+        "rss_bytes": rss_after,
+        "index_rss_bytes": rss_after - rss_before,
+        "event_rss_growth_bytes": rss_after - rss_warm,
+        "oom_path_allocated_bytes_max": allocated_max,
+        "oom_path_retained_bytes": retained,
+    }
+
+
+def main(cgroup_counts, sync_rounds, events, tmpdir, output):
+    fd_limit = raise_fd_limit()
+    context = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+    }
+
+    for cgroup_count in cgroup_counts:
+        needed = cgroup_count * FDS_PER_CGROUP + FDS_RESERVED
+        if needed > fd_limit:
+            logger.error("%s cgroups: need %s fds, limit is %s, skipping",
+                         cgroup_count, needed, fd_limit)
+            continue
+
+        root = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            result = run_benchmark(root, cgroup_count, sync_rounds, events)
+        finally:
+            shutil.rmtree(root)
+
+        result.update(context)
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+        output.flush()
+
+
+def main_wrapper(args):
+    desc = ("Benchmark cgroup index sync and event dispatch against a fake "
+            "cgroup hierarchy. Results are printed as JSON lines.")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--cgroups", default=DEFAULT_CGROUP_COUNTS,
+                        type=lambda s: [int(n) for n in s.split(",")],
+                        help="comma-separated cgroup counts to benchmark")
+    parser.add_argument("--sync-rounds", default=DEFAULT_SYNC_ROUNDS,
+                        type=int, help="full syncs to time per run")
+    parser.add_argument("--events", default=DEFAULT_EVENTS, type=int,
+                        help="OOM events to deliver per run")
+    parser.add_argument("--tmpdir", default=None,
+                        help="where to create the fake hierarchy (use a "
+                             "tmpfs for representative numbers)")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="random seed used to pick cgroups to notify")
+
+    ns = parser.parse_args(args)
+    # The index logs every cgroup it sees, and every OOM we simulate.
+    logging.basicConfig(level=logging.ERROR,
+                        format="%(asctime)-15s %(levelname)-8s %(message)s")
+
+    random.seed(ns.seed)
+    main(ns.cgroups, ns.sync_rounds, ns.events, ns.tmpdir, sys.stdout)
+
+
+if __name__ == "__main__":
+    main_wrapper(sys.argv[1:])
@@ -1,36 +1,175 @@
 # coding:utf-8
 import os
 import logging
+import select
+import threading
+import time
 import linuxfd
 
-from captain_comeback.restart.messages import RestartRequestedMessage
+from captain_comeback import metrics
+from captain_comeback.restart.messages import (RestartRequestedMessage,
+                                               MemoryPressureMessage,
+                                               MemoryThresholdMessage)
+from captain_comeback.restart.policy import policy_of
 
 logger = logging.getLogger()
 
 
+PRESSURE_LEVELS = ["low", "medium", "critical"]
+
+# Python 2 doesn't expose this, but Linux has supported it since 2.6.23.
+O_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+# memory.oom_control is a few short lines (oom_kill_disable, under_oom, and
+# oom_kill on newer kernels).
+OOM_CONTROL_BUFFER_SIZE = 256
+OOM_KILL_DISABLE = b"oom_kill_disable "
+UNDER_OOM = b"under_oom "
+FLAG_SET = ord(b"1")
+
+CONTROL_READ_SIZE = 64 * 1024
+
+MEMORY_LIMIT_FILE = "memory.limit_in_bytes"
+USAGE_FILE = "memory.usage_in_bytes"
+TASKS_FILE = "tasks"
+PROCS_FILE = "cgroup.procs"
+MEMORY_STAT_FILE = "memory.stat"
+# Resident memory, including children's (if any) when the kernel tells us.
+RSS_KEYS = [b"total_rss", b"rss"]
+
+
+def memory_is_unconstrained(memory_limit):
+    # Note: in practice the memory limit is usually a huge number when
+    # unconstrained, but on the other hand -1 is what you write to the file.
+    # So, we check for both just to be safe.
+    return (memory_limit < 0) or (memory_limit > 10**15)
+
+
+def open_control(path):
+    return os.open(path, os.O_RDONLY | O_CLOEXEC)
+
+
+def _pread_into(fd, buf):
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [buf], 0)
+    # Python < 3.7 can't read into an existing buffer at an offset.
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = os.read(fd, len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+def pread_all(fd):
+    chunks = []
+    offset = 0
+    while True:
+        if hasattr(os, "pread"):
+            chunk = os.pread(fd, CONTROL_READ_SIZE, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            chunk = os.read(fd, CONTROL_READ_SIZE)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        offset += len(chunk)
+
+
+def _read_control(path):
+    fd = open_control(path)
+    try:
+        return pread_all(fd)
+    finally:
+        os.close(fd)
+
+
+def _flag_is_set(buf, n, key):
+    # Look for "<key> 1" in the first n bytes of buf, without copying it.
+    i = buf.find(key, 0, n)
+    if i < 0:
+        raise ValueError("{0} not found".format(key))
+    i += len(key)
+    return i < n and buf[i] == FLAG_SET
+
+
 class Cgroup(object):
-    def __init__(self, path):
+    EVENT_MASK = select.EPOLLIN
+
+    def __init__(self, path, pressure_level=None, usage_thresholds=None):
+        assert pressure_level in [None] + PRESSURE_LEVELS, pressure_level
         self.path = path
+        self._name = path.split("/")[-1]
+        self.pressure_level = pressure_level
+        self.usage_thresholds = sorted(usage_thresholds or [])
         self.oom_control = None
+        self._oom_control_buf = None
+        self._control_fds = {}
+        # Restart workers read control files too (e.g. the memory limit, or
+        # tasks), so this guards _control_fds against them and close().
+        self._control_lock = threading.Lock()
         self.event = None
+        self.pressure = None
+        self.pressure_event = None
+        self.usage = None
+        self.threshold_event = None
+        self._armed_limit = None
+        # Set from the time we request a restart until the restart engine is
+        # done with it, so we don't keep requesting it while it's under way.
+        self.restart_in_flight = False
+        # A RestartPolicy, set by the index when it registers us.
+        self.restart_policy = None
+        # Set by the restart engine when it gives up on us for a while.
+        self.quarantined_until = 0
+
+    @staticmethod
+    def is_container(_entry):
+        return True
+
+    @staticmethod
+    def container_entries(container_id):
+        # Where Docker would put this container's cgroup (under the root)
+        return [container_id]
 
     def name(self):
-        return self.path.split("/")[-1]
+        return self._name
+
+    def left_to_oom_killer(self):
+        # By policy, or because we've been restarted too often (see
+        # RestartBackoff).
+        return (policy_of(self).never_restart or
+                time.time() < self.quarantined_until)
 
     def open(self):
         e = "{0} is already open".format(self.name())
         assert self.oom_control is None, e
         assert self.event is None, e
 
-        # TODO: CLOEXEC?
+        # We keep raw fds open for the control files we read often, and
+        # read them with pread into buffers we reuse, so that wakeups don't
+        # need to open files or allocate.
         logger.debug("%s: open", self.name())
-        self.oom_control = open(self._oom_control_file_path(), "r")
+        self.oom_control = open_control(self._oom_control_file_path())
+        self._oom_control_buf = bytearray(OOM_CONTROL_BUFFER_SIZE)
         self.event = linuxfd.eventfd(initval=0, nonBlocking=True)
 
-        req = "{0} {1}\n".format(self.event_fileno(),
-                                 self.oom_control.fileno())
+        self._register_event(self.event, self.oom_control)
+
+        if self.pressure_level is not None:
+            self.pressure = open_control(self._pressure_level_file_path())
+            self.pressure_event = linuxfd.eventfd(initval=0, nonBlocking=True)
+            self._register_event(self.pressure_event, self.pressure,
+                                 self.pressure_level)
+
+        if self.usage_thresholds:
+            # Thresholds are only armed once we know the memory limit, see
+            # arm_thresholds.
+            self.usage = open_control(self._usage_file_path())
+
+    def _register_event(self, event, control, args=None):
+        req = "{0} {1}".format(event.fileno(), control)
+        if args is not None:
+            req = "{0} {1}".format(req, args)
         with open(self._evt_control_file_path(), "w") as evt_control:
-            evt_control.write(req)
+            evt_control.write(req + "\n")
 
     def close(self):
         e = "{0} is already closed".format(self.name())
@@ -39,57 +178,220 @@ class Cgroup(object):
 
         logger.debug("%s: close", self.name())
 
-        self.oom_control.close()
-        self.oom_control = None
+        with self._control_lock:
+            os.close(self.oom_control)
+            self.oom_control = None
+            self._oom_control_buf = None
+
+            for fd in self._control_fds.values():
+                os.close(fd)
+            self._control_fds.clear()
 
         os.close(self.event.fileno())
         self.event = None
 
+        if self.pressure is not None:
+            os.close(self.pressure)
+            self.pressure = None
+
+        if self.pressure_event is not None:
+            os.close(self.pressure_event.fileno())
+            self.pressure_event = None
+
+        if self.usage is not None:
+            os.close(self.usage)
+            self.usage = None
+
+        self._disarm_thresholds()
+
+    def thresholds_need_rearm(self):
+        if not self.usage_thresholds:
+            return False
+
+        memory_limit = self.memory_limit_in_bytes()
+        if memory_is_unconstrained(memory_limit):
+            memory_limit = None
+
+        return memory_limit != self._armed_limit
+
+    def arm_thresholds(self):
+        # Closing the eventfd is the only way to unregister the thresholds
+        # we previously armed, so we start from a fresh one every time.
+        self._disarm_thresholds()
+
+        memory_limit = self.memory_limit_in_bytes()
+        if memory_is_unconstrained(memory_limit):
+            logger.debug("%s: no memory limit, not arming thresholds",
+                         self.name())
+            return
+
+        self.threshold_event = linuxfd.eventfd(initval=0, nonBlocking=True)
+        for threshold in self.usage_thresholds:
+            threshold_bytes = int(memory_limit * threshold)
+            logger.debug("%s: arm usage threshold at %s", self.name(),
+                         threshold_bytes)
+            self._register_event(self.threshold_event, self.usage,
+                                 threshold_bytes)
+        self._armed_limit = memory_limit
+
+    def _disarm_thresholds(self):
+        if self.threshold_event is not None:
+            os.close(self.threshold_event.fileno())
+            self.threshold_event = None
+        self._armed_limit = None
+
     def event_fileno(self):
         return self.event.fileno()
 
+    def event_filenos(self):
+        filenos = [self.event_fileno()]
+        if self.pressure_event is not None:
+            filenos.append(self.pressure_event.fileno())
+        if self.threshold_event is not None:
+            filenos.append(self.threshold_event.fileno())
+        return filenos
+
+    def dispatch(self, efds, job_queue):
+        # Handle events on our eventfds. We acknowledge events before
+        # handling them, so that anything that comes in while we do is
+        # picked up at the next poll, and we run each handler at most once
+        # no matter how many times its eventfd was signalled.
+        for efd in efds:
+            if efd not in self.event_filenos():
+                raise Exception("Unexpected fd: {0}".format(efd))
+
+        if self.event_fileno() in efds:
+            self.event.read()
+            self.wakeup(job_queue)
+
+        if (self.pressure_event is not None and
+                self.pressure_event.fileno() in efds):
+            self.pressure_event.read()
+            self.on_pressure_event(job_queue)
+
+        if (self.threshold_event is not None and
+                self.threshold_event.fileno() in efds):
+            self.threshold_event.read()
+            self.on_threshold_event(job_queue)
+
     def on_oom_killer_enabled(self, _job_queue):
         memory_limit = self.memory_limit_in_bytes()
-        if (memory_limit < 0) or (memory_limit > 10**15):
+        if memory_is_unconstrained(memory_limit):
             # Memory is unconstrained for this container; don't enable manual
-            # OOM handling (note: in practice the memory limit is usually a
-            # huge number when unconstrained, but on the other hand -1 is what
-            # you write to the file. So, we check for both just to be safe.
+            # OOM handling.
             return
 
         logger.info("%s: set oom_kill_disable = 1", self.name())
         with open(self._oom_control_file_path(), "w") as f:
             f.write("1\n")
 
+    def on_oom_killer_disabled(self, _job_queue):
+        # We won't restart this container (for now), so let the kernel deal
+        # with it (we might have disabled the OOM killer before that).
+        logger.info("%s: set oom_kill_disable = 0", self.name())
+        with open(self._oom_control_file_path(), "w") as f:
+            f.write("0\n")
+
     def on_oom_event(self, job_queue):
+        if self.left_to_oom_killer():
+            logger.info("%s: under_oom, left to the OOM killer", self.name())
+            return
+
+        if self.restart_in_flight:
+            logger.debug("%s: under_oom, restart in flight", self.name())
+            metrics.OOM_EVENTS_SUPPRESSED.inc()
+            return
+
         logger.warning("%s: under_oom", self.name())
+        self.restart_in_flight = True
         job_queue.put(RestartRequestedMessage(self))
 
+    def on_pressure_event(self, job_queue):
+        logger.debug("%s: memory pressure: %s", self.name(),
+                     self.pressure_level)
+        job_queue.put(MemoryPressureMessage(self, self.pressure_level))
+
+    def on_threshold_event(self, job_queue):
+        # Events fire whenever usage crosses a threshold in either direction,
+        # so we have to look at usage to know where we are now.
+        usage = self.usage_in_bytes()
+        memory_limit = self._armed_limit
+
+        crossed = None
+        for threshold in self.usage_thresholds:
+            if usage >= memory_limit * threshold:
+                crossed = threshold
+
+        logger.debug("%s: usage threshold: %s (%s / %s)", self.name(),
+                     crossed, usage, memory_limit)
+        job_queue.put(MemoryThresholdMessage(self, crossed, usage,
+                                             memory_limit))
+
     def wakeup(self, job_queue, raise_for_stale=False):
         logger.debug("%s: wakeup", self.name())
 
+        buf = self._oom_control_buf
         try:
-            oom_control_status = self.oom_control_status()
+            n = _pread_into(self.oom_control, buf)
         except EnvironmentError:
             logger.warning("%s: cgroup is stale", self.name())
             if raise_for_stale:
                 raise
             return
 
-        if oom_control_status["oom_kill_disable"] == "0":
+        oom_kill_disabled = _flag_is_set(buf, n, OOM_KILL_DISABLE)
+
+        if self.left_to_oom_killer():
+            if oom_kill_disabled:
+                self.on_oom_killer_disabled(job_queue)
+            return
+
+        if not oom_kill_disabled:
             self.on_oom_killer_enabled(job_queue)
 
-        if oom_control_status["under_oom"] == "1":
+        if _flag_is_set(buf, n, UNDER_OOM):
             self.on_oom_event(job_queue)
 
     def oom_control_status(self):
-        self.oom_control.seek(0)
-        lines = self.oom_control.readlines()
+        n = _pread_into(self.oom_control, self._oom_control_buf)
+        lines = bytes(self._oom_control_buf[:n]).decode("ascii").splitlines()
         return dict([entry.strip().split(' ') for entry in lines])
 
+    def is_under_oom(self):
+        # Restart workers call this, so it doesn't use our oom_control fd.
+        buf = bytearray(_read_control(self._oom_control_file_path()))
+        return _flag_is_set(buf, len(buf), UNDER_OOM)
+
+    def _read_hot_control(self, filename):
+        # Control files other than oom_control are opened the first time we
+        # need them, and kept open for as long as we are. We read under the
+        # lock too, so that close() can't close (and the OS reuse) the fd
+        # from under us, and the seek on Python 2 doesn't race.
+        with self._control_lock:
+            if self.oom_control is not None:
+                fd = self._control_fds.get(filename)
+                if fd is None:
+                    fd = open_control(os.path.join(self.path, filename))
+                    self._control_fds[filename] = fd
+                return pread_all(fd)
+
+        return _read_control(os.path.join(self.path, filename))
+
+    def usage_in_bytes(self):
+        # Not through self.usage (which is only there for thresholds), since
+        # restart workers call this.
+        return int(self._read_hot_control(USAGE_FILE))
+
     def memory_limit_in_bytes(self):
-        with open(self._memory_limit_file_path(), "r") as f:
-            return int(f.read())
+        return int(self._read_hot_control(MEMORY_LIMIT_FILE))
+
+    def rss_in_bytes(self):
+        stat = self._read_hot_control(MEMORY_STAT_FILE)
+        entries = dict(line.split(b" ", 1) for line in stat.splitlines())
+        for key in RSS_KEYS:
+            if key in entries:
+                return int(entries[key])
+        raise ValueError("no rss in {0}".format(MEMORY_STAT_FILE))
 
     def set_memory_limit_in_bytes(self, new_limit):
         with open(self._memory_limit_file_path(), "w") as f:
@@ -97,8 +399,12 @@ class Cgroup(object):
             f.write("\n")
 
     def pids(self):
-        with open(self._tasks_file_path()) as f:
-            return [int(t) for t in f.readlines()]
+        tasks = self._read_hot_control(TASKS_FILE)
+        return [int(t) for t in tasks.split()]
+
+    def procs(self):
+        procs = self._read_hot_control(PROCS_FILE)
+        return [int(t) for t in procs.split()]
 
     def _oom_control_file_path(self):
         return os.path.join(self.path, "memory.oom_control")
@@ -106,8 +412,17 @@ class Cgroup(object):
     def _evt_control_file_path(self):
         return os.path.join(self.path, "cgroup.event_control")
 
+    def _pressure_level_file_path(self):
+        return os.path.join(self.path, "memory.pressure_level")
+
+    def _usage_file_path(self):
+        return os.path.join(self.path, "memory.usage_in_bytes")
+
     def _memory_limit_file_path(self):
-        return os.path.join(self.path, "memory.limit_in_bytes")
+        return os.path.join(self.path, MEMORY_LIMIT_FILE)
 
     def _tasks_file_path(self):
-        return os.path.join(self.path, "tasks")
+        return os.path.join(self.path, TASKS_FILE)
+
+    def _procs_file_path(self):
+        return os.path.join(self.path, PROCS_FILE)
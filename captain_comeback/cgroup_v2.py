@@ -0,0 +1,237 @@
+# coding:utf-8
+import os
+import logging
+import select
+import time
+
+from captain_comeback import metrics
+from captain_comeback.cgroup import memory_is_unconstrained
+from captain_comeback.restart.messages import RestartRequestedMessage
+from captain_comeback.restart.policy import policy_of
+
+logger = logging.getLogger()
+
+
+# Docker's systemd cgroup driver names cgroups docker-<id>.scope, whereas the
+# cgroupfs driver just uses the container ID.
+SYSTEMD_SCOPE_PREFIX = "docker-"
+SYSTEMD_SCOPE_SUFFIX = ".scope"
+
+
+def is_cgroup_v2(path):
+    # Every cgroup in the unified hierarchy has this file, and no cgroup in
+    # a v1 hierarchy does.
+    return os.path.exists(os.path.join(path, "cgroup.controllers"))
+
+
+def _parse_keyed_file(f):
+    f.seek(0)
+    return dict([entry.strip().split(' ') for entry in f.readlines()])
+
+
+def _read_max(path):
+    with open(path, "r") as f:
+        value = f.read().strip()
+    if value == "max":
+        return -1
+    return int(value)
+
+
+# There is no way to disable the OOM killer in cgroup v2, so we can't hold
+# containers at their limit the way we do in v1. Instead, we watch the oom
+# counter in memory.events (the kernel notifies us of changes through
+# POLLPRI), and request a restart whenever it moves.
+class CgroupV2(object):
+    EVENT_MASK = select.EPOLLPRI
+
+    def __init__(self, path, pressure_level=None, usage_thresholds=None):
+        assert pressure_level is None, "not supported with cgroup v2"
+        assert not usage_thresholds, "not supported with cgroup v2"
+        self.path = path
+        self.memory_events = None
+        self.cgroup_events = None
+        self._oom_count = None
+        self.restart_in_flight = False
+        # See Cgroup
+        self.restart_policy = None
+        self.quarantined_until = 0
+
+    @staticmethod
+    def is_container(entry):
+        if "." not in entry:
+            return True
+        return (entry.startswith(SYSTEMD_SCOPE_PREFIX) and
+                entry.endswith(SYSTEMD_SCOPE_SUFFIX))
+
+    @staticmethod
+    def container_entries(container_id):
+        # Depending on the cgroup driver Docker uses
+        return [container_id,
+                SYSTEMD_SCOPE_PREFIX + container_id + SYSTEMD_SCOPE_SUFFIX]
+
+    def name(self):
+        name = self.path.split("/")[-1]
+        if name.startswith(SYSTEMD_SCOPE_PREFIX):
+            name = name[len(SYSTEMD_SCOPE_PREFIX):]
+        if name.endswith(SYSTEMD_SCOPE_SUFFIX):
+            name = name[:-len(SYSTEMD_SCOPE_SUFFIX)]
+        return name
+
+    def left_to_oom_killer(self):
+        # See Cgroup
+        return (policy_of(self).never_restart or
+                time.time() < self.quarantined_until)
+
+    def open(self):
+        e = "{0} is already open".format(self.name())
+        assert self.memory_events is None, e
+        assert self.cgroup_events is None, e
+
+        logger.debug("%s: open", self.name())
+        self.memory_events = open(self._memory_events_file_path(), "r")
+        self.cgroup_events = open(self._cgroup_events_file_path(), "r")
+
+        # Only OOMs that happen after we start watching count.
+        self._oom_count = int(self.memory_events_status()["oom"])
+
+    def close(self):
+        e = "{0} is already closed".format(self.name())
+        assert self.memory_events is not None, e
+        assert self.cgroup_events is not None, e
+
+        logger.debug("%s: close", self.name())
+
+        self.memory_events.close()
+        self.memory_events = None
+
+        self.cgroup_events.close()
+        self.cgroup_events = None
+
+    def event_fileno(self):
+        return self.memory_events.fileno()
+
+    def event_filenos(self):
+        return [self.memory_events.fileno(), self.cgroup_events.fileno()]
+
+    def dispatch(self, efds, job_queue):
+        # Reading the files is what acknowledges the event.
+        for efd in efds:
+            if efd not in self.event_filenos():
+                raise Exception("Unexpected fd: {0}".format(efd))
+
+        if self.memory_events.fileno() in efds:
+            self.wakeup(job_queue)
+
+        if self.cgroup_events.fileno() in efds:
+            self.on_cgroup_event(job_queue)
+
+    def thresholds_need_rearm(self):
+        return False
+
+    def arm_thresholds(self):
+        pass
+
+    def on_oom_event(self, job_queue):
+        if self.left_to_oom_killer():
+            # The kernel already killed something, and that's all we do.
+            logger.info("%s: oom, left to the OOM killer", self.name())
+            return
+
+        if self.restart_in_flight:
+            logger.debug("%s: oom, restart in flight", self.name())
+            metrics.OOM_EVENTS_SUPPRESSED.inc()
+            return
+
+        logger.warning("%s: oom", self.name())
+        self.restart_in_flight = True
+        job_queue.put(RestartRequestedMessage(self))
+
+    def on_cgroup_event(self, _job_queue):
+        try:
+            status = self.cgroup_events_status()
+        except EnvironmentError:
+            logger.warning("%s: cgroup is stale", self.name())
+            return
+
+        logger.debug("%s: populated: %s, frozen: %s", self.name(),
+                     status.get("populated"), status.get("frozen"))
+
+    def wakeup(self, job_queue, raise_for_stale=False):
+        logger.debug("%s: wakeup", self.name())
+
+        try:
+            memory_events_status = self.memory_events_status()
+        except EnvironmentError:
+            logger.warning("%s: cgroup is stale", self.name())
+            if raise_for_stale:
+                raise
+            return
+
+        oom_count = int(memory_events_status["oom"])
+        if oom_count > self._oom_count:
+            self._oom_count = oom_count
+            self.on_oom_event(job_queue)
+
+    def memory_events_status(self):
+        return _parse_keyed_file(self.memory_events)
+
+    def cgroup_events_status(self):
+        return _parse_keyed_file(self.cgroup_events)
+
+    def memory_limit_in_bytes(self):
+        return _read_max(self._memory_max_file_path())
+
+    def usage_in_bytes(self):
+        with open(self._memory_current_file_path()) as f:
+            return int(f.read())
+
+    def rss_in_bytes(self):
+        with open(self._memory_stat_file_path()) as f:
+            return int(_parse_keyed_file(f)["anon"])
+
+    def set_memory_limit_in_bytes(self, new_limit):
+        # If memory.high is set, keep it at the same distance from
+        # memory.max, otherwise the container would stay throttled at its
+        # old limit.
+        memory_limit = self.memory_limit_in_bytes()
+        memory_high = _read_max(self._memory_high_file_path())
+
+        with open(self._memory_max_file_path(), "w") as f:
+            f.write(str(new_limit))
+            f.write("\n")
+
+        if memory_is_unconstrained(memory_high) or \
+                memory_is_unconstrained(memory_limit):
+            return
+
+        with open(self._memory_high_file_path(), "w") as f:
+            f.write(str(memory_high + new_limit - memory_limit))
+            f.write("\n")
+
+    def pids(self):
+        with open(self._procs_file_path()) as f:
+            return [int(t) for t in f.readlines()]
+
+    def procs(self):
+        return self.pids()
+
+    def _memory_events_file_path(self):
+        return os.path.join(self.path, "memory.events")
+
+    def _cgroup_events_file_path(self):
+        return os.path.join(self.path, "cgroup.events")
+
+    def _memory_max_file_path(self):
+        return os.path.join(self.path, "memory.max")
+
+    def _memory_high_file_path(self):
+        return os.path.join(self.path, "memory.high")
+
+    def _memory_current_file_path(self):
+        return os.path.join(self.path, "memory.current")
+
+    def _memory_stat_file_path(self):
+        return os.path.join(self.path, "memory.stat")
+
+    def _procs_file_path(self):
+        return os.path.join(self.path, "cgroup.procs")
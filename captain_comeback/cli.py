@@ -4,55 +4,584 @@ import logging
 import argparse
 import threading
 import time
+import math
+import multiprocessing
 from six.moves import queue
 
-from captain_comeback.index import CgroupIndex
-from captain_comeback.restart.engine import RestartEngine
+from captain_comeback.metrics import start_metrics_server
+from captain_comeback.hardening import (protect_process, lock_memory,
+                                        MemoryWatch)
+from captain_comeback.index import (CgroupIndex, DEFAULT_RESCAN_INTERVAL,
+                                    DEFAULT_MAX_DEPTH)
+from captain_comeback.shard import ShardForwarder, Coordinator
+from captain_comeback.watchdog import (HostMemoryWatchdog,
+                                       PressureLevelTrigger, PsiTrigger,
+                                       DEFAULT_HOST_MIN_AVAILABLE,
+                                       DEFAULT_HOST_MAX_VICTIMS,
+                                       DEFAULT_PSI_MEMORY)
+from captain_comeback.cgroup import Cgroup, PRESSURE_LEVELS
+from captain_comeback.cgroup_v2 import CgroupV2, is_cgroup_v2
+from captain_comeback.restart.engine import (RestartEngine, PRESSURE_ACTIONS,
+                                             PRESSURE_ACTION_LOG,
+                                             DEFAULT_RESTART_WORKERS,
+                                             DEFAULT_MAX_PENDING_RESTARTS)
+from captain_comeback.restart.backends import (
+    DockerCliBackend, DockerApiBackend, SignalBackend, SelectBackend,
+    SIGNAL_TARGET_ALL, SIGNAL_TARGET_LARGEST, RESTART_BACKEND_API,
+    RESTART_BACKEND_CLI, RESTART_BACKEND_SIGNAL,
+    RESTART_BACKEND_SIGNAL_LARGEST, RESTART_BACKENDS)
+from captain_comeback.restart.headroom import (
+    HeadroomBudget, HEADROOM_POLICIES, HEADROOM_POLICY_PARTIAL,
+    DEFAULT_HEADROOM_FRACTION, DEFAULT_HEADROOM_MIN_FREE)
+from captain_comeback.restart.backoff import (
+    RestartBackoff, TokenBucket, DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX,
+    DEFAULT_BACKOFF_RESET, DEFAULT_QUARANTINE_AFTER,
+    DEFAULT_QUARANTINE_PERIOD, DEFAULT_RESTART_RATE, DEFAULT_RESTART_BURST)
+from captain_comeback.restart.snapshot import (TaskSnapshotter,
+                                               DEFAULT_SNAPSHOT_TOP_N,
+                                               DEFAULT_SNAPSHOT_BUDGET)
+from captain_comeback.restart.limits import LimitJournal, DEFAULT_LIMIT_JOURNAL
+from captain_comeback.restart.docker_api import (DockerClient,
+                                                 DEFAULT_DOCKER_SOCKET)
+from captain_comeback.restart.docker_events import DockerEventStream
+from captain_comeback.restart.policy import PolicyResolver
+from captain_comeback.restart.freezer import CgroupFreezer, CgroupV2Freezer
 
 
 logger = logging.getLogger()
 
 
+CGROUP_MOUNT = "/sys/fs/cgroup"
 DEFAULT_ROOT_CG = "/sys/fs/cgroup/memory/docker"
+DEFAULT_ROOT_CG_V2 = "/sys/fs/cgroup/system.slice"
+# Where the host's memory pressure level is (cgroup v1)
+HOST_MEMORY_CG = "/sys/fs/cgroup/memory"
+DEFAULT_HOST_PRESSURE_LEVEL = "medium"
 DEFAULT_SYNC_TARGET_INTERVAL = 1
 DEFAULT_RESTART_GRACE_PERIOD = 10
+DEFAULT_SYNC_SLICE_BUDGET = 0
 
+RUNTIME_THREADS = "threads"
+RUNTIME_ASYNCIO = "asyncio"
+RUNTIMES = [RUNTIME_THREADS, RUNTIME_ASYNCIO]
+
+# How often to run a sync slice when syncing incrementally.
+SYNC_SLICE_PERIOD = 0.05
+
+DEFAULT_SHARDS = 1
+# How often to check that shard processes are still alive.
+SHARD_CHECK_INTERVAL = 1
+
+
+def poll_until(index, deadline):
+    while True:
+        poll_timeout = deadline - time.time()
+        if poll_timeout <= 0:
+            break
+        logger.debug("poll with timeout: %s", poll_timeout)
+        index.poll(poll_timeout)
+
+
+def run_full_sync(index, sync_target_interval, memory_watch=None):
+    while True:
+        index.sync()
+        if memory_watch is not None:
+            memory_watch.check()
+        poll_until(index, time.time() + sync_target_interval)
+
+
+def run_incremental_sync(index, sync_target_interval, sync_slice_budget,
+                         memory_watch=None):
+    # Spread the sync across the interval in small slices, so that we never
+    # spend more than sync_slice_budget without dispatching events.
+    while True:
+        round_end = time.time() + sync_target_interval
+        index.begin_sync()
+        if memory_watch is not None:
+            memory_watch.check()
+
+        while True:
+            now = time.time()
+            if now >= round_end:
+                break
+
+            slices_left = max(1, int((round_end - now) / SYNC_SLICE_PERIOD))
+            quota = int(math.ceil(index.sync_pending() / float(slices_left)))
+            if quota:
+                index.sync_slice(quota, sync_slice_budget)
+
+            poll_until(index, min(round_end, time.time() + SYNC_SLICE_PERIOD))
+
+
+def run_sync(index, sync_target_interval, sync_slice_budget,
+             memory_watch=None):
+    if sync_slice_budget > 0:
+        run_incremental_sync(index, sync_target_interval, sync_slice_budget,
+                             memory_watch)
+    else:
+        run_full_sync(index, sync_target_interval, memory_watch)
+
+
+def warm_up(index):
+    # Pick up existing cgroups before we lock our memory.
+    index.sync()
+    lock_memory()
+    memory_watch = MemoryWatch()
+    memory_watch.reset()
+    return memory_watch
+
+
+def make_container_events(docker_events, docker_socket):
+    if not docker_events:
+        return None
+    return DockerEventStream(docker_socket)
 
-def main(root_cg_path, sync_target_interval, restart_grace_period):
-    threading.current_thread().name = "index"
+
+def make_host_watchdog(host_min_available, host_target_available,
+                       host_max_victims, host_pressure_level, cgroup_class):
+    if not host_min_available:
+        return None
+
+    # Checked at every sync, and whenever the kernel tells us memory is
+    # getting tight.
+    if cgroup_class is CgroupV2:
+        trigger = PsiTrigger(DEFAULT_PSI_MEMORY)
+    else:
+        trigger = PressureLevelTrigger(HOST_MEMORY_CG, host_pressure_level)
+
+    return HostMemoryWatchdog(host_min_available, host_target_available,
+                              trigger, host_max_victims)
+
+
+def make_freezer(freeze, cgroup_class):
+    if not freeze:
+        return None
+    if cgroup_class is CgroupV2:
+        return CgroupV2Freezer()
+    return CgroupFreezer()
+
+
+def make_policies(policy_file, policy_labels, docker_socket):
+    if policy_file is None and not policy_labels:
+        return None
+    client = DockerClient(docker_socket) if policy_labels else None
+    return PolicyResolver(policy_file, client)
+
+
+def run_shard(shard, shards, root_cg_paths, cgroup_class, rescan_interval,
+              pressure_level, usage_thresholds, sync_target_interval,
+              sync_slice_budget, harden, docker_events, docker_socket,
+              max_depth, policy_file, policy_labels, upstream, downstream):
+    threading.current_thread().name = "shard-{0}".format(shard)
+
+    # Each shard has its own subscription, since it has its own index.
+    container_events = make_container_events(docker_events, docker_socket)
+    policies = make_policies(policy_file, policy_labels, docker_socket)
 
     job_queue = queue.Queue()
-    index = CgroupIndex(root_cg_path, job_queue)
+    index = CgroupIndex(root_cg_paths, job_queue, rescan_interval,
+                        pressure_level, usage_thresholds, cgroup_class,
+                        shard=(shard, shards),
+                        container_events=container_events,
+                        max_depth=max_depth, policies=policies)
     index.open()
+    ShardForwarder(shard, index, job_queue, upstream, downstream).start()
+    if container_events is not None:
+        container_events.start()
+
+    memory_watch = warm_up(index) if harden else None
+    run_sync(index, sync_target_interval, sync_slice_budget, memory_watch)
+
+
+def start_shards(shards, *args):
+    # We fork, so this has to happen before we start any threads.
+    if hasattr(multiprocessing, "get_context"):
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing
+
+    upstream = ctx.Queue()
+    downstreams = []
+    processes = []
+
+    for shard in range(shards):
+        downstream = ctx.Queue()
+        process = ctx.Process(target=run_shard, name="shard-{0}".format(shard),
+                              args=(shard, shards) + args +
+                              (upstream, downstream))
+        process.daemon = True
+        process.start()
+        downstreams.append(downstream)
+        processes.append(process)
+
+    return upstream, downstreams, processes
+
+
+def supervise_shards(processes):
+    # We can't safely fork new shards now that we have threads, so if one
+    # dies, we exit and let whatever supervises us restart everything.
+    while True:
+        for process in processes:
+            if not process.is_alive():
+                logger.error("%s exited with status %s", process.name,
+                             process.exitcode)
+                sys.exit(1)
+        time.sleep(SHARD_CHECK_INTERVAL)
+
+
+def parse_usage_thresholds(arg):
+    try:
+        thresholds = [float(t) for t in arg.split(",") if t]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid thresholds: {0}".format(arg))
+
+    for threshold in thresholds:
+        if not 0 < threshold <= 1:
+            e = "thresholds must be in (0, 1]: {0}".format(threshold)
+            raise argparse.ArgumentTypeError(e)
+
+    return thresholds
 
-    restarter = RestartEngine(job_queue, restart_grace_period)
+
+def parse_container_backend(arg):
+    pattern, sep, name = arg.rpartition("=")
+    if not sep or not pattern:
+        raise argparse.ArgumentTypeError(
+            "expected PATTERN=BACKEND: {0}".format(arg))
+    if name not in RESTART_BACKENDS:
+        raise argparse.ArgumentTypeError(
+            "invalid backend: {0} (choose from {1})".format(
+                name, ", ".join(RESTART_BACKENDS)))
+    return pattern, name
+
+
+def make_restart_backend(name, docker_socket):
+    if name == RESTART_BACKEND_CLI:
+        return DockerCliBackend()
+    if name == RESTART_BACKEND_SIGNAL:
+        return SignalBackend(SIGNAL_TARGET_ALL)
+    if name == RESTART_BACKEND_SIGNAL_LARGEST:
+        return SignalBackend(SIGNAL_TARGET_LARGEST)
+    # We keep the CLI around in case the API is unreachable.
+    return DockerApiBackend(DockerClient(docker_socket), DockerCliBackend())
+
+
+def make_restart_backends(default, container_backends, docker_socket):
+    # Restart policies can ask for any backend by name. Backends are cheap
+    # until used, and this shares them (and e.g. their Docker API
+    # connections) across patterns.
+    backends = dict((name, make_restart_backend(name, docker_socket))
+                    for name in RESTART_BACKENDS)
+    overrides = [(pattern, backends[name])
+                 for pattern, name in container_backends or []]
+    return SelectBackend(backends[default], overrides, backends)
+
+
+def main(root_cg_paths, sync_target_interval, rescan_interval,
+         restart_grace_period, sync_slice_budget=DEFAULT_SYNC_SLICE_BUDGET,
+         pressure_level=None, pressure_action=PRESSURE_ACTION_LOG,
+         usage_thresholds=None, restart_backend=RESTART_BACKEND_API,
+         docker_socket=DEFAULT_DOCKER_SOCKET, container_backends=None,
+         restart_workers=DEFAULT_RESTART_WORKERS,
+         max_pending_restarts=DEFAULT_MAX_PENDING_RESTARTS,
+         headroom_fraction=DEFAULT_HEADROOM_FRACTION,
+         headroom_policy=HEADROOM_POLICY_PARTIAL,
+         headroom_min_free=DEFAULT_HEADROOM_MIN_FREE,
+         limit_journal=DEFAULT_LIMIT_JOURNAL,
+         snapshot_top_n=DEFAULT_SNAPSHOT_TOP_N,
+         snapshot_budget=DEFAULT_SNAPSHOT_BUDGET, metrics_address=None,
+         harden=False, shards=DEFAULT_SHARDS, runtime=RUNTIME_THREADS,
+         docker_events=False, max_depth=DEFAULT_MAX_DEPTH, policy_file=None,
+         policy_labels=False, backoff_base=DEFAULT_BACKOFF_BASE,
+         backoff_max=DEFAULT_BACKOFF_MAX, backoff_reset=DEFAULT_BACKOFF_RESET,
+         quarantine_after=DEFAULT_QUARANTINE_AFTER,
+         quarantine_period=DEFAULT_QUARANTINE_PERIOD,
+         restart_rate=DEFAULT_RESTART_RATE,
+         restart_burst=DEFAULT_RESTART_BURST,
+         host_min_available=DEFAULT_HOST_MIN_AVAILABLE,
+         host_target_available=None,
+         host_max_victims=DEFAULT_HOST_MAX_VICTIMS,
+         host_pressure_level=DEFAULT_HOST_PRESSURE_LEVEL, freeze=False):
+    threading.current_thread().name = "index"
+
+    if harden:
+        protect_process()
+
+    if runtime == RUNTIME_ASYNCIO:
+        # Only importable on Python 3.5+
+        from captain_comeback import aio
+        loop = aio.new_event_loop()
+        job_queue = aio.LoopQueue()
+    else:
+        job_queue = queue.Queue()
+
+    # We don't support mixing cgroup versions.
+    cgroup_class = CgroupV2 if is_cgroup_v2(root_cg_paths[0]) else Cgroup
+    logger.info("monitoring %s (%s, depth %s)", ", ".join(root_cg_paths),
+                cgroup_class.__name__, max_depth)
+
+    # Put back limits we raised before crashing mid-restart, if any.
+    limits = LimitJournal(limit_journal)
+    limits.restore_all(cgroup_class)
+
+    index = None
+    coordinator = None
+
+    if shards > 1:
+        logger.info("sharding cgroups across %s processes", shards)
+        upstream, downstreams, shard_processes = start_shards(
+            shards, root_cg_paths, cgroup_class, rescan_interval,
+            pressure_level, usage_thresholds, sync_target_interval,
+            sync_slice_budget, harden, docker_events, docker_socket,
+            max_depth, policy_file, policy_labels)
+        coordinator = Coordinator(job_queue, cgroup_class, upstream,
+                                  downstreams)
+    else:
+        container_events = make_container_events(docker_events,
+                                                 docker_socket)
+        policies = make_policies(policy_file, policy_labels, docker_socket)
+        host_watchdog = make_host_watchdog(
+            host_min_available, host_target_available, host_max_victims,
+            host_pressure_level, cgroup_class)
+        index = CgroupIndex(root_cg_paths, job_queue, rescan_interval,
+                            pressure_level, usage_thresholds, cgroup_class,
+                            container_events=container_events,
+                            max_depth=max_depth, policies=policies,
+                            host_watchdog=host_watchdog)
+        index.open()
+        if container_events is not None:
+            container_events.start()
+
+    if metrics_address is not None:
+        start_metrics_server(metrics_address)
+
+    headroom = HeadroomBudget(headroom_fraction, headroom_policy,
+                              headroom_min_free)
+    snapshotter = TaskSnapshotter(snapshot_top_n, snapshot_budget)
+    backoff = RestartBackoff(backoff_base, backoff_max, backoff_reset,
+                             quarantine_after, quarantine_period)
+    rate_limit = TokenBucket(restart_rate, restart_burst)
+    freezer = make_freezer(freeze, cgroup_class)
+
+    if runtime == RUNTIME_ASYNCIO:
+        assert index is not None, "sharding needs the threads runtime"
+        backend = aio.make_restart_backends(restart_backend,
+                                            container_backends, docker_socket)
+        restarter = aio.AsyncRestartEngine(
+            job_queue, restart_grace_period, pressure_action, backend,
+            restart_workers, max_pending_restarts, headroom=headroom,
+            limits=limits, snapshotter=snapshotter, backoff=backoff,
+            rate_limit=rate_limit, freezer=freezer)
+        memory_watch = warm_up(index) if harden else None
+        aio.run(loop, index, restarter, sync_target_interval,
+                sync_slice_budget, memory_watch)
+        return
+
+    backend = make_restart_backends(restart_backend, container_backends,
+                                    docker_socket)
+    restarter = RestartEngine(job_queue, restart_grace_period,
+                              pressure_action, backend, restart_workers,
+                              max_pending_restarts, headroom=headroom,
+                              limits=limits, snapshotter=snapshotter,
+                              backoff=backoff, rate_limit=rate_limit,
+                              freezer=freezer)
+    restarter.start_workers()
     restarter_thread = threading.Thread(target=restarter.run, name="restarter")
     restarter_thread.daemon = True
     restarter_thread.start()
 
-    while True:
-        index.sync()
-        next_sync = time.time() + sync_target_interval
-        while True:
-            poll_timeout = next_sync - time.time()
-            if poll_timeout <= 0:
-                break
-            logger.debug("poll with timeout: %s", poll_timeout)
-            index.poll(poll_timeout)
+    if coordinator is not None:
+        coordinator_thread = threading.Thread(target=coordinator.run,
+                                              name="coordinator")
+        coordinator_thread.daemon = True
+        coordinator_thread.start()
+
+        if harden:
+            lock_memory()
+        supervise_shards(shard_processes)
+        return
+
+    memory_watch = warm_up(index) if harden else None
+    run_sync(index, sync_target_interval, sync_slice_budget, memory_watch)
 
 
 def main_wrapper(args):
     desc = "Autorestart containers that exceed their memory allocation"
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument("--root-cg",
-                        default=DEFAULT_ROOT_CG,
-                        help="parent cgroup (children will be monitored)")
+    parser.add_argument("--root-cg", dest="root_cgs",
+                        default=[], action="append",
+                        help="parent cgroup (children will be monitored); "
+                             "may be repeated; defaults to {0}, or {1} with "
+                             "cgroup v2".format(
+                                 DEFAULT_ROOT_CG, DEFAULT_ROOT_CG_V2))
+    parser.add_argument("--max-depth", default=DEFAULT_MAX_DEPTH, type=int,
+                        help="look for containers this many levels under "
+                             "the parent cgroups (e.g. 3 for Kubernetes' "
+                             "kubepods/<qos>/<pod>/<container>); below the "
+                             "first level, only cgroups with tasks of their "
+                             "own are monitored")
     parser.add_argument("--sync-interval",
                         default=DEFAULT_SYNC_TARGET_INTERVAL, type=float,
                         help="target sync interval to refresh cgroups")
+    parser.add_argument("--sync-slice-budget",
+                        default=DEFAULT_SYNC_SLICE_BUDGET, type=float,
+                        help="sync incrementally, spending at most this many "
+                             "seconds at a time (0 to sync all cgroups at "
+                             "once)")
+    parser.add_argument("--rescan-interval",
+                        default=DEFAULT_RESCAN_INTERVAL, type=float,
+                        help="interval between full scans of the parent "
+                             "cgroup (new cgroups are normally discovered "
+                             "via inotify)")
     parser.add_argument("--restart-grace-period",
                         default=DEFAULT_RESTART_GRACE_PERIOD, type=int,
                         help="how long to wait before sending SIGKILL")
+    parser.add_argument("--restart-backend", default=RESTART_BACKEND_API,
+                        choices=RESTART_BACKENDS,
+                        help="restart containers through the Docker API "
+                             "(falling back to the CLI if it's unavailable), "
+                             "the Docker CLI, or by signalling their tasks "
+                             "directly (all of them, or only the largest)")
+    parser.add_argument("--container-backend", dest="container_backends",
+                        default=[], action="append",
+                        type=parse_container_backend,
+                        metavar="PATTERN=BACKEND",
+                        help="use a different restart backend for "
+                             "containers whose name matches PATTERN (a "
+                             "shell-style wildcard); may be repeated, the "
+                             "first match wins")
+    parser.add_argument("--policy-file", default=None,
+                        help="JSON file of per-container restart policies "
+                             "(grace period, headroom fraction, backend, "
+                             "priority, or never restart), reloaded when it "
+                             "changes")
+    parser.add_argument("--policy-labels", default=False,
+                        action="store_true",
+                        help="read restart policies from container labels "
+                             "(e.g. captain-comeback.grace-period=3), "
+                             "which override the policy file; looked up "
+                             "through the Docker API when containers start")
+    parser.add_argument("--restart-workers",
+                        default=DEFAULT_RESTART_WORKERS, type=int,
+                        help="how many containers to restart concurrently")
+    parser.add_argument("--max-pending-restarts",
+                        default=DEFAULT_MAX_PENDING_RESTARTS, type=int,
+                        help="how many restarts to queue up before "
+                             "deferring new ones")
+    parser.add_argument("--backoff-base",
+                        default=DEFAULT_BACKOFF_BASE, type=float,
+                        help="how long to wait before restarting a container "
+                             "again after a restart, doubling every time it "
+                             "needs restarting again (0 to disable)")
+    parser.add_argument("--backoff-max",
+                        default=DEFAULT_BACKOFF_MAX, type=float,
+                        help="the longest we wait between restarts of a "
+                             "container")
+    parser.add_argument("--backoff-reset",
+                        default=DEFAULT_BACKOFF_RESET, type=float,
+                        help="how long a container has to stay up after a "
+                             "restart for its backoff to start over")
+    parser.add_argument("--quarantine-after",
+                        default=DEFAULT_QUARANTINE_AFTER, type=int,
+                        help="after this many restarts in a row, leave a "
+                             "container to the kernel's OOM killer for a "
+                             "while (0 to disable)")
+    parser.add_argument("--quarantine-period",
+                        default=DEFAULT_QUARANTINE_PERIOD, type=float,
+                        help="how long containers stay in quarantine")
+    parser.add_argument("--restart-rate",
+                        default=DEFAULT_RESTART_RATE, type=float,
+                        help="how many restarts to start per second, at "
+                             "most, across all containers (0 for no limit)")
+    parser.add_argument("--restart-burst",
+                        default=DEFAULT_RESTART_BURST, type=int,
+                        help="how many restarts can start at once before "
+                             "--restart-rate kicks in")
+    parser.add_argument("--headroom-fraction",
+                        default=DEFAULT_HEADROOM_FRACTION, type=float,
+                        help="extra memory to grant containers while they "
+                             "restart, as a fraction of their limit")
+    parser.add_argument("--headroom-policy", default=HEADROOM_POLICY_PARTIAL,
+                        choices=HEADROOM_POLICIES,
+                        help="whether to grant part of the extra memory when "
+                             "there isn't enough free memory for all of it")
+    parser.add_argument("--headroom-min-free",
+                        default=DEFAULT_HEADROOM_MIN_FREE, type=int,
+                        help="free memory (in bytes) to never grant to "
+                             "restarting containers")
+    parser.add_argument("--freeze", default=False, action="store_true",
+                        help="freeze containers while we snapshot them and "
+                             "grant them extra memory, and thaw them right "
+                             "before restarting them")
+    parser.add_argument("--snapshot-top-n",
+                        default=DEFAULT_SNAPSHOT_TOP_N, type=int,
+                        help="how many of the largest tasks to log when "
+                             "restarting a container")
+    parser.add_argument("--snapshot-budget",
+                        default=DEFAULT_SNAPSHOT_BUDGET, type=float,
+                        help="how long to spend (at most) looking at tasks "
+                             "when restarting a container")
+    parser.add_argument("--limit-journal", default=DEFAULT_LIMIT_JOURNAL,
+                        help="where to record memory limits to restore "
+                             "after restarts")
+    parser.add_argument("--docker-socket", default=DEFAULT_DOCKER_SOCKET,
+                        help="path to the Docker API socket")
+    parser.add_argument("--docker-events", default=False,
+                        action="store_true",
+                        help="follow Docker's event stream to pick up "
+                             "containers as they start and stop, and "
+                             "restarts we didn't ask for (syncs still run "
+                             "as a fallback)")
+    parser.add_argument("--pressure-level", default=None,
+                        choices=PRESSURE_LEVELS,
+                        help="get notified when containers reach this memory "
+                             "pressure level (disabled by default)")
+    parser.add_argument("--pressure-action", default=PRESSURE_ACTION_LOG,
+                        choices=PRESSURE_ACTIONS,
+                        help="what to do when a container reaches the "
+                             "memory pressure level")
+    parser.add_argument("--usage-thresholds", default=None,
+                        type=parse_usage_thresholds,
+                        help="comma-separated fractions of the memory limit "
+                             "(e.g. 0.8,0.95) at which to report memory "
+                             "usage (disabled by default)")
+    parser.add_argument("--host-min-available",
+                        default=DEFAULT_HOST_MIN_AVAILABLE, type=int,
+                        help="restart containers (lowest priority, then "
+                             "largest first) when the host has less than "
+                             "this much memory (in bytes) available "
+                             "(disabled by default, not supported with "
+                             "--shards)")
+    parser.add_argument("--host-target-available", default=None, type=int,
+                        help="how much memory (in bytes) to free up once "
+                             "below --host-min-available (defaults to "
+                             "--host-min-available)")
+    parser.add_argument("--host-max-victims",
+                        default=DEFAULT_HOST_MAX_VICTIMS, type=int,
+                        help="how many containers to restart at once when "
+                             "the host is low on memory")
+    parser.add_argument("--host-pressure-level",
+                        default=DEFAULT_HOST_PRESSURE_LEVEL,
+                        choices=PRESSURE_LEVELS,
+                        help="host memory pressure level at which to check "
+                             "available memory between syncs (cgroup v1; "
+                             "cgroup v2 uses PSI)")
+    parser.add_argument("--metrics-address", default=None,
+                        help="serve Prometheus metrics on this address "
+                             "(host:port or unix:/path/to/socket)")
+    parser.add_argument("--shards", default=DEFAULT_SHARDS, type=int,
+                        help="split cgroups (by name) across this many "
+                             "processes, each with its own event loop")
+    parser.add_argument("--runtime", default=RUNTIME_THREADS,
+                        choices=RUNTIMES,
+                        help="run restarts on worker threads, or everything "
+                             "on a single asyncio event loop (Python 3.5+, "
+                             "not supported with --shards)")
+    parser.add_argument("--harden", default=False, action="store_true",
+                        help="protect ourselves when the host is out of "
+                             "memory: opt out of the OOM killer, lock our "
+                             "memory, and report how much resident memory "
+                             "the whole process gains once warmed up")
     parser.add_argument("--debug", default=False, action='store_true',
                         help="enable debug logging")
 
@@ -64,18 +593,152 @@ def main_wrapper(args):
     logging.basicConfig(level=log_level, format=log_format)
     logger.setLevel(log_level)
 
+    root_cgs = ns.root_cgs
+    if not root_cgs:
+        if is_cgroup_v2(CGROUP_MOUNT):
+            root_cgs = [DEFAULT_ROOT_CG_V2]
+        else:
+            root_cgs = [DEFAULT_ROOT_CG]
+
+    if len(set(is_cgroup_v2(root_cg) for root_cg in root_cgs)) > 1:
+        parser.error("--root-cg can't mix cgroup v1 and v2")
+
+    if is_cgroup_v2(root_cgs[0]):
+        if ns.pressure_level is not None or ns.usage_thresholds:
+            parser.error("--pressure-level and --usage-thresholds are not "
+                         "supported with cgroup v2")
+
     sync_interval = ns.sync_interval
     if sync_interval < 0:
         logger.warning("invalid sync interval %s, must be > 0", sync_interval)
         sync_interval = DEFAULT_SYNC_TARGET_INTERVAL
 
+    sync_slice_budget = ns.sync_slice_budget
+    if sync_slice_budget < 0:
+        logger.warning("invalid sync slice budget %s, must be >= 0",
+                       sync_slice_budget)
+        sync_slice_budget = DEFAULT_SYNC_SLICE_BUDGET
+
+    restart_workers = ns.restart_workers
+    if restart_workers < 1:
+        logger.warning("invalid restart workers %s, must be > 0",
+                       restart_workers)
+        restart_workers = DEFAULT_RESTART_WORKERS
+
+    max_pending_restarts = ns.max_pending_restarts
+    if max_pending_restarts < 1:
+        logger.warning("invalid max pending restarts %s, must be > 0",
+                       max_pending_restarts)
+        max_pending_restarts = DEFAULT_MAX_PENDING_RESTARTS
+
+    headroom_fraction = ns.headroom_fraction
+    if headroom_fraction < 0:
+        logger.warning("invalid headroom fraction %s, must be >= 0",
+                       headroom_fraction)
+        headroom_fraction = DEFAULT_HEADROOM_FRACTION
+
+    headroom_min_free = ns.headroom_min_free
+    if headroom_min_free < 0:
+        logger.warning("invalid headroom min free %s, must be >= 0",
+                       headroom_min_free)
+        headroom_min_free = DEFAULT_HEADROOM_MIN_FREE
+
+    backoff_base = ns.backoff_base
+    if backoff_base < 0:
+        logger.warning("invalid backoff base %s, must be >= 0", backoff_base)
+        backoff_base = DEFAULT_BACKOFF_BASE
+
+    backoff_max = ns.backoff_max
+    if backoff_max < 0:
+        logger.warning("invalid backoff max %s, must be >= 0", backoff_max)
+        backoff_max = DEFAULT_BACKOFF_MAX
+
+    backoff_reset = ns.backoff_reset
+    if backoff_reset < 0:
+        logger.warning("invalid backoff reset %s, must be >= 0",
+                       backoff_reset)
+        backoff_reset = DEFAULT_BACKOFF_RESET
+
+    quarantine_after = ns.quarantine_after
+    if quarantine_after < 0:
+        logger.warning("invalid quarantine after %s, must be >= 0",
+                       quarantine_after)
+        quarantine_after = DEFAULT_QUARANTINE_AFTER
+
+    quarantine_period = ns.quarantine_period
+    if quarantine_period < 0:
+        logger.warning("invalid quarantine period %s, must be >= 0",
+                       quarantine_period)
+        quarantine_period = DEFAULT_QUARANTINE_PERIOD
+
+    restart_rate = ns.restart_rate
+    if restart_rate < 0:
+        logger.warning("invalid restart rate %s, must be >= 0", restart_rate)
+        restart_rate = DEFAULT_RESTART_RATE
+
+    restart_burst = ns.restart_burst
+    if restart_burst < 1:
+        logger.warning("invalid restart burst %s, must be > 0",
+                       restart_burst)
+        restart_burst = DEFAULT_RESTART_BURST
+
+    rescan_interval = ns.rescan_interval
+    if rescan_interval < 0:
+        logger.warning("invalid rescan interval %s, must be > 0",
+                       rescan_interval)
+        rescan_interval = DEFAULT_RESCAN_INTERVAL
+
+    max_depth = ns.max_depth
+    if max_depth < 1:
+        logger.warning("invalid max depth %s, must be > 0", max_depth)
+        max_depth = DEFAULT_MAX_DEPTH
+
+    shards = ns.shards
+    if shards < 1:
+        logger.warning("invalid shards %s, must be > 0", shards)
+        shards = DEFAULT_SHARDS
+
+    host_min_available = ns.host_min_available
+    if host_min_available < 0:
+        logger.warning("invalid host min available %s, must be >= 0",
+                       host_min_available)
+        host_min_available = DEFAULT_HOST_MIN_AVAILABLE
+
+    host_max_victims = ns.host_max_victims
+    if host_max_victims < 1:
+        logger.warning("invalid host max victims %s, must be > 0",
+                       host_max_victims)
+        host_max_victims = DEFAULT_HOST_MAX_VICTIMS
+
+    if host_min_available and shards > 1:
+        parser.error("--host-min-available is not supported with --shards")
+
+    if ns.runtime == RUNTIME_ASYNCIO:
+        if sys.version_info < (3, 5):
+            parser.error("--runtime {0} needs Python 3.5 or later".format(
+                RUNTIME_ASYNCIO))
+        if shards > 1:
+            parser.error("--shards is not supported with --runtime {0}"
+                         .format(RUNTIME_ASYNCIO))
+
     restart_grace_period = ns.restart_grace_period
     if restart_grace_period < 0:
         logger.warning("invalid restart grace period %s, must be > 0",
                        restart_grace_period)
         restart_grace_period = DEFAULT_RESTART_GRACE_PERIOD
 
-    main(ns.root_cg, sync_interval, restart_grace_period)
+    main(root_cgs, sync_interval, rescan_interval, restart_grace_period,
+         sync_slice_budget, ns.pressure_level, ns.pressure_action,
+         ns.usage_thresholds, ns.restart_backend, ns.docker_socket,
+         ns.container_backends, restart_workers, max_pending_restarts,
+         headroom_fraction, ns.headroom_policy, headroom_min_free,
+         ns.limit_journal,
+         ns.snapshot_top_n, ns.snapshot_budget, ns.metrics_address,
+         ns.harden, shards, ns.runtime, ns.docker_events, max_depth,
+         ns.policy_file, ns.policy_labels, backoff_base, backoff_max,
+         backoff_reset, quarantine_after, quarantine_period, restart_rate,
+         restart_burst, host_min_available, ns.host_target_available,
+         host_max_victims, ns.host_pressure_level, ns.freeze)
 
 
 def cli_entrypoint():
@@ -0,0 +1,102 @@
+# coding:utf-8
+import os
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from captain_comeback import metrics
+
+
+logger = logging.getLogger()
+
+
+# We're needed most when the host is out of memory, so in hardened mode, we
+# ask the kernel not to pick us as an OOM victim, and lock our memory so that
+# we don't stall on page faults. Locking memory means every thread stack is
+# resident, so we also ask for smaller stacks than the (usually 8MB) default.
+OOM_SCORE_ADJ_MIN = -1000
+HARDENED_STACK_SIZE = 512 * 1024
+
+# From <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def set_oom_score_adj(value=OOM_SCORE_ADJ_MIN, pid="self"):
+    path = os.path.join("/proc", str(pid), "oom_score_adj")
+    with open(path, "w") as f:
+        f.write("{0}\n".format(value))
+
+
+def mlockall(flags=MCL_CURRENT | MCL_FUTURE):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mlockall(flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def protect_process():
+    # Call this before starting any threads.
+    try:
+        set_oom_score_adj()
+    except EnvironmentError as e:
+        logger.warning("failed to set oom_score_adj: %s", e)
+    else:
+        logger.info("set oom_score_adj = %s", OOM_SCORE_ADJ_MIN)
+
+    threading.stack_size(HARDENED_STACK_SIZE)
+
+
+def lock_memory():
+    # Call this once we've warmed up (i.e. started our threads and registered
+    # the cgroups we know about), so that what we lock is what we'll need.
+    try:
+        mlockall()
+    except EnvironmentError as e:
+        logger.warning("failed to lock memory: %s", e)
+        return False
+
+    logger.info("locked memory")
+    return True
+
+
+def process_memory(status_path="/proc/self/status"):
+    # Returns resident and locked memory, in bytes.
+    rss, locked = 0, 0
+    with open(status_path) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith("VmLck:"):
+                locked = int(line.split()[1]) * 1024
+    return rss, locked
+
+
+class MemoryWatch(object):
+    # Reports whether the whole process keeps taking memory from the kernel
+    # once we've warmed up. Python will reuse memory it has already freed, so
+    # this only catches growth, which is what could stall or fail under
+    # memory pressure. It can't tell what the OOM path allocates on its own:
+    # the benchmark measures that.
+    def __init__(self, status_path="/proc/self/status"):
+        self.status_path = status_path
+        self.baseline = None
+        self.high_water = None
+
+    def reset(self):
+        self.baseline, locked = process_memory(self.status_path)
+        self.high_water = self.baseline
+        logger.info("steady state: rss=%s, locked=%s", self.baseline, locked)
+
+    def check(self):
+        rss, locked = process_memory(self.status_path)
+        growth = rss - self.baseline
+        metrics.RSS_GROWTH.set(growth)
+
+        if rss > self.high_water:
+            logger.warning("steady state: allocated %s bytes since warm-up "
+                           "(rss=%s, locked=%s)", growth, rss, locked)
+            self.high_water = rss
+
+        return growth
@@ -1,86 +1,528 @@
 # coding:utf-8
 import os
+import collections
+import errno
 import logging
 import select
+import time
 
+import linuxfd
+import six
+
+from captain_comeback import metrics
 from captain_comeback.cgroup import Cgroup
+from captain_comeback.shard import shard_of
+from captain_comeback.restart.docker_events import (EVENT_START, EVENT_DIE,
+                                                    EVENT_DESTROY,
+                                                    EVENT_RESTART,
+                                                    EVENT_RECONNECT)
+from captain_comeback.restart.messages import ContainerRestartedMessage
 
 logger = logging.getLogger()
 
 
+# Large enough to hold a few hundred events for container-ID-sized names in a
+# single read.
+INOTIFY_BUFFER_SIZE = 64 * 1024
+INOTIFY_MASK = (linuxfd.IN_CREATE | linuxfd.IN_DELETE | linuxfd.IN_MOVED_TO |
+                linuxfd.IN_MOVED_FROM | linuxfd.IN_ONLYDIR)
+
+DEFAULT_RESCAN_INTERVAL = 60
+
+# How many levels to look for cgroups under each root. Docker puts all its
+# containers right under its root, but e.g. Kubernetes nests them under
+# QoS classes and pods.
+DEFAULT_MAX_DEPTH = 1
+
+# Levels above max_depth are usually there to hold other cgroups (e.g. pods),
+# and never get tasks of their own. When one does (e.g. a container right
+# under a pod's QoS class), it's right after it's created, so we only keep
+# checking on them for that long. After that, rescans do.
+UNPOPULATED_CHECK_WINDOW = 30
+
+
+class Inotify(linuxfd.inotify):
+    # linuxfd looks up the path of every event's watch, which fails for
+    # IN_Q_OVERFLOW: that one isn't for any watch (its wd is -1). We report
+    # it with no path instead.
+    def read(self, buffersize=1024):
+        events = linuxfd.inotify_c.inotify_read(self._fd, int(buffersize))
+        return tuple((None if wd == -1 else self._name[wd], name, mask,
+                      cookie) for wd, mask, cookie, name in events)
+
+
+def is_populated(path):
+    # Does this cgroup have tasks of its own (not counting its children)?
+    try:
+        with open(os.path.join(path, "cgroup.procs"), "rb") as f:
+            return bool(f.read(1))
+    except EnvironmentError:
+        return False
+
+
 class CgroupIndex(object):
-    def __init__(self, root_cg_path, job_queue):
-        self.root_cg_path = root_cg_path
+    def __init__(self, root_cg_paths, job_queue,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL,
+                 pressure_level=None, usage_thresholds=None,
+                 cgroup_class=Cgroup, shard=None, container_events=None,
+                 max_depth=DEFAULT_MAX_DEPTH, policies=None,
+                 host_watchdog=None):
+        if isinstance(root_cg_paths, six.string_types):
+            root_cg_paths = [root_cg_paths]
+        assert max_depth > 0, "max_depth must be at least 1"
+        self.root_cg_paths = [os.path.normpath(p) for p in root_cg_paths]
+        self.max_depth = max_depth
+        # (index, count): only monitor the cgroups that hash to this shard
+        self.shard = shard
+        self.cgroup_class = cgroup_class
+        self.pressure_level = pressure_level
+        self.usage_thresholds = usage_thresholds
+        # Where we hear about containers starting and stopping, besides
+        # inotify (e.g. a DockerEventStream)
+        self.container_events = container_events
+        # Where restart policies come from (a PolicyResolver), if anywhere
+        self.policies = policies
+        # Restarts containers when the host is low on memory (a
+        # HostMemoryWatchdog), if enabled
+        self.host_watchdog = host_watchdog
         self.epl = None
+        self.inotify = None
         self.job_queue = job_queue
+        self.rescan_interval = rescan_interval
+        self._next_rescan = 0
+        self._sync_pending = collections.deque()
         self._efd_hash = {}
         self._path_hash = {}
+        # The directories we watch with inotify (the roots, and the levels
+        # between them and max_depth), and how deep they are.
+        self._dirs = {}
+        # Nested cgroups we're waiting to have tasks, and until when we keep
+        # checking on them (None if for as long as they're around, see
+        # _discover).
+        self._unpopulated = {}
+        # Those we gave up on: only rescans check them
+        self._settled = set()
 
     def register(self, cg):
+        # This might have to ask Docker (blocking for up to its inspect
+        # timeout), so we do it now rather than when the container runs out
+        # of memory. It also has to happen before the first wakeup, which is
+        # where we disable the OOM killer (or not).
+        if self.policies is not None:
+            cg.restart_policy = self.policies.resolve(cg)
         cg.open()
-        self._efd_hash[cg.event_fileno()] = cg
+        try:
+            if cg.thresholds_need_rearm():
+                cg.arm_thresholds()
+            self._register_events(cg)
+        except Exception:
+            # Only track cgroups we've fully set up, so that remove() works.
+            self._unregister_events(cg)
+            cg.close()
+            raise
         self._path_hash[cg.path] = cg
-        self.epl.register(cg.event_fileno(), select.EPOLLIN)
 
     def remove(self, cg):
-        self.epl.unregister(cg.event_fileno())
+        self._unregister_events(cg)
         self._path_hash.pop(cg.path)
-        self._efd_hash.pop(cg.event_fileno())
         cg.close()
+        if self.policies is not None:
+            self.policies.forget(cg)
+
+    def _register_events(self, cg):
+        for efd in cg.event_filenos():
+            self._efd_hash[efd] = cg
+            self.epl.register(efd, cg.EVENT_MASK)
+
+    def _unregister_events(self, cg):
+        # Some might not have been registered, if registering failed.
+        for efd in cg.event_filenos():
+            if self._efd_hash.get(efd) is cg:
+                self.epl.unregister(efd)
+                self._efd_hash.pop(efd)
+
+    def _rearm_thresholds(self, cg):
+        # The memory limit changed (or was just set), so the thresholds need
+        # moving. This replaces the threshold eventfd, so we need to
+        # re-register the cgroup's events.
+        logger.info("%s: re-arming usage thresholds", cg.name())
+        self._unregister_events(cg)
+        try:
+            cg.arm_thresholds()
+        finally:
+            self._register_events(cg)
+
+    def _refresh_policies(self):
+        if self.policies is None or not self.policies.refresh():
+            return
+        # This only asks Docker about containers we failed to inspect before
+        # (see PolicyResolver).
+        for cg in self._path_hash.values():
+            cg.restart_policy = self.policies.resolve(cg)
 
     def sync(self):
         logger.debug("syncing cgroups")
+        self._refresh_policies()
 
         # Sync all monitors with disk, and remove stale ones. It's important to
         # actually *wakeup* monitors here, so as to ensure we don't race with
         # Docker when it creates a cgroup (which could result in us not seeing
         # the memory limit and therefore not disabling the OOM killer).
         for cg in list(self._path_hash.values()):
+            self._sync_one(cg)
+
+        self._housekeep()
+
+    def begin_sync(self):
+        # Start a new incremental sync round, unless the last one hasn't
+        # completed yet: in that case, we carry on from where we left off so
+        # that every cgroup eventually gets its turn.
+        self._refresh_policies()
+
+        if self._sync_pending:
+            logger.debug("sync round overran, %s cgroups pending",
+                         len(self._sync_pending))
+        else:
+            logger.debug("starting sync round")
+            self._sync_pending.extend(self._path_hash.values())
+
+        # An overrun only holds up the per-cgroup work: this has its own
+        # schedule (e.g. rescans), or is cheap enough to do every time.
+        self._housekeep()
+
+    def _housekeep(self):
+        self._check_unpopulated()
+        self._maybe_rescan()
+        self._check_host()
+
+    def sync_pending(self):
+        return len(self._sync_pending)
+
+    def sync_slice(self, quota, budget):
+        # Sync up to quota cgroups from the current round, but give up after
+        # budget seconds so that we get back to dispatching events quickly.
+        deadline = time.time() + budget
+        done = 0
+
+        while self._sync_pending and done < quota:
+            cg = self._sync_pending.popleft()
+
+            # This cgroup might have been removed since the round started.
+            if self._path_hash.get(cg.path) is not cg:
+                continue
+
+            self._sync_one(cg)
+            done += 1
+
+            if time.time() >= deadline:
+                break
+
+        return len(self._sync_pending)
+
+    def _sync_one(self, cg):
+        try:
+            cg.wakeup(self.job_queue, raise_for_stale=True)
+            if cg.thresholds_need_rearm():
+                self._rearm_thresholds(cg)
+        except EnvironmentError:
+            logger.info("%s: deregistering", cg.name())
+            self.remove(cg)
+
+    def _check_host(self):
+        if self.host_watchdog is None:
+            return
+        try:
+            self.host_watchdog.check(self._path_hash.values(), self.job_queue)
+        except (EnvironmentError, ValueError) as e:
+            logger.error("host: failed to check memory: %s", e)
+
+    def _maybe_rescan(self):
+        # New and deleted cgroups are normally picked up via inotify, so we
+        # only need to list the root cgroup once in a while as a consistency
+        # check (or if inotify told us it dropped events).
+        if time.time() >= self._next_rescan:
+            self.rescan()
+
+    def _owns(self, entry):
+        if not self.cgroup_class.is_container(entry):
+            return False
+        if self.shard is None:
+            return True
+        shard, shards = self.shard
+        return shard_of(entry, shards) == shard
+
+    def rescan(self):
+        logger.debug("rescanning cgroups")
+        self._next_rescan = time.time() + self.rescan_interval
+
+        for root in self.root_cg_paths:
+            self._walk(root, 0)
+
+    def _walk(self, parent, depth):
+        for entry in os.listdir(parent):
+            path = os.path.join(parent, entry)
+
+            # Is this a CG or just a regular file?
+            if not os.path.isdir(path):
+                continue
+
             try:
-                cg.wakeup(self.job_queue, raise_for_stale=True)
+                self._discover(path, depth + 1)
             except EnvironmentError:
+                # It went away while we were looking (or we couldn't open
+                # it). If it's still there, the next rescan will retry.
+                logger.warning("%s: failed to register", path)
+                continue
+
+    def _discover(self, path, depth):
+        # Watch intermediate levels before we walk them, so that we don't
+        # miss what's created in between. We walk them again when we rescan,
+        # in case inotify dropped events (or to catch up on cgroups we've
+        # stopped checking, see UNPOPULATED_CHECK_WINDOW).
+        if depth < self.max_depth:
+            if path not in self._dirs:
+                self.inotify.add(path, INOTIFY_MASK)
+                self._dirs[path] = depth
+            self._walk(path, depth)
+
+        # We're already tracking this CG. It *might* have changed between our
+        # check and now, but in that case we'll catch it at the next sync.
+        if path in self._path_hash:
+            return
+
+        if not self._owns(os.path.basename(path)):
+            return
+
+        # In nested hierarchies, we only want the cgroups containers run in
+        # (that's where their runtime sets their limits), not the levels
+        # above them (e.g. Kubernetes QoS classes and pods). Only the former
+        # have tasks, but not until the runtime has started the container,
+        # so we keep checking until they do (for a while only, above
+        # max_depth).
+        if self.max_depth > 1 and not is_populated(path):
+            if path not in self._unpopulated and path not in self._settled:
+                check_until = None
+                if depth < self.max_depth:
+                    check_until = time.time() + UNPOPULATED_CHECK_WINDOW
+                self._unpopulated[path] = check_until
+            return
+
+        self._unpopulated.pop(path, None)
+        self._settled.discard(path)
+        self._register_new(path)
+
+    def _check_unpopulated(self):
+        now = time.time()
+        for path, check_until in list(self._unpopulated.items()):
+            if check_until is not None and now >= check_until:
+                del self._unpopulated[path]
+                self._settled.add(path)
+            elif not os.path.isdir(path):
+                self._unpopulated.pop(path)
+            elif is_populated(path):
+                try:
+                    self._discover(path, self._depth(path))
+                except EnvironmentError:
+                    logger.warning("%s: failed to register", path)
+
+    def _depth(self, path):
+        return self._dirs[os.path.dirname(path)] + 1
+
+    def _forget(self, path):
+        # This directory is gone (or moved), along with everything under it.
+        prefix = path + os.sep
+        for d in list(self._dirs):
+            if d == path or d.startswith(prefix):
+                # The kernel drops the watch itself. Removing it ourselves
+                # would confuse linuxfd when the IN_IGNORED event comes in.
+                del self._dirs[d]
+
+        for p in list(self._unpopulated):
+            if p == path or p.startswith(prefix):
+                del self._unpopulated[p]
+        for p in list(self._settled):
+            if p == path or p.startswith(prefix):
+                self._settled.discard(p)
+
+        for p, cg in list(self._path_hash.items()):
+            if p == path or p.startswith(prefix):
                 logger.info("%s: deregistering", cg.name())
                 self.remove(cg)
 
-        for entry in os.listdir(self.root_cg_path):
-            path = os.path.join(self.root_cg_path, entry)
+    def _register_new(self, path):
+        # This a new CG, register it.
+        cg = self.cgroup_class(path, pressure_level=self.pressure_level,
+                               usage_thresholds=self.usage_thresholds)
+        logger.info("%s: new cgroup", cg.name())
 
-            # Is this a CG or just a regular file?
-            if not os.path.isdir(path):
-                continue
+        # Register and wake up the CG immediately after, in case there
+        # already is some handling to do (typically: disabling the OOM
+        # killer). To avoid race conditions, we do this after registration
+        # to ensure we can deregister immediately if the cgroup just
+        # exited.
+        self.register(cg)
+        cg.wakeup(self.job_queue)
 
-            # We're already tracking this CG. It *might* have changed between
-            # our check and now, but in that case we'll catch it at the next
-            # sync.
-            if path in self._path_hash:
+    def _handle_inotify(self):
+        while True:
+            try:
+                events = self.inotify.read(INOTIFY_BUFFER_SIZE)
+            except EnvironmentError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+            for parent, name, mask, _ in events:
+                if mask & linuxfd.IN_Q_OVERFLOW:
+                    # The kernel dropped events: the rescan catches up.
+                    logger.warning("inotify queue overflowed, rescanning")
+                    self._next_rescan = 0
+                    continue
+
+                if mask & linuxfd.IN_IGNORED:
+                    if parent in self.root_cg_paths:
+                        logger.warning("%s: root cgroup went away", parent)
+                    continue
+
+                if not mask & linuxfd.IN_ISDIR:
+                    continue
+
+                # This might be a directory we've since forgotten about.
+                depth = self._dirs.get(parent)
+                if depth is None:
+                    continue
+
+                path = os.path.join(parent, name)
+
+                if mask & (linuxfd.IN_CREATE | linuxfd.IN_MOVED_TO):
+                    try:
+                        self._discover(path, depth + 1)
+                    except EnvironmentError:
+                        # The cgroup went away before we could open it. If it
+                        # didn't, the next rescan will pick it up.
+                        logger.warning("%s: failed to register", name)
+                elif mask & (linuxfd.IN_DELETE | linuxfd.IN_MOVED_FROM):
+                    self._forget(path)
+
+    def _container_paths(self, container_id):
+        # Where this container's cgroup could be, and how deep that is
+        entries = [entry for entry in
+                   self.cgroup_class.container_entries(container_id)
+                   if self._owns(entry)]
+        return [(os.path.join(parent, entry), depth + 1)
+                for parent, depth in self._dirs.items()
+                for entry in entries]
+
+    def _handle_container_events(self):
+        for action, container_id in self.container_events.drain():
+            if action == EVENT_RECONNECT:
+                # We might have missed events while we were disconnected.
+                self._next_rescan = 0
                 continue
 
-            # This a new CG, register it.
-            cg = Cgroup(path)
-            logger.info("%s: new cgroup", cg.name())
+            if action == EVENT_START:
+                for path, depth in self._container_paths(container_id):
+                    if path in self._path_hash or not os.path.isdir(path):
+                        continue
+                    try:
+                        self._discover(path, depth)
+                    except EnvironmentError:
+                        logger.warning("%s: failed to register",
+                                       container_id)
+
+            elif action in (EVENT_DIE, EVENT_DESTROY):
+                for path, _ in self._container_paths(container_id):
+                    cg = self._path_hash.get(path)
+                    if cg is None:
+                        continue
+                    if action == EVENT_DIE and cg.restart_in_flight:
+                        # Likely our own restart, which still needs the
+                        # cgroup. If the container is really gone, we'll
+                        # hear about it from inotify (or destroy).
+                        logger.debug("%s: container stopped while "
+                                     "restarting", cg.name())
+                        continue
+                    logger.info("%s: container stopped, deregistering",
+                                cg.name())
+                    self.remove(cg)
 
-            # Register and wake up the CG immediately after, in case there
-            # already is some handling to do (typically: disabling the OOM
-            # killer). To avoid race conditions, we do this after registration
-            # to ensure we can deregister immediately if the cgroup just
-            # exited.
-            self.register(cg)
-            cg.wakeup(self.job_queue)
+            elif action == EVENT_RESTART:
+                # Only for containers we monitor (and might be restarting)
+                if any(path in self._path_hash for path, _ in
+                       self._container_paths(container_id)):
+                    self.job_queue.put(ContainerRestartedMessage(container_id))
 
     def poll(self, timeout):
-        events = self.epl.poll(timeout)
+        # Ask for every fd we might have, so that a storm doesn't get split
+        # across several polls.
+        events = self.epl.poll(timeout, len(self._efd_hash) + 3)
+        polled_at = time.time()
+
+        # Group events by cgroup, so that each cgroup is only woken up once
+        # per poll no matter how many of its fds are ready.
+        ready = collections.OrderedDict()
+
         for efd, event in events:
-            if not event & select.EPOLLIN:
+            if efd == self.inotify.fileno():
+                self._handle_inotify()
+                continue
+
+            if (self.container_events is not None and
+                    efd == self.container_events.fileno()):
+                self._handle_container_events()
+                continue
+
+            if (self.host_watchdog is not None and
+                    efd == self.host_watchdog.fileno()):
+                self.host_watchdog.ack()
+                self._check_host()
+                continue
+
+            # The cgroup might have been removed by an inotify event we
+            # handled earlier in this batch.
+            cg = self._efd_hash.get(efd)
+            if cg is None:
+                continue
+
+            if not event & cg.EVENT_MASK:
                 raise Exception("Unexpected event: {0}".format(event))
 
-            # Handle event and ackownledge
-            cg = self._efd_hash[efd]
-            cg.wakeup(self.job_queue)
-            cg.event.read()
+            ready.setdefault(cg, []).append(efd)
+
+        for cg, efds in ready.items():
+            # Likewise, an inotify event later in the batch might have
+            # removed this cgroup.
+            if self._path_hash.get(cg.path) is not cg:
+                continue
+
+            cg.dispatch(efds, self.job_queue)
+            metrics.PHASE_SECONDS.observe(time.time() - polled_at,
+                                          "dispatch")
 
     def open(self):
         assert self.epl is None, "already open"
         self.epl = select.epoll()
+
+        # Load policies before we register anything.
+        self._refresh_policies()
+
+        # Watch the root cgroup before we list it for the first time, so that
+        # we don't miss cgroups that are created in between.
+        self.inotify = Inotify(nonBlocking=True, closeOnExec=True)
+        for root in self.root_cg_paths:
+            self.inotify.add(root, INOTIFY_MASK)
+            self._dirs[root] = 0
+        self.epl.register(self.inotify.fileno(), select.EPOLLIN)
+
+        if self.container_events is not None:
+            self.epl.register(self.container_events.fileno(), select.EPOLLIN)
+
+        if self.host_watchdog is not None:
+            self.host_watchdog.open()
+            if self.host_watchdog.fileno() is not None:
+                self.epl.register(self.host_watchdog.fileno(),
+                                  self.host_watchdog.trigger.EVENT_MASK)
+
         logger.info("ready to sync")
 
     def close(self):
@@ -89,5 +531,20 @@ class CgroupIndex(object):
         for cg in list(self._path_hash.values()):
             self.remove(cg)
 
+        if self.container_events is not None:
+            self.epl.unregister(self.container_events.fileno())
+
+        if self.host_watchdog is not None:
+            if self.host_watchdog.fileno() is not None:
+                self.epl.unregister(self.host_watchdog.fileno())
+            self.host_watchdog.close()
+
+        self.epl.unregister(self.inotify.fileno())
+        self.inotify.close()
+        self.inotify = None
+        self._dirs.clear()
+        self._unpopulated.clear()
+        self._settled.clear()
+
         self.epl.close()
         self.epl = None
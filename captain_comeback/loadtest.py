@@ -0,0 +1,384 @@
+# coding:utf-8
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import threading
+from six.moves import queue
+
+from captain_comeback.benchmark import percentile, rss_bytes, git_revision
+from captain_comeback.restart.backends import RestartFailed
+from captain_comeback.restart.backoff import (RestartBackoff,
+                                              DEFAULT_BACKOFF_BASE,
+                                              DEFAULT_BACKOFF_MAX)
+from captain_comeback.restart.engine import (RestartEngine,
+                                             DEFAULT_RESTART_WORKERS,
+                                             DEFAULT_MAX_PENDING_RESTARTS)
+from captain_comeback.restart.headroom import HeadroomBudget
+from captain_comeback.restart.messages import RestartRequestedMessage
+
+
+logger = logging.getLogger()
+
+
+PATTERN_BURST = "burst"
+PATTERN_POISSON = "poisson"
+PATTERN_REPEAT_OFFENDER = "repeat-offender"
+PATTERNS = [PATTERN_BURST, PATTERN_POISSON, PATTERN_REPEAT_OFFENDER]
+
+DEFAULT_REQUESTS = 500
+DEFAULT_CONTAINERS = 500
+DEFAULT_RATE = 500
+DEFAULT_OFFENDERS = 5
+DEFAULT_OFFENDER_SHARE = 0.8
+DEFAULT_RESTART_LATENCY = 0.5
+DEFAULT_FAILURE_RATE = 0
+
+MEMORY_LIMIT = 512 * 1024 * 1024
+FREE_MEMORY = 4 * 1024 * 1024 * 1024
+
+SAMPLE_INTERVAL = 0.005
+
+
+def arrivals(pattern, requests, containers, rate, offenders, offender_share,
+             rng):
+    # Returns a list of (offset in seconds, container index) for each OOM
+    # notification we're going to send.
+    if pattern == PATTERN_BURST:
+        return [(0, i % containers) for i in range(requests)]
+
+    out = []
+    offset = 0
+    for _ in range(requests):
+        offset += rng.expovariate(rate)
+        if (pattern == PATTERN_REPEAT_OFFENDER and
+                rng.random() < offender_share):
+            target = rng.randrange(min(offenders, containers))
+        else:
+            target = rng.randrange(containers)
+        out.append((offset, target))
+    return out
+
+
+class StubCgroup(object):
+    def __init__(self, name, memory_limit=MEMORY_LIMIT):
+        self.path = os.path.join("/stub", name)
+        self._name = name
+        self._memory_limit = memory_limit
+        self.restart_in_flight = False
+        self.quarantined_until = 0
+
+    def name(self):
+        return self._name
+
+    def memory_limit_in_bytes(self):
+        return self._memory_limit
+
+    def set_memory_limit_in_bytes(self, new_limit):
+        self._memory_limit = new_limit
+
+    def pids(self):
+        return []
+
+    def procs(self):
+        return []
+
+
+class StubRestart(object):
+    def __init__(self, backend, latency, fail):
+        self.backend = backend
+        self.latency = latency
+        self.fail = fail
+
+    def wait(self):
+        try:
+            time.sleep(self.latency)
+        finally:
+            self.backend.restart_done()
+
+        if self.fail:
+            raise RestartFailed("stub failure")
+
+
+class StubBackend(object):
+    # Stands in for the container runtime: restarts take latency seconds
+    # (give or take jitter), and fail with probability failure_rate.
+    def __init__(self, latency, jitter=0, failure_rate=0, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def start_restart(self, cg, grace_period):
+        with self._lock:
+            latency = max(0, self.latency +
+                          self.rng.uniform(-self.jitter, self.jitter))
+            fail = self.rng.random() < self.failure_rate
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if fail:
+                self.failures += 1
+        return StubRestart(self, latency, fail)
+
+    def restart_done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class InstrumentedRestartEngine(RestartEngine):
+    # Keeps track of what happened to each request (and each retry after a
+    # backoff), and how long restarts waited before a worker picked them up.
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedRestartEngine, self).__init__(*args, **kwargs)
+        self.requests_handled = 0
+        self.retries = 0
+        self.scheduled = 0
+        self.deduplicated = 0
+        # Held back (and retried) because too many restarts were pending
+        self.deferred = 0
+        # Deferred because the container was restarted recently
+        self.backed_off = 0
+        self.quarantined = 0
+        self.completed = 0
+        self.last_completed_at = None
+        self.queue_delays = []
+        self._retrying = False
+        self._held_back = False
+
+    def _handle_restart_requested(self, cg, requested_at=None,
+                                  preemption=False):
+        was_pending = cg in self._running_restarts or cg in self._deferred
+        quarantined_until = cg.quarantined_until
+        self._held_back = False
+        super(InstrumentedRestartEngine, self)._handle_restart_requested(
+            cg, requested_at, preemption)
+
+        if was_pending:
+            self.deduplicated += 1
+        elif cg in self._running_restarts:
+            self.scheduled += 1
+        elif self._held_back:
+            self.deferred += 1
+        elif cg in self._deferred:
+            self.backed_off += 1
+        elif cg.quarantined_until != quarantined_until:
+            self.quarantined += 1
+
+        # Retries go through here too, but they aren't new requests.
+        if self._retrying:
+            self.retries += 1
+        else:
+            self.requests_handled += 1
+
+    def _hold_back(self, cg, requested_at, preemption=False):
+        self._held_back = True
+        super(InstrumentedRestartEngine, self)._hold_back(cg, requested_at,
+                                                          preemption)
+
+    def _handle_restart_retry(self, cg, requested_at, preemption=False):
+        self._retrying = True
+        try:
+            super(InstrumentedRestartEngine, self)._handle_restart_retry(
+                cg, requested_at, preemption)
+        finally:
+            self._retrying = False
+
+    def _restart(self, cg):
+        self.queue_delays.append(time.time() - self._requested_at[cg])
+        super(InstrumentedRestartEngine, self)._restart(cg)
+
+    def _handle_restart_complete(self, cg):
+        super(InstrumentedRestartEngine, self)._handle_restart_complete(cg)
+        self.completed += 1
+        self.last_completed_at = time.time()
+
+    def idle(self, requests):
+        return (self.requests_handled == requests and
+                self.queue.empty() and not self._running_restarts and
+                not self._deferred)
+
+
+class Sampler(object):
+    # Samples resource usage in the background while the storm is running.
+    def __init__(self, headroom):
+        self.headroom = headroom
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self.peak_headroom = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_threads = max(self.peak_threads,
+                                    threading.active_count())
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+            self.peak_headroom = max(self.peak_headroom,
+                                     self.headroom.outstanding)
+            self._stop.wait(SAMPLE_INTERVAL)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_storm(schedule, containers, backend, workers=DEFAULT_RESTART_WORKERS,
+              max_pending=DEFAULT_MAX_PENDING_RESTARTS, timeout=None,
+              backoff=None):
+    job_queue = queue.Queue()
+    cgs = [StubCgroup("storm-{0:06d}".format(i)) for i in range(containers)]
+    headroom = HeadroomBudget(free_memory=lambda: FREE_MEMORY)
+
+    engine = InstrumentedRestartEngine(
+        job_queue, 0, backend=backend, workers=workers,
+        max_pending=max_pending, headroom=headroom, backoff=backoff)
+
+    # The engine runs forever, so we leave it behind when we're done.
+    engine_thread = threading.Thread(target=engine.run, name="engine")
+    engine_thread.daemon = True
+
+    sampler = Sampler(headroom)
+    sampler.start()
+    threads_before = threading.active_count()
+    engine_thread.start()
+
+    started_at = time.time()
+    for offset, target in schedule:
+        delay = started_at + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        job_queue.put(RestartRequestedMessage(cgs[target]))
+    sent_at = time.time()
+
+    while not engine.idle(len(schedule)):
+        if timeout is not None and time.time() - started_at > timeout:
+            logger.error("storm did not settle within %s seconds", timeout)
+            break
+        time.sleep(SAMPLE_INTERVAL)
+
+    sampler.stop()
+
+    finished_at = engine.last_completed_at or time.time()
+    duration = finished_at - started_at
+    delays = engine.queue_delays
+
+    return {
+        "requests": len(schedule),
+        "send_seconds": sent_at - started_at,
+        "duration_seconds": duration,
+        "restarts": engine.scheduled,
+        "restarts_completed": engine.completed,
+        "restarts_failed": backend.failures,
+        "deduplicated": engine.deduplicated,
+        "deferred": engine.deferred,
+        "backed_off": engine.backed_off,
+        "retries": engine.retries,
+        "quarantined": engine.quarantined,
+        "restarts_per_second": engine.completed / duration if duration else 0,
+        "queue_delay_seconds_p50": percentile(delays, 50),
+        "queue_delay_seconds_p90": percentile(delays, 90),
+        "queue_delay_seconds_p99": percentile(delays, 99),
+        "queue_delay_seconds_max": max(delays) if delays else None,
+        "peak_concurrent_restarts": backend.peak_in_flight,
+        "peak_threads": sampler.peak_threads,
+        "threads_started": sampler.peak_threads - threads_before,
+        "peak_rss_bytes": sampler.peak_rss,
+        "peak_headroom_bytes": sampler.peak_headroom,
+        "headroom_outstanding_bytes": headroom.outstanding,
+    }
+
+
+def main(pattern, requests, containers, rate, offenders, offender_share,
+         latency, jitter, failure_rate, workers, max_pending, seed, output,
+         backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX):
+    rng = random.Random(seed)
+    schedule = arrivals(pattern, requests, containers, rate, offenders,
+                        offender_share, rng)
+    backend = StubBackend(latency, jitter, failure_rate, rng)
+    backoff = RestartBackoff(backoff_base, backoff_max)
+    result = run_storm(schedule, containers, backend, workers, max_pending,
+                       backoff=backoff)
+
+    result.update({
+        "pattern": pattern,
+        "containers": containers,
+        "restart_latency": latency,
+        "failure_rate": failure_rate,
+        "workers": workers,
+        "max_pending": max_pending,
+        "backoff_base": backoff_base,
+        "backoff_max": backoff_max,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+    })
+    output.write(json.dumps(result, sort_keys=True) + "\n")
+    output.flush()
+
+
+def main_wrapper(args):
+    desc = ("Replay a storm of OOM notifications against the restart engine, "
+            "using a stub container runtime. Results are printed as JSON.")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--pattern", default=PATTERN_BURST, choices=PATTERNS,
+                        help="how OOM notifications arrive: all at once, "
+                             "at random (Poisson), or mostly from a few "
+                             "repeat offenders")
+    parser.add_argument("--requests", default=DEFAULT_REQUESTS, type=int,
+                        help="number of OOM notifications to send")
+    parser.add_argument("--containers", default=DEFAULT_CONTAINERS, type=int,
+                        help="number of distinct containers")
+    parser.add_argument("--rate", default=DEFAULT_RATE, type=float,
+                        help="average notifications per second (Poisson and "
+                             "repeat-offender patterns)")
+    parser.add_argument("--offenders", default=DEFAULT_OFFENDERS, type=int,
+                        help="number of repeat offenders")
+    parser.add_argument("--offender-share", default=DEFAULT_OFFENDER_SHARE,
+                        type=float,
+                        help="share of notifications from repeat offenders")
+    parser.add_argument("--restart-latency", default=DEFAULT_RESTART_LATENCY,
+                        type=float, help="how long stub restarts take")
+    parser.add_argument("--restart-jitter", default=0, type=float,
+                        help="random variation in stub restart latency")
+    parser.add_argument("--failure-rate", default=DEFAULT_FAILURE_RATE,
+                        type=float, help="share of stub restarts that fail")
+    parser.add_argument("--restart-workers", default=DEFAULT_RESTART_WORKERS,
+                        type=int, help="restart engine workers")
+    parser.add_argument("--max-pending-restarts",
+                        default=DEFAULT_MAX_PENDING_RESTARTS, type=int,
+                        help="restart engine backlog limit")
+    parser.add_argument("--backoff-base", default=DEFAULT_BACKOFF_BASE,
+                        type=float,
+                        help="restart engine backoff for repeat offenders "
+                             "(the storm waits for retries to complete)")
+    parser.add_argument("--backoff-max", default=DEFAULT_BACKOFF_MAX,
+                        type=float, help="restart engine maximum backoff")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="random seed for arrivals and failures")
+
+    ns = parser.parse_args(args)
+    # The engine logs every restart, which would skew results.
+    logging.basicConfig(level=logging.CRITICAL,
+                        format="%(asctime)-15s %(levelname)-8s %(message)s")
+
+    main(ns.pattern, ns.requests, ns.containers, ns.rate, ns.offenders,
+         ns.offender_share, ns.restart_latency, ns.restart_jitter,
+         ns.failure_rate, ns.restart_workers, ns.max_pending_restarts,
+         ns.seed, sys.stdout, ns.backoff_base, ns.backoff_max)
+
+
+if __name__ == "__main__":
+    main_wrapper(sys.argv[1:])
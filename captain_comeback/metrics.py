@@ -0,0 +1,243 @@
+# coding:utf-8
+import os
+import bisect
+import logging
+import threading
+
+from six.moves import socketserver, BaseHTTPServer
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ['{0}="{1}"'.format(k, v) for k, v in labels]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return ["# HELP {0} {1}".format(self.name, self.help_text),
+                "# TYPE {0} counter".format(self.name),
+                "{0} {1}".format(self.name, _format_value(self.value))]
+
+
+class Gauge(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return ["# HELP {0} {1}".format(self.name, self.help_text),
+                "# TYPE {0} gauge".format(self.name),
+                "{0} {1}".format(self.name, _format_value(self.value))]
+
+
+class Histogram(object):
+    # A histogram, optionally split by a single label (e.g. a phase).
+    def __init__(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = sorted(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per-bucket counts (plus +Inf), sum
+                series = [[0] * (len(self.buckets) + 1), 0]
+                self._series[label_value] = series
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help_text),
+                 "# TYPE {0} histogram".format(self.name)]
+
+        with self._lock:
+            series = sorted((k, list(v[0]), v[1])
+                            for k, v in self._series.items())
+
+        for label_value, counts, total in series:
+            labels = []
+            if self.label is not None:
+                labels.append((self.label, label_value))
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                le = labels + [("le", _format_value(bound))]
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name, _format_labels(le), cumulative))
+
+            lines.append("{0}_sum{1} {2}".format(
+                self.name, _format_labels(labels), _format_value(total)))
+            lines.append("{0}_count{1} {2}".format(
+                self.name, _format_labels(labels), cumulative))
+
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# The phases of an OOM recovery are:
+# - dispatch: from epoll returning to the event being handled by the cgroup
+#   (which is when restart requests are enqueued)
+# - queue: from a restart being requested to the engine handling it
+# - schedule: from a restart being scheduled to a worker picking it up
+# - freeze: with --freeze, from freezing a container to thawing it
+# - restart: from the restart being initiated to it being complete
+# - complete: from a restart completing to the engine handling it
+# - total: from a restart being requested to the engine handling completion
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "captain_comeback_phase_seconds",
+    "Time spent in each phase of OOM recovery", label="phase"))
+
+OOM_EVENTS = REGISTRY.register(Counter(
+    "captain_comeback_oom_events_total",
+    "Restart requests received"))
+OOM_EVENTS_SUPPRESSED = REGISTRY.register(Counter(
+    "captain_comeback_oom_events_suppressed_total",
+    "OOM events not sent to the restart engine because a restart was "
+    "already in flight"))
+RESTARTS_DEDUPLICATED = REGISTRY.register(Counter(
+    "captain_comeback_restarts_deduplicated_total",
+    "Restart requests ignored because a restart was already in progress"))
+RESTARTS = REGISTRY.register(Counter(
+    "captain_comeback_restarts_total",
+    "Restarts initiated"))
+RESTARTS_FAILED = REGISTRY.register(Counter(
+    "captain_comeback_restarts_failed_total",
+    "Restarts that failed"))
+HEADROOM_GRANTS = REGISTRY.register(Counter(
+    "captain_comeback_headroom_grants_total",
+    "Extra memory grants to restarting containers"))
+HEADROOM_GRANTED_BYTES = REGISTRY.register(Counter(
+    "captain_comeback_headroom_granted_bytes_total",
+    "Extra memory granted to restarting containers"))
+RESTARTS_DEFERRED = REGISTRY.register(Counter(
+    "captain_comeback_restarts_deferred_total",
+    "Restarts delayed because the container was restarted recently"))
+RESTARTS_HELD_BACK = REGISTRY.register(Counter(
+    "captain_comeback_restarts_held_back_total",
+    "Restarts delayed because too many restarts were pending"))
+RESTARTS_QUARANTINED = REGISTRY.register(Counter(
+    "captain_comeback_restarts_quarantined_total",
+    "Restart requests refused because the container is quarantined"))
+RESTARTS_RATE_LIMITED = REGISTRY.register(Counter(
+    "captain_comeback_restarts_rate_limited_total",
+    "Restarts that had to wait for the global restart rate limit"))
+HOST_PREEMPTIONS = REGISTRY.register(Counter(
+    "captain_comeback_host_preemptions_total",
+    "Containers restarted because the host was low on memory"))
+HOST_AVAILABLE_BYTES = REGISTRY.register(Gauge(
+    "captain_comeback_host_available_bytes",
+    "Memory available on the host, as of the last check (host watchdog "
+    "only)"))
+PENDING_RESTARTS = REGISTRY.register(Gauge(
+    "captain_comeback_pending_restarts",
+    "Restarts waiting for a worker"))
+RSS_GROWTH = REGISTRY.register(Gauge(
+    "captain_comeback_rss_growth_bytes",
+    "Resident memory the whole process gained since warm-up (hardened mode "
+    "only)"))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets don't have a client address.
+        return str(self.client_address or "local")
+
+    def log_message(self, fmt, *args):
+        logger.debug("metrics: %s", fmt % args)
+
+
+class TCPMetricsServer(socketserver.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_metrics_server(address, registry=REGISTRY):
+    # address is either unix:<path> or <host>:<port>
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixMetricsServer(path, MetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = TCPMetricsServer((host or "127.0.0.1", int(port)),
+                                  MetricsHandler)
+    server.registry = registry
+    return server
+
+
+def start_metrics_server(address, registry=REGISTRY):
+    server = make_metrics_server(address, registry)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    logger.info("serving metrics on %s", address)
+    return server
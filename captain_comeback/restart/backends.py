@@ -0,0 +1,217 @@
+# coding:utf-8
+import os
+import errno
+import fnmatch
+import logging
+import signal
+import subprocess
+import time
+
+from six.moves import http_client
+
+from captain_comeback.restart.docker_api import DockerError
+from captain_comeback.restart.snapshot import TaskSnapshotter
+from captain_comeback.restart.policy import policy_of
+
+
+logger = logging.getLogger()
+
+
+# Restart backends are used in two steps: start_restart initiates the restart
+# and returns an object whose wait method blocks until the restart is done
+# (and raises RestartFailed if it didn't work out). This lets us signal the
+# container before we do anything else.
+
+
+RESTART_BACKEND_API = "api"
+RESTART_BACKEND_CLI = "cli"
+RESTART_BACKEND_SIGNAL = "signal"
+RESTART_BACKEND_SIGNAL_LARGEST = "signal-largest"
+RESTART_BACKENDS = [RESTART_BACKEND_API, RESTART_BACKEND_CLI,
+                    RESTART_BACKEND_SIGNAL, RESTART_BACKEND_SIGNAL_LARGEST]
+
+
+class RestartFailed(Exception):
+    pass
+
+
+class DockerCliRestart(object):
+    def __init__(self, proc):
+        self.proc = proc
+
+    def wait(self):
+        out, err = self.proc.communicate()
+        ret = self.proc.poll()
+        if ret != 0:
+            e = "status: {0}, stdout: {1}, stderr: {2}".format(ret, out, err)
+            raise RestartFailed(e)
+
+
+class DockerCliBackend(object):
+    def start_restart(self, cg, grace_period):
+        restart_cmd = ["docker", "restart", "-t", str(grace_period),
+                       cg.name()]
+        try:
+            proc = subprocess.Popen(restart_cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except EnvironmentError as e:
+            raise RestartFailed("failed to run docker: {0}".format(e))
+        return DockerCliRestart(proc)
+
+
+class DockerApiRestart(object):
+    def __init__(self, req):
+        self.req = req
+
+    def wait(self):
+        try:
+            self.req.wait()
+        except DockerError as e:
+            raise RestartFailed(str(e))
+        except (http_client.HTTPException, EnvironmentError) as e:
+            raise RestartFailed("Docker API request failed: {0}".format(e))
+
+
+class DockerApiBackend(object):
+    def __init__(self, client, fallback=None):
+        self.client = client
+        self.fallback = fallback
+
+    def start_restart(self, cg, grace_period):
+        try:
+            req = self.client.start_restart(cg.name(), grace_period)
+        except (http_client.HTTPException, EnvironmentError) as e:
+            # We couldn't even send the request, so it's safe to try
+            # something else.
+            if self.fallback is None:
+                raise RestartFailed("Docker API request failed: {0}"
+                                    .format(e))
+            logger.warning("%s: Docker API unavailable (%s), falling back",
+                           cg.name(), e)
+            return self.fallback.start_restart(cg, grace_period)
+        return DockerApiRestart(req)
+
+
+SIGNAL_TARGET_ALL = "all"
+SIGNAL_TARGET_LARGEST = "largest"
+SIGNAL_TARGETS = [SIGNAL_TARGET_ALL, SIGNAL_TARGET_LARGEST]
+
+# How often to check whether signalled processes have exited.
+SIGNAL_POLL_INTERVAL = 0.1
+
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except EnvironmentError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+
+class SignalRestart(object):
+    def __init__(self, cg, targets, grace_period, all_tasks):
+        self.cg = cg
+        self.targets = targets
+        self.grace_period = grace_period
+        self.all_tasks = all_tasks
+
+    def _survivors(self):
+        try:
+            pids = self.cg.procs()
+        except EnvironmentError:
+            # The cgroup is gone, and its tasks with it.
+            return []
+
+        if self.all_tasks:
+            # This includes processes that were forked after we sent SIGTERM.
+            return pids
+
+        # Only look at our targets, and make sure they are still in the
+        # cgroup so we don't kill a task that reused their PID.
+        return [pid for pid in pids if pid in self.targets]
+
+    def wait(self):
+        deadline = time.time() + self.grace_period
+
+        while True:
+            survivors = self._survivors()
+            if not survivors:
+                return
+            if time.time() >= deadline:
+                break
+            time.sleep(SIGNAL_POLL_INTERVAL)
+
+        logger.info("%s: sending SIGKILL to %s processes", self.cg.name(),
+                    len(survivors))
+        try:
+            for pid in survivors:
+                _kill(pid, signal.SIGKILL)
+        except EnvironmentError as e:
+            raise RestartFailed("failed to kill tasks: {0}".format(e))
+
+
+class SignalBackend(object):
+    # Signals the cgroup's tasks directly, rather than going through the
+    # container runtime. This is useful if the container has a supervisor
+    # that restarts processes itself (or if the runtime is unresponsive).
+    # Processes get SIGTERM, and SIGKILL if they haven't exited after the
+    # grace period. We can either signal all of them, or only the largest.
+    # We signal processes rather than tasks: signals go to a whole process
+    # anyway, and a process can have a lot of threads.
+    def __init__(self, target=SIGNAL_TARGET_ALL, proc_root="/proc"):
+        assert target in SIGNAL_TARGETS, target
+        self.target = target
+        self.snapshotter = TaskSnapshotter(top_n=1, proc_root=proc_root)
+
+    def _targets(self, cg):
+        pids = cg.procs()
+        if self.target == SIGNAL_TARGET_ALL:
+            return pids
+
+        top, _, _ = self.snapshotter.snapshot(pids)
+        return [task.pid for task in top]
+
+    def start_restart(self, cg, grace_period):
+        try:
+            targets = self._targets(cg)
+        except EnvironmentError as e:
+            raise RestartFailed("failed to list tasks: {0}".format(e))
+
+        logger.info("%s: sending SIGTERM to %s processes", cg.name(),
+                    len(targets))
+        try:
+            targets = [pid for pid in targets if _kill(pid, signal.SIGTERM)]
+        except EnvironmentError as e:
+            raise RestartFailed("failed to signal tasks: {0}".format(e))
+
+        return SignalRestart(cg, set(targets), grace_period,
+                             self.target == SIGNAL_TARGET_ALL)
+
+
+class SelectBackend(object):
+    # Picks a backend for each container: the one its restart policy names
+    # (out of named), or the first pattern its name matches, and the default
+    # otherwise.
+    def __init__(self, default, overrides=None, named=None):
+        self.default = default
+        self.overrides = overrides or []
+        self.named = named or {}
+
+    def backend_for(self, cg):
+        name = policy_of(cg).backend
+        if name is not None:
+            backend = self.named.get(name)
+            if backend is not None:
+                return backend
+            logger.warning("%s: unknown restart backend in policy: %s",
+                           cg.name(), name)
+
+        for pattern, backend in self.overrides:
+            if fnmatch.fnmatchcase(cg.name(), pattern):
+                return backend
+        return self.default
+
+    def start_restart(self, cg, grace_period):
+        return self.backend_for(cg).start_restart(cg, grace_period)
@@ -0,0 +1,132 @@
+# coding:utf-8
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+
+# A container that runs out of memory as soon as it boots would otherwise get
+# restarted again as soon as its last restart completes, forever. We keep
+# track of how often we restart each container, and make it wait longer and
+# longer between restarts (and eventually, if configured, give up on it for a
+# while: we call that quarantine). Separately, a token bucket caps how many
+# restarts we start per second across all containers, so that many
+# containers failing at once don't all hit Docker at the same time.
+
+DEFAULT_BACKOFF_BASE = 1
+DEFAULT_BACKOFF_MAX = 300
+# A container that stays up this long after a restart starts over.
+DEFAULT_BACKOFF_RESET = 600
+
+# Disabled by default
+DEFAULT_QUARANTINE_AFTER = 0
+DEFAULT_QUARANTINE_PERIOD = 1800
+DEFAULT_RESTART_RATE = 0
+DEFAULT_RESTART_BURST = 1
+
+
+class RestartBackoff(object):
+    # Only used by the engine's thread (or loop), so no locking here.
+    def __init__(self, base=DEFAULT_BACKOFF_BASE,
+                 max_delay=DEFAULT_BACKOFF_MAX,
+                 reset_after=DEFAULT_BACKOFF_RESET,
+                 quarantine_after=DEFAULT_QUARANTINE_AFTER,
+                 quarantine_period=DEFAULT_QUARANTINE_PERIOD,
+                 clock=time.time):
+        self.base = base
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.quarantine_after = quarantine_after
+        self.quarantine_period = quarantine_period
+        self.clock = clock
+        # Container name -> (consecutive restarts, when the last one ended).
+        # We use names since a container gets a new cgroup when it restarts.
+        self._history = {}
+        # Container name -> when its quarantine ends
+        self._quarantine = {}
+
+    def _streak(self, name, now):
+        streak, last = self._history.get(name, (0, None))
+        if last is None or now - last >= self.reset_after:
+            return 0, None
+        return streak, last
+
+    def streak(self, name):
+        return self._streak(name, self.clock())[0]
+
+    def delay(self, name):
+        # How long this container has left to wait before its next restart.
+        now = self.clock()
+        streak, last = self._streak(name, now)
+        if streak == 0 or self.base <= 0:
+            return 0
+        wait = min(self.base * 2 ** (streak - 1), self.max_delay)
+        return max(0, last + wait - now)
+
+    def quarantined_until(self, name):
+        # When this container's quarantine ends, or None if it isn't in
+        # quarantine. We put it there if we've restarted it so often in a row
+        # that we should stop trying, and leave it to the kernel's OOM killer
+        # for a while. It starts over when it comes out.
+        now = self.clock()
+        until = self._quarantine.get(name)
+        if until is not None and now >= until:
+            del self._quarantine[name]
+            until = None
+
+        if (until is None and self.quarantine_after > 0 and
+                self._streak(name, now)[0] >= self.quarantine_after):
+            until = now + self.quarantine_period
+            self._quarantine[name] = until
+            self._history.pop(name, None)
+            logger.warning("%s: restarted %s times in a row, quarantined "
+                           "for %ss", name, self.quarantine_after,
+                           self.quarantine_period)
+        return until
+
+    def record(self, name):
+        now = self.clock()
+        streak, _ = self._streak(name, now)
+        self._history[name] = (streak + 1, now)
+        self._prune(now)
+
+    def _prune(self, now):
+        # Don't hold on to containers that have been doing fine (or are
+        # gone).
+        for name, (_, last) in list(self._history.items()):
+            if now - last >= self.reset_after:
+                del self._history[name]
+        for name, until in list(self._quarantine.items()):
+            if now >= until:
+                del self._quarantine[name]
+
+
+class TokenBucket(object):
+    # Shared by restart workers. take hands out tokens in order, possibly
+    # ahead of time: it returns how long the caller should wait before
+    # using its token.
+    def __init__(self, rate=DEFAULT_RESTART_RATE, burst=DEFAULT_RESTART_BURST,
+                 clock=time.time):
+        assert burst >= 1, "burst must be at least 1"
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return 0
+
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
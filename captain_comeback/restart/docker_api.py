@@ -0,0 +1,190 @@
+# coding:utf-8
+import io
+import json
+import errno
+import logging
+import socket
+
+from six.moves import http_client, queue
+from six.moves.urllib.parse import quote
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+DEFAULT_POOL_SIZE = 4
+
+# Docker only responds to a restart once the container is back up, which
+# includes the grace period. Give it a little more time than that.
+RESTART_TIMEOUT_MARGIN = 30
+
+# What we get when we use a connection Docker closed while it was idle.
+STALE_CONNECTION_ERRNOS = [errno.ECONNRESET, errno.EPIPE]
+
+# Requests we can send again if the connection fails before we get a
+# response. Docker might already be acting on others (e.g. a restart).
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super(DockerError, self).__init__(
+            "Docker API error {0}: {1}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        http_client.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.socket_timeout)
+            sock.connect(self.socket_path)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def set_timeout(self, timeout):
+        self.socket_timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+
+class DockerRequest(object):
+    # A request that has been sent, but whose response we haven't read yet.
+    def __init__(self, client, method, path, timeout):
+        self.client = client
+        self.method = method
+        self.path = path
+        self.timeout = timeout
+        self.conn = None
+        self.reused = False
+
+    def send(self):
+        self.conn, self.reused = self.client._acquire(self.timeout)
+        try:
+            self.conn.request(self.method, self.path)
+        except (http_client.HTTPException, EnvironmentError):
+            self.conn.close()
+            if not self.reused:
+                raise
+            # Docker closed this connection while it was idle in the pool,
+            # so this request never made it.
+            logger.debug("docker: retrying on a new connection")
+            self.send()
+
+    def wait(self):
+        try:
+            response = self.conn.getresponse()
+            body = response.read()
+        except Exception as e:
+            self.conn.close()
+            if not (self.reused and self.method in IDEMPOTENT_METHODS and
+                    _is_stale_connection_error(e)):
+                raise
+            # Same as above, but we only found out when reading the response.
+            logger.debug("docker: retrying on a new connection")
+            self.send()
+            return self.wait()
+
+        if response.will_close:
+            self.conn.close()
+        else:
+            self.client._release(self.conn)
+
+        check_status(response.status, body)
+        return body
+
+
+def _is_stale_connection_error(e):
+    if isinstance(e, http_client.BadStatusLine):
+        return True
+    if isinstance(e, EnvironmentError):
+        return e.errno in STALE_CONNECTION_ERRNOS
+    return False
+
+
+def error_message(body):
+    try:
+        return json.loads(body.decode("utf-8"))["message"]
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+        return body
+
+
+def check_status(status, body):
+    if status >= 400:
+        raise DockerError(status, error_message(body))
+
+
+class _BufferedSocket(object):
+    # Enough of a socket for HTTPResponse to read from.
+    def __init__(self, data):
+        self._file = io.BytesIO(data)
+
+    def makefile(self, *_args, **_kwargs):
+        return self._file
+
+
+def parse_response(data):
+    # Parses a whole response (e.g. one read until Docker closed the
+    # connection) like our connections do. Returns (status, body), and
+    # raises HTTPException if it's malformed or incomplete.
+    response = http_client.HTTPResponse(_BufferedSocket(data))
+    response.begin()
+    return response.status, response.read()
+
+
+class DockerClient(object):
+    def __init__(self, socket_path=DEFAULT_DOCKER_SOCKET,
+                 pool_size=DEFAULT_POOL_SIZE):
+        self.socket_path = socket_path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _acquire(self, timeout):
+        try:
+            conn, reused = self._pool.get_nowait(), True
+        except queue.Empty:
+            conn, reused = UnixHTTPConnection(self.socket_path), False
+        conn.set_timeout(timeout)
+        return conn, reused
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def send(self, method, path, timeout=None):
+        req = DockerRequest(self, method, path, timeout)
+        req.send()
+        return req
+
+    def request(self, method, path, timeout=None):
+        return self.send(method, path, timeout).wait()
+
+    def start_restart(self, container, grace_period):
+        path = "/containers/{0}/restart?t={1}".format(
+            quote(container), int(grace_period))
+        return self.send("POST", path, grace_period + RESTART_TIMEOUT_MARGIN)
+
+    def restart(self, container, grace_period):
+        self.start_restart(container, grace_period).wait()
+
+    def inspect(self, container, timeout=None):
+        path = "/containers/{0}/json".format(quote(container))
+        return json.loads(self.request("GET", path, timeout).decode("utf-8"))
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
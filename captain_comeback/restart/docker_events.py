@@ -0,0 +1,165 @@
+# coding:utf-8
+import json
+import errno
+import logging
+import threading
+import collections
+import time
+
+import linuxfd
+from six.moves import http_client
+from six.moves.urllib.parse import quote
+
+from captain_comeback.restart.docker_api import (UnixHTTPConnection,
+                                                 DockerError, error_message,
+                                                 DEFAULT_DOCKER_SOCKET)
+
+
+logger = logging.getLogger()
+
+
+# Docker tells us about container lifecycle events as they happen, which lets
+# us register cgroups as soon as a container starts, and drop them as soon as
+# it dies, rather than waiting for inotify or a sync to notice. This doesn't
+# replace either: if the stream breaks, we may have missed events, so we ask
+# the index to rescan when we reconnect.
+
+EVENT_START = "start"
+EVENT_DIE = "die"
+EVENT_DESTROY = "destroy"
+EVENT_RESTART = "restart"
+WATCHED_EVENTS = [EVENT_START, EVENT_DIE, EVENT_DESTROY, EVENT_RESTART]
+
+# Not a Docker event: we send this when we (re)connect to the stream.
+EVENT_RECONNECT = "reconnect"
+
+DEFAULT_RECONNECT_INTERVAL = 1
+
+
+def events_path():
+    filters = {"type": ["container"], "event": WATCHED_EVENTS}
+    return "/events?filters={0}".format(
+        quote(json.dumps(filters, sort_keys=True)))
+
+
+def iter_lines(fp, chunked):
+    # httplib won't give us lines out of a chunked response on Python 2, so
+    # we undo the chunking ourselves. Docker sends one event per line.
+    buf = b""
+    while True:
+        if chunked:
+            size_line = fp.readline()
+            if not size_line:
+                break
+            size = int(size_line.split(b";")[0].strip(), 16)
+            if size == 0:
+                break
+            data = fp.read(size)
+            fp.readline()
+        else:
+            data = fp.readline()
+            if not data:
+                break
+
+        buf += data
+        while b"\n" in buf:
+            line, buf = buf.split(b"\n", 1)
+            if line.strip():
+                yield line
+
+    if buf.strip():
+        yield buf
+
+
+def parse_event(line):
+    # Returns (action, container ID), or None for events we don't care
+    # about. Docker before 1.10 only sends status and id.
+    try:
+        event = json.loads(line.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        logger.warning("docker events: invalid event: %r", line)
+        return None
+
+    if event.get("Type", "container") != "container":
+        return None
+
+    action = event.get("Action") or event.get("status")
+    container_id = (event.get("Actor") or {}).get("ID") or event.get("id")
+
+    if action not in WATCHED_EVENTS or not container_id:
+        return None
+
+    return action, container_id
+
+
+class DockerEventStream(object):
+    # Reads events on a thread of its own, and hands them over to the index
+    # through an eventfd it polls alongside cgroups (the index isn't thread
+    # safe).
+    def __init__(self, socket_path=DEFAULT_DOCKER_SOCKET,
+                 reconnect_interval=DEFAULT_RECONNECT_INTERVAL):
+        self.socket_path = socket_path
+        self.reconnect_interval = reconnect_interval
+        self._events = collections.deque()
+        self._efd = linuxfd.eventfd(initval=0, nonBlocking=True,
+                                    closeOnExec=True)
+
+    def fileno(self):
+        return self._efd.fileno()
+
+    def push(self, action, container_id):
+        self._events.append((action, container_id))
+        self._efd.write(1)
+
+    def drain(self):
+        # Acknowledge first, so that anything pushed while we drain is picked
+        # up at the next poll.
+        try:
+            self._efd.read()
+        except EnvironmentError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    def close(self):
+        self._efd.close()
+
+    def stream(self):
+        conn = UnixHTTPConnection(self.socket_path)
+        try:
+            conn.request("GET", events_path())
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerError(response.status,
+                                  error_message(response.read()))
+
+            logger.info("docker events: connected")
+            self.push(EVENT_RECONNECT, None)
+
+            for line in iter_lines(response.fp, response.chunked):
+                event = parse_event(line)
+                if event is not None:
+                    logger.debug("docker events: %s %s", *event)
+                    self.push(*event)
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                self.stream()
+            except (http_client.HTTPException, EnvironmentError,
+                    DockerError, ValueError) as e:
+                logger.warning("docker events: stream failed: %s", e)
+            else:
+                logger.warning("docker events: stream ended")
+            time.sleep(self.reconnect_interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run, name="docker-events")
+        t.daemon = True
+        t.start()
@@ -1,92 +1,510 @@
 # coding:utf-8
+import heapq
 import logging
 import threading
-import subprocess
+import itertools
+import time
 
-import psutil
+from six.moves import queue as six_queue
 
+from captain_comeback import metrics
+from captain_comeback.cgroup import memory_is_unconstrained
+from captain_comeback.restart.backends import DockerCliBackend, RestartFailed
+from captain_comeback.restart.backoff import RestartBackoff, TokenBucket
+from captain_comeback.restart.headroom import HeadroomBudget
+from captain_comeback.restart.limits import restore_memory_limit
+from captain_comeback.restart.snapshot import TaskSnapshotter
+from captain_comeback.restart.policy import policy_of
 from captain_comeback.restart.messages import (RestartRequestedMessage,
-                                               RestartCompleteMessage)
+                                               RestartCompleteMessage,
+                                               RestartRetryMessage,
+                                               ContainerRestartedMessage,
+                                               MemoryPressureMessage,
+                                               MemoryThresholdMessage)
 
 
 logger = logging.getLogger()
 
 
+PRESSURE_ACTION_LOG = "log"
+PRESSURE_ACTION_RESTART = "restart"
+PRESSURE_ACTIONS = [PRESSURE_ACTION_LOG, PRESSURE_ACTION_RESTART]
+
+DEFAULT_RESTART_WORKERS = 8
+DEFAULT_MAX_PENDING_RESTARTS = 256
+
+# How long to wait before trying again when too many restarts are pending
+HOLD_BACK_INTERVAL = 1
+
+
+def default_priority(cg):
+    return policy_of(cg).priority
+
+
+def grace_period_for(cg, default):
+    grace_period = policy_of(cg).grace_period
+    return default if grace_period is None else grace_period
+
+
+class Deferral(object):
+    def __init__(self, message):
+        self.message = message
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
 class RestartEngine(object):
-    def __init__(self, queue, grace_period):
+    def __init__(self, queue, grace_period,
+                 pressure_action=PRESSURE_ACTION_LOG, backend=None,
+                 workers=DEFAULT_RESTART_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING_RESTARTS,
+                 priority=default_priority, headroom=None, limits=None,
+                 snapshotter=None, backoff=None, rate_limit=None,
+                 freezer=None):
+        assert pressure_action in PRESSURE_ACTIONS, pressure_action
+        assert workers > 0, "need at least one worker"
         self.grace_period = grace_period
+        self.backend = backend or DockerCliBackend()
+        self.headroom = headroom or HeadroomBudget()
+        self.limits = limits
+        self.snapshotter = snapshotter or TaskSnapshotter()
+        self.backoff = backoff or RestartBackoff()
+        self.rate_limit = rate_limit or TokenBucket()
+        self.freezer = freezer
+        self.pressure_action = pressure_action
         self.queue = queue
-        self.counter = 0
+        self.workers = workers
+        self.max_pending = max_pending
+        self.priority = priority
         self._running_restarts = set()
+        self._requested_at = {}
+        # Restarts the host memory watchdog asked for (see watchdog.py)
+        self._preemptions = set()
+        # Restarts waiting out their backoff, and their timers
+        self._deferred = {}
+        # (due, sequence, Deferral) heap of the messages those timers will
+        # send, which run handles alongside the queue (see _next_message).
+        self._timers = []
+        self._pending_restarts = six_queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker_threads = []
 
-    def _handle_restart_requested(self, cg):
-        if cg in self._running_restarts:
+    def _handle_restart_requested(self, cg, requested_at=None,
+                                  preemption=False):
+        if cg in self._running_restarts or cg in self._deferred:
             logger.info("%s: already being restarted", cg.name())
+            metrics.RESTARTS_DEDUPLICATED.inc()
+            return
+
+        if policy_of(cg).never_restart:
+            # The cgroup shouldn't have asked, but e.g. memory pressure
+            # doesn't go through it, or its policy just changed.
+            logger.info("%s: policy says never restart, skipping", cg.name())
+            cg.restart_in_flight = False
+            return
+
+        quarantined_until = self.backoff.quarantined_until(cg.name())
+        if quarantined_until is not None:
+            # The cgroup will hand itself over to the OOM killer at its next
+            # wakeup, and stop asking until the quarantine is over.
+            logger.info("%s: quarantined, leaving it to the OOM killer",
+                        cg.name())
+            metrics.RESTARTS_QUARANTINED.inc()
+            cg.quarantined_until = quarantined_until
+            cg.restart_in_flight = False
             return
-        logger.debug("%s: scheduling restart", cg.name())
+
+        requested_at = requested_at or time.time()
+        delay = self.backoff.delay(cg.name())
+        if delay > 0:
+            logger.info("%s: restarted recently, backing off for %.1fs",
+                        cg.name(), delay)
+            metrics.RESTARTS_DEFERRED.inc()
+            self._defer_restart(cg, delay, requested_at, preemption)
+            return
+
+        # If we can't keep up, don't let the backlog grow without bounds. We
+        # can't count on the cgroup asking again (cgroup v2 only tells us
+        # about an OOM once), so we hold on to it and try again in a bit.
+        pending = self._pending_restarts.qsize()
+        if pending >= self.max_pending:
+            logger.warning("%s: too many pending restarts (%s), deferring",
+                           cg.name(), pending)
+            self._hold_back(cg, requested_at, preemption)
+            return
+
+        logger.debug("%s: scheduling restart (%s pending)", cg.name(),
+                     pending)
+        now = time.time()
         self._running_restarts.add(cg)
+        self._requested_at[cg] = requested_at
+        if preemption:
+            self._preemptions.add(cg)
+        cg.restart_in_flight = True
 
-        job_name = "restart-job-{0}".format(self.counter)
-        self.counter += 1
-        threading.Thread(target=restart, name=job_name,
-                         args=(self.queue, self.grace_period, cg,)).start()
+        # Higher priority first, then containers that haven't been restarted
+        # recently (so that crash looping ones don't hold up everyone else),
+        # then whoever has been waiting for longest (i.e. has been stuck under
+        # OOM the longest).
+        key = (-self.priority(cg), self.backoff.streak(cg.name()),
+               requested_at, next(self._sequence))
+        self._pending_restarts.put_nowait((key, now, cg))
+        metrics.PENDING_RESTARTS.set(self._pending_restarts.qsize())
+
+    def _defer_restart(self, cg, delay, requested_at, preemption=False):
+        # We keep the restart in flight meanwhile, so the cgroup doesn't
+        # keep asking.
+        cg.restart_in_flight = True
+        self._deferred[cg] = self._defer(
+            delay, RestartRetryMessage(cg, requested_at, preemption))
+
+    def _hold_back(self, cg, requested_at, preemption=False):
+        metrics.RESTARTS_HELD_BACK.inc()
+        self._defer_restart(cg, HOLD_BACK_INTERVAL, requested_at, preemption)
+
+    def _defer(self, delay, message):
+        # Returns something we can cancel. We don't start a thread for each
+        # of these: crash looping containers can make for a lot of them.
+        deferral = Deferral(message)
+        heapq.heappush(self._timers, (time.time() + delay,
+                                      next(self._sequence), deferral))
+        return deferral
+
+    def _next_message(self):
+        # Blocks until there's a message on the queue, or a deferred one is
+        # due (whichever comes first).
+        while True:
+            if not self._timers:
+                return self.queue.get()
+
+            due, _, deferral = self._timers[0]
+            timeout = due - time.time()
+            if timeout <= 0:
+                heapq.heappop(self._timers)
+                if not deferral.cancelled:
+                    return deferral.message
+                continue
+
+            try:
+                return self.queue.get(timeout=timeout)
+            except six_queue.Empty:
+                continue
+
+    def _handle_restart_retry(self, cg, requested_at, preemption=False):
+        if self._deferred.pop(cg, None) is None:
+            # Cancelled (see _handle_container_restarted)
+            return
+        self._handle_restart_requested(cg, requested_at, preemption)
+
+    def _rate_limit_delay(self, cg):
+        delay = self.rate_limit.take()
+        if delay > 0:
+            logger.info("%s: rate limited, waiting %.2fs", cg.name(), delay)
+            metrics.RESTARTS_RATE_LIMITED.inc()
+        return delay
+
+    def pending_restarts(self):
+        return self._pending_restarts.qsize()
+
+    def start_workers(self):
+        # Workers are normally started by run, but can be started early so
+        # that they exist before we lock our memory.
+        if self._worker_threads:
+            return
+
+        for i in range(self.workers):
+            name = "restart-worker-{0}".format(i)
+            t = threading.Thread(target=self._work, name=name)
+            t.daemon = True
+            t.start()
+            self._worker_threads.append(t)
+
+    def _work(self):
+        while True:
+            _, scheduled_at, cg = self._pending_restarts.get()
+            metrics.PENDING_RESTARTS.set(self._pending_restarts.qsize())
+            if not self._still_needs_restart(cg):
+                continue
+            delay = self._rate_limit_delay(cg)
+            if delay > 0:
+                time.sleep(delay)
+            metrics.PHASE_SECONDS.observe(time.time() - scheduled_at,
+                                          "schedule")
+            try:
+                self._restart(cg)
+            except Exception:
+                # Don't let this cgroup get stuck as "being restarted", or
+                # this worker die.
+                logger.exception("%s: restart failed", cg.name())
+                self.queue.put(RestartCompleteMessage(cg))
+
+    def _still_needs_restart(self, cg):
+        # The container might have been restarted (e.g. by Docker) while
+        # this was waiting for a worker, in which case we're done with it.
+        if cg in self._running_restarts:
+            return True
+        logger.info("%s: already restarted, skipping", cg.name())
+        return False
+
+    def _restart(self, cg):
+        grace_period = grace_period_for(cg, self.grace_period)
+        restart(self.queue, grace_period, cg, self.backend,
+                self.headroom, self.limits, self.snapshotter, self.freezer,
+                cg in self._preemptions)
 
     def _handle_restart_complete(self, cg):
+        if cg not in self._running_restarts:
+            # Docker told us about it first (see below).
+            logger.debug("%s: restart already complete", cg.name())
+            return
+
         logger.debug("%s: registering restart complete", cg.name())
         self._running_restarts.remove(cg)
+        self._preemptions.discard(cg)
+        self.backoff.record(cg.name())
+        cg.restart_in_flight = False
+
+        requested_at = self._requested_at.pop(cg, None)
+        if requested_at is not None:
+            metrics.PHASE_SECONDS.observe(time.time() - requested_at,
+                                          "total")
+
+    def _handle_container_restarted(self, name):
+        # If we were going to restart this container (or were waiting for it
+        # to come back), there's no need to anymore. Whatever the worker
+        # still has to do (e.g. restoring the memory limit), it does in its
+        # own time.
+        for cg in list(self._deferred):
+            if cg.name() == name:
+                logger.info("%s: container restarted, no longer deferred",
+                            name)
+                self._deferred.pop(cg).cancel()
+                cg.restart_in_flight = False
+
+        for cg in self._running_restarts:
+            if cg.name() == name:
+                break
+        else:
+            return
+
+        logger.info("%s: container restarted", name)
+        self._handle_restart_complete(cg)
+
+    def _handle_memory_pressure(self, cg, level):
+        if cg in self._running_restarts:
+            return
+
+        logger.warning("%s: memory pressure: %s", cg.name(), level)
+
+        if self.pressure_action == PRESSURE_ACTION_RESTART:
+            # Restart the container before it actually runs out of memory, so
+            # it can drain before being frozen at its limit.
+            self._handle_restart_requested(cg)
+
+    def _handle_memory_threshold(self, cg, threshold, usage, memory_limit):
+        if threshold is None:
+            logger.info("%s: memory usage back below thresholds (%s / %s)",
+                        cg.name(), usage, memory_limit)
+            return
+
+        logger.warning("%s: memory usage over %d%% of limit (%s / %s)",
+                       cg.name(), threshold * 100, usage, memory_limit)
+
+    def _handle_message(self, message):
+        if isinstance(message, RestartRequestedMessage):
+            # Preemptions are counted by the watchdog.
+            if not message.preemption:
+                metrics.OOM_EVENTS.inc()
+            metrics.PHASE_SECONDS.observe(time.time() - message.created_at,
+                                          "queue")
+            self._handle_restart_requested(message.cg, message.created_at,
+                                           message.preemption)
+        elif isinstance(message, RestartCompleteMessage):
+            metrics.PHASE_SECONDS.observe(time.time() - message.created_at,
+                                          "complete")
+            self._handle_restart_complete(message.cg)
+        elif isinstance(message, RestartRetryMessage):
+            self._handle_restart_retry(message.cg, message.requested_at,
+                                       message.preemption)
+        elif isinstance(message, ContainerRestartedMessage):
+            self._handle_container_restarted(message.name)
+        elif isinstance(message, MemoryPressureMessage):
+            self._handle_memory_pressure(message.cg, message.level)
+        elif isinstance(message, MemoryThresholdMessage):
+            self._handle_memory_threshold(message.cg, message.threshold,
+                                          message.usage, message.memory_limit)
+        else:
+            raise Exception("Unexpected message: {0}".format(message))
 
     def run(self):
         # TODO: Exit everything when this fails
+        self.start_workers()
         logger.info("ready to restart containers")
         while True:
-            message = self.queue.get()
-            if isinstance(message, RestartRequestedMessage):
-                self._handle_restart_requested(message.cg)
-            elif isinstance(message, RestartCompleteMessage):
-                self._handle_restart_complete(message.cg)
-            else:
-                raise Exception("Unexpected message: {0}".format(message))
+            self._handle_message(self._next_message())
+
+
+def reserve_headroom(cg, headroom, usage=None):
+    # Try and allocate some extra memory to give this cgroup a chance to
+    # shut down gracefully. This comes out of a budget shared with other
+    # restarts, which we give back once the restart is done.
+    memory_limit = cg.memory_limit_in_bytes()
+    extra = 0
+
+    if memory_is_unconstrained(memory_limit):
+        # The limit might have been lifted since we were notified (and we
+        # certainly shouldn't be setting a negative limit).
+        logger.info("%s: no memory limit to increase", cg.name())
+    else:
+        extra = headroom.reserve(memory_limit,
+                                 policy_of(cg).headroom_fraction, usage)
+
+    if extra > 0:
+        metrics.HEADROOM_GRANTS.inc()
+        metrics.HEADROOM_GRANTED_BYTES.inc(extra)
+
+    logger.debug("%s: memory_limit: %s, extra: %s", cg.name(), memory_limit,
+                 extra)
+    return memory_limit, extra
+
 
+def raise_memory_limit(cg, memory_limit, new_limit, limits):
+    # Make a note of the original limit before we touch it, so we can restore
+    # it even if we crash before the restart completes. If we can't, the
+    # container still needs the memory more than we need the note.
+    if limits is not None:
+        try:
+            limits.record(cg, memory_limit, new_limit)
+        except EnvironmentError as e:
+            logger.error("%s: failed to record memory limit: %s", cg.name(),
+                         e)
 
-def restart(queue, grace_period, cg):
-    # Snapshot task usage
+    logger.info("%s: increasing memory limit to %s", cg.name(), new_limit)
+    cg.set_memory_limit_in_bytes(new_limit)
+
+
+def snapshot_tasks(cg, snapshotter):
+    try:
+        snapshotter.log(cg)
+    except EnvironmentError as e:
+        logger.warning("%s: failed to snapshot tasks: %s", cg.name(), e)
+
+
+def prepare_frozen(cg, headroom, limits, snapshotter, freezer):
+    # Freeze the cgroup, so that its tasks stop allocating while we snapshot
+    # them and size their headroom, and thaw it once they have it. Returns
+    # the memory limit and the extra memory granted, like reserve_headroom,
+    # or None if we couldn't freeze it.
+    if not freezer.freeze(cg):
+        # Thaw whatever we did freeze, and let the caller restart it as
+        # usual: granting headroom before the restart starts would let the
+        # container use it all up before it's even signalled.
+        freezer.thaw(cg)
+        return None
+
+    try:
+        snapshot_tasks(cg, snapshotter)
+
+        usage = None
+        try:
+            usage = cg.usage_in_bytes()
+        except EnvironmentError as e:
+            logger.warning("%s: failed to read usage: %s", cg.name(), e)
+
+        memory_limit, extra = reserve_headroom(cg, headroom, usage)
+        if extra > 0:
+            try:
+                raise_memory_limit(cg, memory_limit, memory_limit + extra,
+                                   limits)
+            except Exception:
+                headroom.release(extra)
+                raise
+    finally:
+        freezer.thaw(cg)
+
+    return memory_limit, extra
+
+
+def lower_memory_limit(cg, memory_limit, new_limit, limits):
+    # Now that the container has restarted, it no longer needs the extra
+    # memory; give it back so that limits don't creep up with every OOM.
+    try:
+        restore_memory_limit(cg, memory_limit, new_limit)
+    except EnvironmentError as e:
+        # We'll try again next time we start.
+        logger.error("%s: failed to restore memory limit: %s", cg.name(), e)
+    else:
+        if limits is not None:
+            try:
+                limits.forget(cg)
+            except EnvironmentError as e:
+                # We'll find the limit already restored next time we start.
+                logger.error("%s: failed to forget memory limit: %s",
+                             cg.name(), e)
+
+
+def restart(queue, grace_period, cg, backend=None, headroom=None,
+            limits=None, snapshotter=None, freezer=None, preemption=False):
+    backend = backend or DockerCliBackend()
+    headroom = headroom or HeadroomBudget()
+    snapshotter = snapshotter or TaskSnapshotter()
     logger.info("%s: restarting", cg.name())
+    metrics.RESTARTS.inc()
+    started_at = time.time()
 
-    for pid in cg.pids():
-        proc = psutil.Process(pid)
-        logger.info("%s: task %s: %s: %s", cg.name(), pid,
-                    proc.cmdline(), proc.memory_info())
-
-    # We initiate the restart first. This increases our chances of getting a
-    # successful restart by signalling a potential memory hog before we
-    # allocate extra memory.
-    restart_cmd = ["docker", "restart", "-t", str(grace_period), cg.name()]
-    proc = subprocess.Popen(restart_cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-
-    # Try and allocate 10% of extra memory to give this cgroup a chance to
-    # shut down gracefully.
-    # NOTE: we look at free memory (rather than available) so that we don't
-    # have to e.g. free some buffers to grant this extra memory.
-    memory_limit = cg.memory_limit_in_bytes()
-    free_memory = psutil.virtual_memory().free
-    extra = int(memory_limit / 10)  # Make parameterizable
-
-    logger.debug("%s: memory_limit: %s, free_memory: %s, extra: %s",
-                 cg.name(), memory_limit, free_memory, extra)
-    if free_memory > extra:
-        new_limit = memory_limit + extra
-        logger.info("%s: increasing memory limit to %s", cg.name(),
-                    new_limit)
-        cg.set_memory_limit_in_bytes(new_limit)
-
-    out, err = proc.communicate()
-    ret = proc.poll()
-    if ret != 0:
-        logger.error("%s: failed to restart", cg.name())
-        logger.error("%s: status: %s", cg.name(), ret)
-        logger.error("%s: stdout: %s", cg.name(), out)
-        logger.error("%s: stderr: %s", cg.name(), err)
+    # A container we restart to free up host memory isn't at its limit, so
+    # it has nothing to gain from headroom (and the host has none to spare).
+    prepared = None
+    if freezer is not None and not preemption:
+        prepared = prepare_frozen(cg, headroom, limits, snapshotter, freezer)
+        metrics.PHASE_SECONDS.observe(time.time() - started_at, "freeze")
+    memory_limit, extra = prepared or (None, 0)
+
+    # Unless we froze it, we initiate the restart first. This increases our
+    # chances of getting a successful restart by signalling a potential
+    # memory hog before we allocate extra memory.
+    try:
+        pending_restart = backend.start_restart(cg, grace_period)
+    except Exception as e:
+        # If we froze the container, it already has its extra memory.
+        if extra > 0:
+            headroom.release(extra)
+            lower_memory_limit(cg, memory_limit, memory_limit + extra, limits)
+        if not isinstance(e, RestartFailed):
+            raise
+        logger.error("%s: failed to restart: %s", cg.name(), e)
+        metrics.RESTARTS_FAILED.inc()
+        queue.put(RestartCompleteMessage(cg))
+        return
+
+    if prepared is None and not preemption:
+        memory_limit, extra = reserve_headroom(cg, headroom)
+
+    try:
+        if prepared is None:
+            if extra > 0:
+                raise_memory_limit(cg, memory_limit, memory_limit + extra,
+                                   limits)
+
+            # Snapshot task usage. We only do this once the restart is under
+            # way and the container has its extra memory, so as not to delay
+            # either.
+            snapshot_tasks(cg, snapshotter)
+
+        try:
+            pending_restart.wait()
+        except RestartFailed as e:
+            logger.error("%s: failed to restart: %s", cg.name(), e)
+            metrics.RESTARTS_FAILED.inc()
+
+        metrics.PHASE_SECONDS.observe(time.time() - started_at, "restart")
+    finally:
+        headroom.release(extra)
+
+    if extra > 0:
+        lower_memory_limit(cg, memory_limit, memory_limit + extra, limits)
 
     # TODO: Make this a finally?
     logger.info("%s: restart complete", cg.name())
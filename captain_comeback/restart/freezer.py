@@ -0,0 +1,120 @@
+# coding:utf-8
+import os
+import logging
+import time
+
+
+logger = logging.getLogger()
+
+
+# Between a container running out of memory and its tasks getting the stop
+# signal, they keep allocating, and can use up the headroom we give them
+# before they even start shutting down. Optionally, we freeze them first:
+# this lets us snapshot them consistently and give them headroom based on
+# what they're actually using, and we thaw them right before the restart
+# starts.
+
+# cgroup v1 puts the freezer in its own hierarchy, which mirrors the memory
+# one for Docker containers.
+DEFAULT_MEMORY_MOUNT = "/sys/fs/cgroup/memory"
+DEFAULT_FREEZER_MOUNT = "/sys/fs/cgroup/freezer"
+
+FREEZER_STATE_FROZEN = "FROZEN"
+FREEZER_STATE_THAWED = "THAWED"
+
+# Tasks the kernel has stopped at their memory limit (with the OOM killer
+# disabled) only freeze once they get memory, so we don't even try while a
+# v1 cgroup is under OOM, and otherwise don't wait for long.
+DEFAULT_FREEZE_TIMEOUT = 0.5
+FREEZE_POLL_INTERVAL = 0.01
+
+
+class CgroupFreezer(object):
+    def __init__(self, memory_mount=DEFAULT_MEMORY_MOUNT,
+                 freezer_mount=DEFAULT_FREEZER_MOUNT,
+                 timeout=DEFAULT_FREEZE_TIMEOUT):
+        self.memory_mount = memory_mount
+        self.freezer_mount = freezer_mount
+        self.timeout = timeout
+
+    def _state_file_path(self, cg):
+        rel = os.path.relpath(cg.path, self.memory_mount)
+        return os.path.join(self.freezer_mount, rel, "freezer.state")
+
+    def _write_state(self, cg, frozen):
+        state = FREEZER_STATE_FROZEN if frozen else FREEZER_STATE_THAWED
+        with open(self._state_file_path(cg), "w") as f:
+            f.write("{0}\n".format(state))
+
+    def _is_frozen(self, cg):
+        # The state is FREEZING until every task is frozen.
+        with open(self._state_file_path(cg)) as f:
+            return f.read().strip() == FREEZER_STATE_FROZEN
+
+    def _can_freeze(self, cg):
+        try:
+            under_oom = cg.is_under_oom()
+        except (EnvironmentError, ValueError):
+            return True
+        if under_oom:
+            logger.info("%s: under OOM, not freezing", cg.name())
+            return False
+        return True
+
+    def freeze(self, cg):
+        # Returns whether all of the cgroup's tasks are frozen. Either way,
+        # the cgroup has to be thawed afterwards.
+        if not self._can_freeze(cg):
+            return False
+
+        try:
+            self._write_state(cg, True)
+        except EnvironmentError as e:
+            logger.warning("%s: failed to freeze: %s", cg.name(), e)
+            return False
+
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                if self._is_frozen(cg):
+                    logger.info("%s: frozen", cg.name())
+                    return True
+            except EnvironmentError as e:
+                logger.warning("%s: failed to freeze: %s", cg.name(), e)
+                return False
+
+            if time.time() >= deadline:
+                logger.warning("%s: not frozen after %ss, carrying on",
+                               cg.name(), self.timeout)
+                return False
+            time.sleep(FREEZE_POLL_INTERVAL)
+
+    def thaw(self, cg):
+        try:
+            self._write_state(cg, False)
+        except EnvironmentError as e:
+            logger.error("%s: failed to thaw: %s", cg.name(), e)
+        else:
+            logger.debug("%s: thawed", cg.name())
+
+
+class CgroupV2Freezer(CgroupFreezer):
+    # The freezer is part of every cgroup in v2.
+    def __init__(self, timeout=DEFAULT_FREEZE_TIMEOUT):
+        super(CgroupV2Freezer, self).__init__(timeout=timeout)
+
+    def _can_freeze(self, cg):
+        # There's no waiting at the limit in v2: the kernel OOM kills.
+        return True
+
+    def _write_state(self, cg, frozen):
+        with open(os.path.join(cg.path, "cgroup.freeze"), "w") as f:
+            f.write("1\n" if frozen else "0\n")
+
+    def _is_frozen(self, cg):
+        with open(os.path.join(cg.path, "cgroup.events")) as f:
+            for line in f:
+                key, _, value = line.strip().partition(" ")
+                if key == "frozen":
+                    return value == "1"
+        return False
@@ -0,0 +1,77 @@
+# coding:utf-8
+import logging
+import threading
+
+import psutil
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_HEADROOM_FRACTION = 0.1
+DEFAULT_HEADROOM_MIN_FREE = 0
+
+HEADROOM_POLICY_PARTIAL = "partial"
+HEADROOM_POLICY_ALL_OR_NOTHING = "all-or-nothing"
+HEADROOM_POLICIES = [HEADROOM_POLICY_PARTIAL, HEADROOM_POLICY_ALL_OR_NOTHING]
+
+
+def free_memory():
+    # NOTE: we look at free memory (rather than available) so that we don't
+    # have to e.g. free some buffers to grant this extra memory.
+    return psutil.virtual_memory().free
+
+
+class HeadroomBudget(object):
+    # Keeps track of the extra memory we've granted to containers that are
+    # being restarted, so that concurrent restarts don't all grant
+    # themselves the same free memory.
+    #
+    # This is conservative: memory a container has already consumed out of
+    # its grant is counted twice (it's no longer free, and it's still
+    # outstanding) until the grant is released.
+    def __init__(self, fraction=DEFAULT_HEADROOM_FRACTION,
+                 policy=HEADROOM_POLICY_PARTIAL,
+                 min_free=DEFAULT_HEADROOM_MIN_FREE,
+                 free_memory=free_memory):
+        assert policy in HEADROOM_POLICIES, policy
+        self.fraction = fraction
+        self.policy = policy
+        self.min_free = min_free
+        self.free_memory = free_memory
+        self.outstanding = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, memory_limit, fraction=None, usage=None):
+        # fraction overrides ours (e.g. from a container's restart policy).
+        # If we know how much memory the cgroup is using (and it won't grow,
+        # e.g. because it's frozen), we only grant what it needs on top of
+        # that, which is less if it isn't at its limit.
+        if fraction is None:
+            fraction = self.fraction
+        if usage is None:
+            want = int(memory_limit * fraction)
+        else:
+            want = int(usage * (1 + fraction)) - memory_limit
+        if want <= 0:
+            return 0
+
+        with self._lock:
+            available = self.free_memory() - self.outstanding - self.min_free
+
+            if available > want:
+                grant = want
+            elif self.policy == HEADROOM_POLICY_PARTIAL:
+                grant = max(0, available)
+            else:
+                grant = 0
+
+            self.outstanding += grant
+
+        logger.debug("headroom: wanted %s, available %s, granted %s",
+                     want, available, grant)
+        return grant
+
+    def release(self, grant):
+        with self._lock:
+            self.outstanding -= grant
@@ -0,0 +1,96 @@
+# coding:utf-8
+import os
+import errno
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_LIMIT_JOURNAL = "/var/run/captain-comeback/limits.json"
+
+
+def restore_memory_limit(cg, original, raised_to):
+    # Don't clobber the limit if someone else changed it in the meantime.
+    current = cg.memory_limit_in_bytes()
+    if current != raised_to:
+        logger.info("%s: memory limit changed to %s, not restoring",
+                    cg.name(), current)
+        return
+
+    logger.info("%s: restoring memory limit to %s", cg.name(), original)
+    cg.set_memory_limit_in_bytes(original)
+
+
+class LimitJournal(object):
+    # Records the original memory limit of the cgroups we've given extra
+    # memory to while restarting them, so that if we crash mid-restart, we
+    # can restore their limit when we come back.
+    def __init__(self, path=DEFAULT_LIMIT_JOURNAL):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        except ValueError:
+            logger.warning("%s: corrupt limit journal, ignoring", self.path)
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file and rename it, so that we never leave a
+        # half-written journal behind.
+        tmp = "{0}.tmp".format(self.path)
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def record(self, cg, original, raised_to):
+        with self._lock:
+            self._entries[cg.path] = {"original": original,
+                                      "raised_to": raised_to}
+            self._save()
+
+    def forget(self, cg):
+        with self._lock:
+            if self._entries.pop(cg.path, None) is not None:
+                self._save()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._entries)
+
+    def restore_all(self, cgroup_class):
+        for path, entry in self.pending().items():
+            cg = cgroup_class(path)
+
+            if not os.path.isdir(path):
+                # The cgroup is gone, so is the limit we raised.
+                logger.info("%s: cgroup is gone, forgetting limit",
+                            cg.name())
+                self.forget(cg)
+                continue
+
+            try:
+                restore_memory_limit(cg, entry["original"],
+                                     entry["raised_to"])
+            except EnvironmentError as e:
+                logger.error("%s: failed to restore memory limit: %s",
+                             cg.name(), e)
+                continue
+
+            self.forget(cg)
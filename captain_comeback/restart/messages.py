@@ -1,9 +1,48 @@
 # coding:utf-8
+import time
+
+
 class RestartRequestedMessage(object):
-    def __init__(self, cg):
+    # preemption is set when the host memory watchdog asks for the restart,
+    # rather than the container running out of memory.
+    def __init__(self, cg, preemption=False):
         self.cg = cg
+        self.preemption = preemption
+        self.created_at = time.time()
 
 
 class RestartCompleteMessage(object):
     def __init__(self, cg):
         self.cg = cg
+        self.created_at = time.time()
+
+
+class RestartRetryMessage(object):
+    # A restart the engine deferred (see RestartBackoff) is due.
+    def __init__(self, cg, requested_at, preemption=False):
+        self.cg = cg
+        self.requested_at = requested_at
+        self.preemption = preemption
+        self.created_at = time.time()
+
+
+class ContainerRestartedMessage(object):
+    # Docker told us this container restarted (which we might not have asked
+    # for). We only have its name, since its cgroup is likely new.
+    def __init__(self, name):
+        self.name = name
+        self.created_at = time.time()
+
+
+class MemoryPressureMessage(object):
+    def __init__(self, cg, level):
+        self.cg = cg
+        self.level = level
+
+
+class MemoryThresholdMessage(object):
+    def __init__(self, cg, threshold, usage, memory_limit):
+        self.cg = cg
+        self.threshold = threshold
+        self.usage = usage
+        self.memory_limit = memory_limit
@@ -0,0 +1,279 @@
+# coding:utf-8
+import os
+import json
+import fnmatch
+import logging
+import time
+
+from six.moves import http_client
+
+from captain_comeback.restart.docker_api import DockerError
+
+
+logger = logging.getLogger()
+
+
+# A restart policy overrides how we handle a given container: how long to
+# give it to stop, how much headroom to grant it, which backend to restart it
+# with, how urgently, or whether to leave it to the kernel's OOM killer
+# altogether. Policies come from a file (matched by container name) and from
+# container labels, which win.
+#
+# Looking up labels means asking Docker, which we don't want to do when a
+# container is out of memory, so we resolve policies when we start
+# monitoring a container, and keep them on its cgroup. Labels can't change
+# on a running container, so we only need to look them up again if the
+# container is re-created (which gives us a new cgroup), or if the file
+# changes (in which case we re-resolve using the labels we already have).
+#
+# This does mean that the index thread blocks on Docker (for up to the
+# inspect timeout) when it picks up a new container. If Docker isn't
+# responding, we go with the file's policy for now, and ask again at the next
+# sync. To keep that from stalling the index at every sync while Docker is
+# down, we stop asking for a little while after a failure.
+
+LABEL_PREFIX = "captain-comeback."
+
+FIELD_GRACE_PERIOD = "grace_period"
+FIELD_HEADROOM_FRACTION = "headroom_fraction"
+FIELD_BACKEND = "backend"
+FIELD_PRIORITY = "priority"
+FIELD_NEVER_RESTART = "never_restart"
+
+TRUE_VALUES = ["1", "true", "yes", "on"]
+FALSE_VALUES = ["0", "false", "no", "off", ""]
+
+# Docker only needs to look up the container.
+DEFAULT_INSPECT_TIMEOUT = 2
+INSPECT_RETRY_INTERVAL = 10
+
+
+def _non_negative(parse):
+    def parser(value):
+        value = parse(value)
+        if value < 0:
+            raise ValueError("must be >= 0: {0}".format(value))
+        return value
+    return parser
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError("not a boolean: {0}".format(value))
+
+
+FIELD_PARSERS = {
+    FIELD_GRACE_PERIOD: _non_negative(int),
+    FIELD_HEADROOM_FRACTION: _non_negative(float),
+    FIELD_BACKEND: str,
+    FIELD_PRIORITY: int,
+    FIELD_NEVER_RESTART: _parse_bool,
+}
+
+
+def parse_fields(raw, source):
+    # Invalid fields are ignored (with a warning), so that one typo doesn't
+    # take the rest of the policy down with it.
+    fields = {}
+    for key, value in raw.items():
+        parser = FIELD_PARSERS.get(key)
+        if parser is None:
+            logger.warning("%s: unknown policy field %s", source, key)
+            continue
+        try:
+            fields[key] = parser(value)
+        except (TypeError, ValueError) as e:
+            logger.warning("%s: invalid %s: %s", source, key, e)
+    return fields
+
+
+def label_fields(labels, source):
+    # captain-comeback.grace-period=3 -> grace_period=3
+    raw = {}
+    for label, value in (labels or {}).items():
+        if label.startswith(LABEL_PREFIX):
+            key = label[len(LABEL_PREFIX):].replace("-", "_")
+            raw[key] = value
+    return parse_fields(raw, source)
+
+
+class RestartPolicy(object):
+    # None means "use the default" (i.e. what was set on the command line).
+    def __init__(self, grace_period=None, headroom_fraction=None,
+                 backend=None, priority=0, never_restart=False):
+        self.grace_period = grace_period
+        self.headroom_fraction = headroom_fraction
+        self.backend = backend
+        self.priority = priority
+        self.never_restart = never_restart
+
+    def __eq__(self, other):
+        return (isinstance(other, RestartPolicy) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        fields = sorted(self.__dict__.items())
+        return "RestartPolicy({0})".format(
+            ", ".join("{0}={1!r}".format(k, v) for k, v in fields))
+
+
+DEFAULT_POLICY = RestartPolicy()
+
+
+def policy_of(cg):
+    return getattr(cg, "restart_policy", None) or DEFAULT_POLICY
+
+
+def load_policy_file(path):
+    # The file is a JSON list of policies, each with a "match" pattern (a
+    # shell-style wildcard). The first policy that matches a container wins.
+    #
+    #   [{"match": "web-*", "grace_period": 3, "headroom_fraction": 0.5},
+    #    {"match": "batch-*", "never_restart": true}]
+    with open(path) as f:
+        raw_rules = json.load(f)
+
+    if not isinstance(raw_rules, list):
+        raise ValueError("{0}: expected a list of policies".format(path))
+
+    rules = []
+    for i, raw in enumerate(raw_rules):
+        source = "{0}[{1}]".format(path, i)
+        if not isinstance(raw, dict) or "match" not in raw:
+            logger.warning("%s: policy has no match pattern, ignoring",
+                           source)
+            continue
+        raw = dict(raw)
+        pattern = raw.pop("match")
+        rules.append((pattern, parse_fields(raw, source)))
+    return rules
+
+
+class PolicyResolver(object):
+    def __init__(self, path=None, client=None,
+                 inspect_timeout=DEFAULT_INSPECT_TIMEOUT,
+                 retry_interval=INSPECT_RETRY_INTERVAL, clock=time.time):
+        self.path = path
+        self.client = client
+        self.inspect_timeout = inspect_timeout
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self._rules = []
+        self._mtime = None
+        # Container ID -> (Docker name, labels)
+        self._metadata = {}
+        # Containers we couldn't inspect, and when we can ask Docker again
+        self._unresolved = set()
+        self._retry_at = 0
+
+    def refresh(self):
+        # Returns whether policies should be resolved again: the file
+        # changed, or we have containers to inspect again.
+        reloaded = self._reload()
+        return reloaded or bool(self._unresolved)
+
+    def _reload(self):
+        # Reload the file if it changed. Returns whether it did.
+        if self.path is None:
+            return False
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except EnvironmentError as e:
+            mtime = None
+            if self._mtime is not None:
+                logger.warning("%s: policy file went away: %s", self.path, e)
+
+        if mtime == self._mtime:
+            return False
+
+        self._mtime = mtime
+        if mtime is None:
+            self._rules = []
+            return True
+
+        try:
+            self._rules = load_policy_file(self.path)
+        except (EnvironmentError, ValueError) as e:
+            # Keep what we had.
+            logger.error("%s: failed to load policies: %s", self.path, e)
+            return False
+
+        logger.info("%s: loaded %s policies", self.path, len(self._rules))
+        return True
+
+    def _inspect(self, container_id):
+        # Returns (name, labels), or None if we should ask again later.
+        try:
+            info = self.client.inspect(container_id, self.inspect_timeout)
+        except DockerError as e:
+            if e.status == http_client.NOT_FOUND:
+                # E.g. this cgroup isn't a Docker container.
+                logger.info("%s: no container metadata: %s", container_id, e)
+                return None, {}
+            logger.warning("%s: failed to inspect container: %s",
+                           container_id, e)
+            return None
+        except (http_client.HTTPException, EnvironmentError,
+                ValueError) as e:
+            logger.warning("%s: failed to inspect container: %s",
+                           container_id, e)
+            return None
+
+        name = (info.get("Name") or "").lstrip("/") or None
+        labels = (info.get("Config") or {}).get("Labels") or {}
+        return name, labels
+
+    def _metadata_for(self, container_id):
+        if self.client is None:
+            return None, {}
+
+        metadata = self._metadata.get(container_id)
+        if metadata is not None:
+            return metadata
+
+        if self.clock() < self._retry_at:
+            self._unresolved.add(container_id)
+            return None, {}
+
+        # We cache containers Docker doesn't know too, so that we don't keep
+        # asking about them.
+        metadata = self._inspect(container_id)
+        if metadata is None:
+            self._unresolved.add(container_id)
+            self._retry_at = self.clock() + self.retry_interval
+            return None, {}
+
+        self._unresolved.discard(container_id)
+        self._metadata[container_id] = metadata
+        return metadata
+
+    def resolve(self, cg):
+        container_id = cg.name()
+        name, labels = self._metadata_for(container_id)
+        names = [n for n in [name, container_id] if n]
+
+        fields = {}
+        for pattern, rule_fields in self._rules:
+            if any(fnmatch.fnmatchcase(n, pattern) for n in names):
+                fields.update(rule_fields)
+                break
+        fields.update(label_fields(labels, container_id))
+
+        policy = RestartPolicy(**fields)
+        if policy != DEFAULT_POLICY:
+            logger.info("%s: restart policy: %s", container_id, policy)
+        return policy
+
+    def forget(self, cg):
+        self._metadata.pop(cg.name(), None)
+        self._unresolved.discard(cg.name())
@@ -0,0 +1,103 @@
+# coding:utf-8
+import os
+import errno
+import heapq
+import logging
+import resource
+import time
+
+
+logger = logging.getLogger()
+
+
+DEFAULT_SNAPSHOT_TOP_N = 10
+DEFAULT_SNAPSHOT_BUDGET = 0.1
+
+STATM_BUFFER_SIZE = 256
+CMDLINE_BUFFER_SIZE = 4096
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def _read_into(path, buf):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "readv"):
+            return os.readv(fd, [buf])
+        # Python 2 can't read into an existing buffer.
+        data = os.read(fd, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    finally:
+        os.close(fd)
+
+
+class TaskSnapshot(object):
+    def __init__(self, pid, rss, cmdline=None):
+        self.pid = pid
+        self.rss = rss
+        self.cmdline = cmdline
+
+
+class TaskSnapshotter(object):
+    # Logs what's using memory in a cgroup we're about to restart. We read
+    # /proc directly (rather than go through psutil) since all we need is RSS
+    # and the command line, and only look up the command line for the
+    # biggest tasks. If there are too many tasks to go through within budget
+    # seconds, we only report on the ones we got to.
+    def __init__(self, top_n=DEFAULT_SNAPSHOT_TOP_N,
+                 budget=DEFAULT_SNAPSHOT_BUDGET, proc_root="/proc"):
+        self.top_n = top_n
+        self.budget = budget
+        self.proc_root = proc_root
+
+    def snapshot(self, pids):
+        deadline = time.time() + self.budget
+        statm = bytearray(STATM_BUFFER_SIZE)
+        tasks = []
+        truncated = False
+
+        for pid in pids:
+            if time.time() >= deadline:
+                truncated = True
+                break
+
+            path = os.path.join(self.proc_root, str(pid), "statm")
+            try:
+                n = _read_into(path, statm)
+            except EnvironmentError as e:
+                if e.errno in (errno.ENOENT, errno.ESRCH):
+                    continue  # Task exited
+                raise
+
+            # statm is: size resident shared text lib data dt, in pages
+            rss = int(statm[:n].split(None, 2)[1]) * PAGE_SIZE
+            tasks.append(TaskSnapshot(pid, rss))
+
+        top = heapq.nlargest(self.top_n, tasks, key=lambda t: t.rss)
+
+        cmdline = bytearray(CMDLINE_BUFFER_SIZE)
+        for task in top:
+            path = os.path.join(self.proc_root, str(task.pid), "cmdline")
+            try:
+                n = _read_into(path, cmdline)
+            except EnvironmentError:
+                continue
+            args = bytes(cmdline[:n]).rstrip(b"\0").split(b"\0")
+            task.cmdline = [a.decode("utf-8", "replace") for a in args]
+
+        return top, len(tasks), truncated
+
+    def log(self, cg):
+        top, seen, truncated = self.snapshot(cg.procs())
+
+        for task in top:
+            logger.info("%s: task %s: %s: rss=%s", cg.name(), task.pid,
+                        task.cmdline, task.rss)
+
+        if seen > len(top):
+            logger.info("%s: %s more tasks", cg.name(), seen - len(top))
+
+        if truncated:
+            logger.warning("%s: snapshot ran out of time after %s tasks",
+                           cg.name(), seen)
@@ -0,0 +1,182 @@
+# coding:utf-8
+import logging
+import threading
+import zlib
+
+import six
+
+from captain_comeback.restart.messages import (RestartRequestedMessage,
+                                               ContainerRestartedMessage,
+                                               MemoryPressureMessage,
+                                               MemoryThresholdMessage)
+from captain_comeback.restart.policy import policy_of
+
+
+logger = logging.getLogger()
+
+
+# When sharding, each shard process runs its own index over a subset of the
+# cgroups, and sends the messages it would normally give the restart engine
+# to a coordinator in the main process instead. Cgroups can't cross process
+# boundaries (they hold open fds), so we send their path, and the coordinator
+# stands in a proxy for them.
+#
+# The only state that needs to flow back to shards is restart_in_flight: when
+# the engine is done with a restart (or decides not to do it), the shard has
+# to know so that it can request a restart again (and whether the engine
+# quarantined the cgroup, in which case it shouldn't). Restart policies are
+# resolved by shards, so we send them along with anything that might lead to
+# a restart.
+
+MESSAGE_RESTART = "restart"
+MESSAGE_PRESSURE = "pressure"
+MESSAGE_THRESHOLD = "threshold"
+MESSAGE_RESTARTED = "restarted"
+
+
+def shard_of(name, shards):
+    # This needs to be stable across processes, which hash() isn't.
+    if isinstance(name, six.text_type):
+        name = name.encode("utf-8")
+    return (zlib.crc32(name) & 0xffffffff) % shards
+
+
+def encode_message(message):
+    if isinstance(message, RestartRequestedMessage):
+        return (MESSAGE_RESTART, message.cg.path, message.created_at,
+                policy_of(message.cg))
+    if isinstance(message, MemoryPressureMessage):
+        return (MESSAGE_PRESSURE, message.cg.path, message.level,
+                policy_of(message.cg))
+    if isinstance(message, MemoryThresholdMessage):
+        return (MESSAGE_THRESHOLD, message.cg.path, message.threshold,
+                message.usage, message.memory_limit)
+    if isinstance(message, ContainerRestartedMessage):
+        return (MESSAGE_RESTARTED, message.name, message.created_at)
+    raise Exception("Unexpected message: {0}".format(message))
+
+
+class ShardForwarder(object):
+    # Runs in shard processes: forwards the index's messages to the
+    # coordinator, and clears restart_in_flight when the coordinator tells us
+    # a restart is over.
+    def __init__(self, shard, index, job_queue, upstream, downstream):
+        self.shard = shard
+        self.index = index
+        self.job_queue = job_queue
+        self.upstream = upstream
+        self.downstream = downstream
+
+    def _forward(self):
+        while True:
+            message = self.job_queue.get()
+            self.upstream.put((self.shard, encode_message(message)))
+
+    def _release(self):
+        while True:
+            path, quarantined_until = self.downstream.get()
+            cg = self.index._path_hash.get(path)
+            if cg is None:
+                continue
+            logger.debug("%s: restart released", cg.name())
+            cg.quarantined_until = quarantined_until
+            cg.restart_in_flight = False
+
+    def start(self):
+        for target, name in [(self._forward, "forward"),
+                             (self._release, "release")]:
+            t = threading.Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+
+
+class ShardCgroup(object):
+    # Stands in for a cgroup that lives in a shard process. The restart
+    # engine only needs the cgroup's name, its memory limit and its tasks,
+    # which we can read from here without opening it.
+    def __init__(self, coordinator, shard, cg):
+        self._coordinator = coordinator
+        self._shard = shard
+        self._cg = cg
+        self._restart_in_flight = False
+        # Whatever the shard resolved last (see decode_message)
+        self.restart_policy = None
+        # Sent back to the shard on release
+        self.quarantined_until = 0
+
+    def __getattr__(self, attr):
+        return getattr(self._cg, attr)
+
+    @property
+    def restart_in_flight(self):
+        return self._restart_in_flight
+
+    @restart_in_flight.setter
+    def restart_in_flight(self, value):
+        self._restart_in_flight = value
+        if value:
+            self._coordinator.track(self)
+        else:
+            self._coordinator.release(self._shard, self)
+
+
+class Coordinator(object):
+    # Runs in the main process: turns what shards send us back into messages
+    # for the restart engine.
+    def __init__(self, job_queue, cgroup_class, upstream, downstreams):
+        self.job_queue = job_queue
+        self.cgroup_class = cgroup_class
+        self.upstream = upstream
+        self.downstreams = downstreams
+        self._lock = threading.Lock()
+        # Proxies for cgroups that have a restart in flight, so that the
+        # engine sees the same cgroup if we hear about it again. We drop them
+        # once released, so this doesn't grow as containers come and go.
+        self._proxies = {}
+
+    def _proxy(self, shard, path):
+        with self._lock:
+            cg = self._proxies.get(path)
+        if cg is None:
+            cg = ShardCgroup(self, shard, self.cgroup_class(path))
+        return cg
+
+    def track(self, cg):
+        with self._lock:
+            self._proxies[cg.path] = cg
+
+    def release(self, shard, cg):
+        with self._lock:
+            if self._proxies.get(cg.path) is cg:
+                del self._proxies[cg.path]
+        self.downstreams[shard].put((cg.path, cg.quarantined_until))
+
+    def decode_message(self, shard, payload):
+        kind, path = payload[0], payload[1]
+
+        if kind == MESSAGE_RESTARTED:
+            # This one has a container name, not a cgroup path.
+            message = ContainerRestartedMessage(payload[1])
+            message.created_at = payload[2]
+            return message
+
+        cg = self._proxy(shard, path)
+
+        if kind == MESSAGE_RESTART:
+            # The shard already marked it in flight, and so do we.
+            cg.restart_in_flight = True
+            cg.restart_policy = payload[3]
+            message = RestartRequestedMessage(cg)
+            message.created_at = payload[2]
+            return message
+        if kind == MESSAGE_PRESSURE:
+            cg.restart_policy = payload[3]
+            return MemoryPressureMessage(cg, payload[2])
+        if kind == MESSAGE_THRESHOLD:
+            return MemoryThresholdMessage(cg, *payload[2:])
+        raise Exception("Unexpected message: {0}".format(kind))
+
+    def run(self):
+        while True:
+            shard, payload = self.upstream.get()
+            self.job_queue.put(self.decode_message(shard, payload))
@@ -0,0 +1,173 @@
+# coding:utf-8
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+from captain_comeback.index import CgroupIndex
+from captain_comeback.benchmark import FakeCgroupTree
+from captain_comeback.restart.backends import RestartFailed
+from captain_comeback.restart.headroom import HeadroomBudget
+from captain_comeback.restart.snapshot import TaskSnapshotter
+from captain_comeback.restart.messages import (RestartRequestedMessage,
+                                               RestartCompleteMessage)
+from captain_comeback.test.docker_api_test_unit import FakeDockerServer
+from captain_comeback.test.mocks import MockCgroup, MockBackend
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from captain_comeback import aio
+
+
+FAKE_DOCKER = """#!/bin/sh
+echo "$@" >> "{log}"
+{action}
+"""
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio runtime needs 3.5+")
+class AioTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.loop = aio.new_event_loop()
+        self.path = os.environ["PATH"]
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        self.loop.close()
+        shutil.rmtree(self.tmp)
+
+    def run_for(self, coro, seconds):
+        # Our loops run forever, so we stop them after a while
+        try:
+            self.loop.run_until_complete(asyncio.wait_for(coro, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    def fake_docker(self, action):
+        bin_dir = os.path.join(self.tmp, "bin")
+        os.mkdir(bin_dir)
+        log = os.path.join(self.tmp, "docker.log")
+        script = os.path.join(bin_dir, "docker")
+        with open(script, "w") as f:
+            f.write(FAKE_DOCKER.format(log=log, action=action))
+        os.chmod(script, 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + self.path
+        return log
+
+    def start_docker_server(self):
+        server = FakeDockerServer(os.path.join(self.tmp, "docker.sock"))
+        t = threading.Thread(target=server.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def restart(self, backend, cg):
+        pending = self.loop.run_until_complete(backend.start_restart(cg, 3))
+        self.loop.run_until_complete(pending.wait())
+
+    def test_loop_queue(self):
+        q = aio.LoopQueue()
+        q.put("foo")
+        self.assertEqual(1, q.qsize())
+        self.assertEqual("foo", self.loop.run_until_complete(q.get()))
+        self.assertTrue(q.empty())
+
+    def test_api_restart(self):
+        server = self.start_docker_server()
+        backend = aio.AsyncDockerApiBackend(server.server_address)
+
+        self.restart(backend, MockCgroup("foo"))
+        self.assertEqual(["/containers/foo/restart?t=3"], server.requests)
+
+    def test_api_restart_error(self):
+        server = self.start_docker_server()
+        server.response = (404, {"message": "no such container"})
+        backend = aio.AsyncDockerApiBackend(server.server_address)
+
+        with self.assertRaises(RestartFailed) as cm:
+            self.restart(backend, MockCgroup("foo"))
+        self.assertIn("no such container", str(cm.exception))
+
+    def test_api_restart_fallback(self):
+        fallback = MockBackend()
+        backend = aio.AsyncDockerApiBackend(
+            os.path.join(self.tmp, "nope.sock"), aio.ExecutorBackend(fallback))
+
+        self.restart(backend, MockCgroup("foo"))
+        self.assertEqual(["foo"], fallback.restarts)
+
+    def test_api_restart_no_fallback(self):
+        backend = aio.AsyncDockerApiBackend(
+            os.path.join(self.tmp, "nope.sock"))
+        self.assertRaises(RestartFailed, self.restart, backend,
+                          MockCgroup("foo"))
+
+    def test_cli_restart(self):
+        log = self.fake_docker("exit 0")
+        self.restart(aio.AsyncDockerCliBackend(), MockCgroup("foo"))
+        with open(log) as f:
+            self.assertEqual("restart -t 3 foo\n", f.read())
+
+    def test_cli_restart_error(self):
+        self.fake_docker("exit 1")
+        self.assertRaises(RestartFailed, self.restart,
+                          aio.AsyncDockerCliBackend(), MockCgroup("foo"))
+
+    def test_restart_timeout(self):
+        self.fake_docker("exec sleep 30")
+        q = aio.LoopQueue()
+        cg = MockCgroup("foo")
+        headroom = HeadroomBudget(free_memory=lambda: 10 ** 9)
+
+        coro = aio.restart(q, 3, cg, aio.AsyncDockerCliBackend(), headroom,
+                           None, TaskSnapshotter(), 0.2)
+        self.loop.run_until_complete(asyncio.wait_for(coro, 5))
+
+        # We gave up, but put everything back
+        msg = self.loop.run_until_complete(q.get())
+        self.assertIsInstance(msg, RestartCompleteMessage)
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual(0, headroom.outstanding)
+
+    def test_engine(self):
+        q = aio.LoopQueue()
+        backend = MockBackend()
+        engine = aio.AsyncRestartEngine(q, 3,
+                                        backend=aio.ExecutorBackend(backend))
+        cg = MockCgroup("foo")
+
+        q.put(RestartRequestedMessage(cg))
+        q.put(RestartRequestedMessage(cg))
+        self.run_for(engine.run(), 0.5)
+
+        self.assertEqual(["foo"], backend.restarts)
+        self.assertFalse(cg.restart_in_flight)
+        self.assertEqual(set(), engine._running_restarts)
+
+    def test_serve(self):
+        tree = FakeCgroupTree(self.tmp)
+        path = tree.create("foo")
+
+        q = aio.LoopQueue()
+        backend = MockBackend()
+        engine = aio.AsyncRestartEngine(q, 3,
+                                        backend=aio.ExecutorBackend(backend))
+        index = CgroupIndex(self.tmp, q)
+        index.open()
+        self.addCleanup(index.close)
+
+        def oom():
+            tree.set_under_oom(path, True)
+            tree.fire(path)
+
+        # The OOM event is dispatched by the loop, not by a sync.
+        index.sync()
+        self.loop.call_later(0.1, oom)
+        self.run_for(aio.serve(index, engine, 60, 0), 0.5)
+
+        self.assertEqual(["foo"], backend.restarts)
@@ -0,0 +1,143 @@
+# coding:utf-8
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from captain_comeback.restart.backends import (DockerCliBackend,
+                                               RestartFailed, SignalBackend,
+                                               SelectBackend,
+                                               SIGNAL_TARGET_LARGEST)
+from captain_comeback.restart.policy import RestartPolicy
+from captain_comeback.test.mocks import MockCgroup, MockBackend
+
+
+IGNORE_SIGTERM = """
+import signal, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+sys.stdout.write("ready\\n")
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+BIG = """
+import sys, time
+buf = bytearray(64 * 1024 * 1024)
+sys.stdout.write("ready\\n")
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+class ProcessCgroup(object):
+    def __init__(self, name, procs):
+        self._name = name
+        self.procs_ = procs
+
+    def name(self):
+        return self._name
+
+    def procs(self):
+        # Reap processes that exited, like the kernel would remove them
+        return [p.pid for p in self.procs_ if p.poll() is None]
+
+    def pids(self):
+        # Threads would show up here, and shouldn't be signalled.
+        raise AssertionError("only processes should be signalled")
+
+
+class SignalBackendTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if proc.stdout is not None:
+                proc.stdout.close()
+
+    def spawn(self, script=None):
+        if script is None:
+            proc = subprocess.Popen(["sleep", "60"])
+        else:
+            proc = subprocess.Popen([sys.executable, "-c", script],
+                                    stdout=subprocess.PIPE)
+            proc.stdout.readline()
+        self.procs.append(proc)
+        return proc
+
+    def test_signal_all(self):
+        procs = [self.spawn(), self.spawn()]
+        cg = ProcessCgroup("foo", procs)
+
+        SignalBackend().start_restart(cg, 10).wait()
+
+        self.assertEqual([], cg.procs())
+        self.assertEqual([-signal.SIGTERM] * 2, [p.wait() for p in procs])
+
+    def test_signal_kill_survivors(self):
+        proc = self.spawn(IGNORE_SIGTERM)
+        cg = ProcessCgroup("foo", [proc])
+
+        SignalBackend().start_restart(cg, 0.2).wait()
+
+        self.assertEqual(-signal.SIGKILL, proc.wait())
+
+    def test_signal_largest(self):
+        small = self.spawn()
+        big = self.spawn(BIG)
+        cg = ProcessCgroup("foo", [small, big])
+
+        SignalBackend(SIGNAL_TARGET_LARGEST).start_restart(cg, 10).wait()
+
+        self.assertEqual(-signal.SIGTERM, big.wait())
+        self.assertIsNone(small.poll())
+
+    def test_signal_gone(self):
+        proc = self.spawn()
+        proc.kill()
+        proc.wait()
+        cg = ProcessCgroup("foo", [proc])
+        SignalBackend().start_restart(cg, 10).wait()
+
+
+class DockerCliBackendTestUnit(unittest.TestCase):
+    def test_no_docker(self):
+        path = os.environ.get("PATH")
+        self.addCleanup(os.environ.__setitem__, "PATH", path or "")
+        os.environ["PATH"] = tempfile.gettempdir()
+        with self.assertRaises(RestartFailed):
+            DockerCliBackend().start_restart(MockCgroup("foo"), 10)
+
+
+class SelectBackendTestUnit(unittest.TestCase):
+    def test_select(self):
+        default, web, db = MockBackend(), MockBackend(), MockBackend()
+        backend = SelectBackend(default, [("web-*", web), ("*db*", db),
+                                          ("web-db", default)])
+
+        for name in ["web-1", "mydb", "web-db", "other"]:
+            backend.start_restart(MockCgroup(name), 10)
+
+        self.assertEqual(["web-1", "web-db"], web.restarts)
+        self.assertEqual(["mydb"], db.restarts)
+        self.assertEqual(["other"], default.restarts)
+
+    def test_select_policy(self):
+        default, web, sig = MockBackend(), MockBackend(), MockBackend()
+        backend = SelectBackend(default, [("web-*", web)], {"signal": sig})
+
+        for name, backend_name in [("web-1", "signal"), ("web-2", "nope"),
+                                   ("other", None)]:
+            cg = MockCgroup(name)
+            cg.restart_policy = RestartPolicy(backend=backend_name)
+            backend.start_restart(cg, 10)
+
+        # Unknown backends fall back to patterns
+        self.assertEqual(["web-1"], sig.restarts)
+        self.assertEqual(["web-2"], web.restarts)
+        self.assertEqual(["other"], default.restarts)
@@ -0,0 +1,108 @@
+# coding:utf-8
+import unittest
+
+from captain_comeback.restart.backoff import RestartBackoff, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RestartBackoffTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_backoff(self, **kwargs):
+        return RestartBackoff(base=1, max_delay=4, reset_after=60,
+                              clock=self.clock, **kwargs)
+
+    def test_first_restart(self):
+        backoff = self.make_backoff()
+        self.assertEqual(0, backoff.delay("foo"))
+        self.assertEqual(0, backoff.streak("foo"))
+
+    def test_exponential(self):
+        backoff = self.make_backoff()
+        delays = []
+        for _ in range(5):
+            backoff.record("foo")
+            delays.append(backoff.delay("foo"))
+        self.assertEqual([1, 2, 4, 4, 4], delays)
+        self.assertEqual(0, backoff.delay("bar"))
+
+    def test_delay_counts_down(self):
+        backoff = self.make_backoff()
+        backoff.record("foo")
+        backoff.record("foo")
+        self.clock.now += 1.5
+        self.assertEqual(0.5, backoff.delay("foo"))
+        self.clock.now += 1
+        self.assertEqual(0, backoff.delay("foo"))
+
+    def test_reset(self):
+        backoff = self.make_backoff()
+        backoff.record("foo")
+        backoff.record("foo")
+        self.clock.now += 60
+        self.assertEqual(0, backoff.streak("foo"))
+        backoff.record("foo")
+        self.assertEqual(1, backoff.delay("foo"))
+
+    def test_prune(self):
+        backoff = self.make_backoff()
+        backoff.record("foo")
+        self.clock.now += 60
+        backoff.record("bar")
+        self.assertEqual(["bar"], list(backoff._history))
+
+    def test_no_quarantine(self):
+        backoff = self.make_backoff()
+        for _ in range(10):
+            backoff.record("foo")
+        self.assertIsNone(backoff.quarantined_until("foo"))
+
+    def test_quarantine(self):
+        backoff = self.make_backoff(quarantine_after=3, quarantine_period=100)
+        for _ in range(2):
+            backoff.record("foo")
+        self.assertIsNone(backoff.quarantined_until("foo"))
+
+        backoff.record("foo")
+        self.assertEqual(1100, backoff.quarantined_until("foo"))
+        self.clock.now += 50
+        self.assertEqual(1100, backoff.quarantined_until("foo"))
+
+        # Starts over afterwards
+        self.clock.now += 50
+        self.assertIsNone(backoff.quarantined_until("foo"))
+        self.assertEqual(0, backoff.delay("foo"))
+
+
+class TokenBucketTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_unlimited(self):
+        bucket = TokenBucket(clock=self.clock)
+        for _ in range(10):
+            self.assertEqual(0, bucket.take())
+
+    def test_rate(self):
+        bucket = TokenBucket(rate=2, burst=2, clock=self.clock)
+        self.assertEqual([0, 0, 0.5, 1],
+                         [bucket.take() for _ in range(4)])
+
+        # Those two tokens were handed out ahead of time
+        self.clock.now += 1
+        self.assertEqual(0.5, bucket.take())
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=1, burst=2, clock=self.clock)
+        bucket.take()
+        bucket.take()
+        self.clock.now += 10
+        self.assertEqual([0, 0, 1], [bucket.take() for _ in range(3)])
@@ -0,0 +1,35 @@
+# coding:utf-8
+import json
+import shutil
+import tempfile
+import unittest
+from six.moves import StringIO
+
+from captain_comeback.benchmark import run_benchmark, main, percentile
+
+
+class BenchmarkTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_run_benchmark(self):
+        result = run_benchmark(self.root, 5, sync_rounds=2, events=3)
+        self.assertEqual(5, result["cgroups"])
+        self.assertGreater(result["rw_syscalls_per_sync"], 0)
+        self.assertIsNotNone(result["event_latency_seconds_p99"])
+        self.assertGreaterEqual(result["oom_path_allocated_bytes_max"], 0)
+
+    def test_main_skips_sizes_over_fd_limit(self):
+        out = StringIO()
+        main([2, 10 ** 9], 1, 1, self.root, out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([2], [r["cgroups"] for r in results])
+
+    def test_percentile(self):
+        self.assertEqual(1, percentile([3, 1, 2], 0))
+        self.assertEqual(2, percentile([3, 1, 2], 50))
+        self.assertEqual(3, percentile([3, 1, 2], 100))
+        self.assertIsNone(percentile([], 50))
@@ -2,10 +2,15 @@
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 from six.moves import queue
 
 from captain_comeback.cgroup import Cgroup
+from captain_comeback.restart.messages import (MemoryPressureMessage,
+                                               MemoryThresholdMessage)
+from captain_comeback.restart.policy import RestartPolicy
 
 
 class CgroupTestUnit(unittest.TestCase):
@@ -32,6 +37,11 @@ class CgroupTestUnit(unittest.TestCase):
             f.write(str(memory_limit))
             f.write("\n")
 
+    def write_usage(self, usage):
+        with open(self.cg_path("memory.usage_in_bytes"), "w") as f:
+            f.write(str(usage))
+            f.write("\n")
+
     def cg_path(self, path):
         return os.path.join(self.mock_cg, path)
 
@@ -41,13 +51,115 @@ class CgroupTestUnit(unittest.TestCase):
         self.write_oom_control()
         self.monitor.open()
         evt_fileno = self.monitor.event_fileno()
-        oom_control_fileno = self.monitor.oom_control.fileno()
+        oom_control_fileno = self.monitor.oom_control
         self.monitor.close()
 
         with open(self.cg_path("cgroup.event_control")) as f:
             e = "{0} {1}\n".format(evt_fileno, oom_control_fileno)
             self.assertEqual(e, f.read())
 
+    def test_open_pressure_level(self):
+        self.write_oom_control()
+        open(self.cg_path("memory.pressure_level"), "w").close()
+
+        cg = Cgroup(self.mock_cg, pressure_level="medium")
+        cg.open()
+        self.assertEqual(2, len(cg.event_filenos()))
+        pressure_evt_fileno = cg.pressure_event.fileno()
+        pressure_fileno = cg.pressure
+        cg.close()
+
+        with open(self.cg_path("cgroup.event_control")) as f:
+            e = "{0} {1} medium\n".format(pressure_evt_fileno,
+                                          pressure_fileno)
+            self.assertEqual(e, f.read())
+
+    def test_dispatch_pressure_event(self):
+        self.write_oom_control()
+        open(self.cg_path("memory.pressure_level"), "w").close()
+
+        cg = Cgroup(self.mock_cg, pressure_level="critical")
+        cg.open()
+        cg.pressure_event.write(1)
+        cg.dispatch([cg.pressure_event.fileno()], self.queue)
+        cg.close()
+
+        msg = self.queue.get_nowait()
+        self.assertIsInstance(msg, MemoryPressureMessage)
+        self.assertEqual("critical", msg.level)
+        self.assertRaises(queue.Empty, self.queue.get_nowait)
+
+    def test_arm_thresholds(self):
+        self.write_oom_control()
+        self.write_memory_limit(1000)
+        self.write_usage(0)
+
+        cg = Cgroup(self.mock_cg, usage_thresholds=[0.8])
+        cg.open()
+        self.assertTrue(cg.thresholds_need_rearm())
+        cg.arm_thresholds()
+        self.assertFalse(cg.thresholds_need_rearm())
+        evt_fileno = cg.threshold_event.fileno()
+        usage_fileno = cg.usage
+        self.assertIn(evt_fileno, cg.event_filenos())
+
+        # Changing the limit means thresholds must move too
+        self.write_memory_limit(2000)
+        self.assertTrue(cg.thresholds_need_rearm())
+        cg.close()
+
+        with open(self.cg_path("cgroup.event_control")) as f:
+            e = "{0} {1} 800\n".format(evt_fileno, usage_fileno)
+            self.assertEqual(e, f.read())
+
+    def test_arm_thresholds_no_memory_limit(self):
+        self.write_oom_control()
+        self.write_memory_limit()
+        self.write_usage(0)
+
+        cg = Cgroup(self.mock_cg, usage_thresholds=[0.8])
+        cg.open()
+        self.assertFalse(cg.thresholds_need_rearm())
+        cg.arm_thresholds()
+        self.assertIsNone(cg.threshold_event)
+        cg.close()
+
+    def test_dispatch_threshold_event(self):
+        self.write_oom_control()
+        self.write_memory_limit(1000)
+        self.write_usage(900)
+
+        cg = Cgroup(self.mock_cg, usage_thresholds=[0.95, 0.8])
+        cg.open()
+        cg.arm_thresholds()
+        cg.threshold_event.write(1)
+        cg.dispatch([cg.threshold_event.fileno()], self.queue)
+
+        self.write_usage(100)
+        cg.threshold_event.write(1)
+        cg.dispatch([cg.threshold_event.fileno()], self.queue)
+        cg.close()
+
+        msg = self.queue.get_nowait()
+        self.assertIsInstance(msg, MemoryThresholdMessage)
+        self.assertEqual(0.8, msg.threshold)
+        self.assertEqual(900, msg.usage)
+        self.assertEqual(1000, msg.memory_limit)
+
+        msg = self.queue.get_nowait()
+        self.assertIsNone(msg.threshold)
+
+    def test_rss(self):
+        with open(self.cg_path("memory.stat"), "w") as f:
+            f.write("cache 2048\nrss 1024\ntotal_cache 4096\n"
+                    "total_rss 3072\n")
+        self.assertEqual(3072, self.monitor.rss_in_bytes())
+
+    def test_usage(self):
+        with open(self.cg_path("memory.usage_in_bytes"), "w") as f:
+            f.write("1024\n")
+        self.assertEqual(1024, self.monitor.usage_in_bytes())
+
     def test_wakeup_disable_oom_killer(self):
         self.write_oom_control()
         self.write_memory_limit(1024)
@@ -83,20 +195,128 @@ class CgroupTestUnit(unittest.TestCase):
         with open(self.cg_path("memory.oom_control")) as f:
             self.assertEqual("oom_kill_disable 0\n", f.readline())
 
+    def test_wakeup_never_restart(self):
+        self.write_oom_control(oom_kill_disable="0", under_oom="1")
+        self.write_memory_limit(1024)
+        self.monitor.restart_policy = RestartPolicy(never_restart=True)
+
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+
+        # Left to the OOM killer
+        with open(self.cg_path("memory.oom_control")) as f:
+            self.assertEqual("oom_kill_disable 0\n", f.readline())
+        self.assertTrue(self.queue.empty())
+
+    def test_wakeup_never_restart_enables_oom_killer(self):
+        self.write_oom_control(oom_kill_disable="1", under_oom="1")
+        self.write_memory_limit(1024)
+        self.monitor.restart_policy = RestartPolicy(never_restart=True)
+
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+
+        with open(self.cg_path("memory.oom_control")) as f:
+            self.assertEqual("0\n", f.read())
+        self.assertTrue(self.queue.empty())
+
+    def test_wakeup_quarantined(self):
+        self.write_oom_control(oom_kill_disable="1", under_oom="1")
+        self.write_memory_limit(1024)
+        self.monitor.quarantined_until = time.time() + 60
+
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+
+        with open(self.cg_path("memory.oom_control")) as f:
+            self.assertEqual("0\n", f.read())
+        self.assertTrue(self.queue.empty())
+
     def test_wakeup_stale(self):
         self.write_oom_control(oom_kill_disable="0")
 
         self.monitor.open()
 
-        os.close(self.monitor.oom_control.fileno())
+        os.close(self.monitor.oom_control)
         self.monitor.wakeup(self.queue)
         self.assertRaises(EnvironmentError, self.monitor.wakeup, self.queue,
                           raise_for_stale=True)
 
-        # Close the other FD manually. We still need to attempt closing the
-        # wrapper to avoid a resource warning.
+        # Close the other FD manually.
         os.close(self.monitor.event_fileno())
+
+    def test_oom_control_status(self):
+        self.write_oom_control(oom_kill_disable="1", under_oom="0")
+        self.monitor.open()
+        status = self.monitor.oom_control_status()
+        self.monitor.close()
+        self.assertEqual({"oom_kill_disable": "1", "under_oom": "0"}, status)
+
+    def test_wakeup_under_oom(self):
+        self.write_oom_control(oom_kill_disable="1", under_oom="1")
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+        self.assertIs(self.monitor, self.queue.get_nowait().cg)
+
+    def test_wakeup_rereads(self):
+        self.write_oom_control(oom_kill_disable="1", under_oom="0")
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.assertTrue(self.queue.empty())
+
+        # The file is kept open, but we must see changes to it
+        self.write_oom_control(oom_kill_disable="1", under_oom="1")
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+        self.assertIs(self.monitor, self.queue.get_nowait().cg)
+
+    def test_memory_limit_kept_open(self):
+        self.write_oom_control()
+        self.write_memory_limit(1024)
+        self.monitor.open()
+        self.assertEqual(1024, self.monitor.memory_limit_in_bytes())
+
+        self.monitor.set_memory_limit_in_bytes(2048)
+        self.assertEqual(2048, self.monitor.memory_limit_in_bytes())
+        self.assertEqual(1, len(self.monitor._control_fds))
+        self.monitor.close()
+        self.assertEqual(0, len(self.monitor._control_fds))
+
+    def test_memory_limit_concurrent_close(self):
+        self.write_oom_control()
+        self.write_memory_limit(1024)
+        stop = threading.Event()
+        results = set()
+
+        def read():
+            while not stop.is_set():
+                results.add(self.monitor.memory_limit_in_bytes())
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
         try:
-            self.monitor.oom_control.close()
-        except EnvironmentError:
-            pass
+            for _ in range(200):
+                self.monitor.open()
+                self.monitor.close()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(set([1024]), results)
+        self.assertEqual(0, len(self.monitor._control_fds))
+
+    def test_memory_limit_closed(self):
+        self.write_memory_limit(1024)
+        self.assertEqual(1024, self.monitor.memory_limit_in_bytes())
+        self.assertEqual(0, len(self.monitor._control_fds))
+
+    def test_pids(self):
+        with open(self.cg_path("tasks"), "w") as f:
+            f.write("1\n23\n")
+        self.assertEqual([1, 23], self.monitor.pids())
@@ -0,0 +1,140 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from six.moves import queue
+
+from captain_comeback.cgroup_v2 import CgroupV2, is_cgroup_v2
+from captain_comeback.restart.messages import RestartRequestedMessage
+
+
+class CgroupV2TestUnit(unittest.TestCase):
+    def setUp(self):
+        self.mock_cg = tempfile.mkdtemp()
+        self.monitor = CgroupV2(self.mock_cg)
+        self.queue = queue.Queue()
+
+        self.write_memory_events()
+        self.write_file("cgroup.events", "populated 1\nfrozen 0\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.mock_cg)
+
+    # Helpers
+
+    def write_memory_events(self, oom=0):
+        events = ["low 0", "high 0", "max 0", "oom {0}".format(oom),
+                  "oom_kill {0}".format(oom)]
+        self.write_file("memory.events", "\n".join(events) + "\n")
+
+    def write_file(self, name, content):
+        with open(self.cg_path(name), "w") as f:
+            f.write(content)
+
+    def read_file(self, name):
+        with open(self.cg_path(name)) as f:
+            return f.read()
+
+    def cg_path(self, path):
+        return os.path.join(self.mock_cg, path)
+
+    # Tests
+
+    def test_is_cgroup_v2(self):
+        self.assertFalse(is_cgroup_v2(self.mock_cg))
+        self.write_file("cgroup.controllers", "memory pids\n")
+        self.assertTrue(is_cgroup_v2(self.mock_cg))
+
+    def test_is_container(self):
+        self.assertTrue(CgroupV2.is_container("abc123"))
+        self.assertTrue(CgroupV2.is_container("docker-abc123.scope"))
+        self.assertFalse(CgroupV2.is_container("sshd.service"))
+        self.assertFalse(CgroupV2.is_container("init.scope"))
+
+    def test_name(self):
+        self.assertEqual("abc123", CgroupV2("/foo/abc123").name())
+        self.assertEqual("abc123",
+                         CgroupV2("/foo/docker-abc123.scope").name())
+
+    def test_wakeup_no_oom(self):
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+        self.assertRaises(queue.Empty, self.queue.get_nowait)
+
+    def test_wakeup_oom(self):
+        self.monitor.open()
+        self.write_memory_events(oom=1)
+        self.monitor.dispatch([self.monitor.event_fileno()], self.queue)
+
+        # The same OOM shouldn't be reported twice
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+
+        msg = self.queue.get_nowait()
+        self.assertIsInstance(msg, RestartRequestedMessage)
+        self.assertEqual(self.monitor, msg.cg)
+        self.assertRaises(queue.Empty, self.queue.get_nowait)
+
+    def test_wakeup_restart_in_flight(self):
+        self.monitor.open()
+        self.monitor.restart_in_flight = True
+        self.write_memory_events(oom=1)
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+        self.assertRaises(queue.Empty, self.queue.get_nowait)
+
+    def test_wakeup_ignores_past_ooms(self):
+        self.write_memory_events(oom=3)
+        self.monitor.open()
+        self.monitor.wakeup(self.queue)
+        self.monitor.close()
+        self.assertRaises(queue.Empty, self.queue.get_nowait)
+
+    def test_wakeup_stale(self):
+        self.monitor.open()
+
+        os.close(self.monitor.memory_events.fileno())
+        self.monitor.wakeup(self.queue)
+        self.assertRaises(EnvironmentError, self.monitor.wakeup, self.queue,
+                          raise_for_stale=True)
+
+        os.close(self.monitor.cgroup_events.fileno())
+        for f in [self.monitor.memory_events, self.monitor.cgroup_events]:
+            try:
+                f.close()
+            except EnvironmentError:
+                pass
+
+    def test_memory_limit(self):
+        self.write_file("memory.max", "max\n")
+        self.assertEqual(-1, self.monitor.memory_limit_in_bytes())
+        self.write_file("memory.max", "1024\n")
+        self.assertEqual(1024, self.monitor.memory_limit_in_bytes())
+
+    def test_rss(self):
+        self.write_file("memory.stat", "anon 1024\nfile 2048\n")
+        self.assertEqual(1024, self.monitor.rss_in_bytes())
+
+    def test_usage(self):
+        self.write_file("memory.current", "1024\n")
+        self.assertEqual(1024, self.monitor.usage_in_bytes())
+
+    def test_set_memory_limit(self):
+        self.write_file("memory.max", "1000\n")
+        self.write_file("memory.high", "max\n")
+        self.monitor.set_memory_limit_in_bytes(1100)
+        self.assertEqual("1100\n", self.read_file("memory.max"))
+        self.assertEqual("max\n", self.read_file("memory.high"))
+
+    def test_set_memory_limit_moves_high(self):
+        self.write_file("memory.max", "1000\n")
+        self.write_file("memory.high", "900\n")
+        self.monitor.set_memory_limit_in_bytes(1100)
+        self.assertEqual("1100\n", self.read_file("memory.max"))
+        self.assertEqual("1000\n", self.read_file("memory.high"))
+
+    def test_pids(self):
+        self.write_file("cgroup.procs", "1\n23\n")
+        self.assertEqual([1, 23], self.monitor.pids())
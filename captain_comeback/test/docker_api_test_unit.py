@@ -0,0 +1,186 @@
+# coding:utf-8
+import io
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from six.moves import socketserver, BaseHTTPServer, http_client
+
+from captain_comeback.restart.docker_api import (DockerClient, DockerError,
+                                                 check_status, parse_response)
+from captain_comeback.restart.backends import (DockerApiBackend,
+                                               RestartFailed)
+from captain_comeback.test.mocks import MockCgroup, MockBackend
+
+
+class FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        status, body = self.server.response
+        body = json.dumps(body).encode("utf-8") if body else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, FakeDockerHandler)
+        self.connections = 0
+        self.requests = []
+        self.response = (204, None)
+
+
+class DockerApiTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp, "docker.sock")
+        self.server = FakeDockerServer(self.socket_path)
+        self.server_thread = threading.Thread(target=self.server.serve_forever,
+                                              args=(0.01,))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.client = DockerClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_restart(self):
+        self.client.restart("foo", 10)
+        self.assertEqual(["/containers/foo/restart?t=10"],
+                         self.server.requests)
+
+    def test_restart_reuses_connections(self):
+        for _ in range(3):
+            self.client.restart("foo", 10)
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, self.server.connections)
+
+    def test_restart_error(self):
+        self.server.response = (404, {"message": "No such container: foo"})
+        with self.assertRaises(DockerError) as cm:
+            self.client.restart("foo", 10)
+        self.assertEqual(404, cm.exception.status)
+        self.assertEqual("No such container: foo", cm.exception.message)
+
+    def break_pooled_connection(self, sock):
+        self.client.restart("foo", 10)
+        conn = self.client._pool.get_nowait()
+        conn.sock.close()
+        conn.sock = sock
+        self.client._pool.put_nowait(conn)
+
+    def test_restart_retries_stale_connection(self):
+        # Docker closed the pooled connection, so the request never made it.
+        self.break_pooled_connection(_ClosedSocket())
+        self.client.restart("foo", 10)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_restart_not_retried_once_sent(self):
+        # Docker might be restarting the container already.
+        self.break_pooled_connection(_HalfClosedSocket())
+        with self.assertRaises(http_client.HTTPException):
+            self.client.restart("foo", 10)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_inspect_retried_once_sent(self):
+        self.break_pooled_connection(_HalfClosedSocket())
+        self.server.response = (200, {"Id": "foo"})
+        self.assertEqual({"Id": "foo"}, self.client.inspect("foo"))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_backend_restart(self):
+        backend = DockerApiBackend(self.client)
+        backend.start_restart(MockCgroup("foo"), 3).wait()
+        self.assertEqual(["/containers/foo/restart?t=3"],
+                         self.server.requests)
+
+    def test_backend_restart_error(self):
+        self.server.response = (500, {"message": "oops"})
+        backend = DockerApiBackend(self.client)
+        pending = backend.start_restart(MockCgroup("foo"), 3)
+        self.assertRaises(RestartFailed, pending.wait)
+
+    def test_backend_fallback(self):
+        fallback = MockBackend()
+        cg = MockCgroup("foo")
+        client = DockerClient(os.path.join(self.tmp, "nope.sock"))
+        backend = DockerApiBackend(client, fallback)
+        backend.start_restart(cg, 3)
+        self.assertEqual(["foo"], fallback.restarts)
+        self.assertEqual([3], fallback.grace_periods)
+
+    def test_backend_no_fallback(self):
+        client = DockerClient(os.path.join(self.tmp, "nope.sock"))
+        backend = DockerApiBackend(client)
+        self.assertRaises(RestartFailed, backend.start_restart,
+                          MockCgroup("foo"), 3)
+
+
+class ParseResponseTestUnit(unittest.TestCase):
+    def test_content_length(self):
+        data = (b"HTTP/1.1 201 Created\r\nContent-Length: 2\r\n\r\n"
+                b"ok")
+        self.assertEqual((201, b"ok"), parse_response(data))
+
+    def test_chunked(self):
+        data = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"2\r\nok\r\n0\r\n\r\n")
+        self.assertEqual((200, b"ok"), parse_response(data))
+
+    def test_until_closed(self):
+        data = b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nok"
+        self.assertEqual((200, b"ok"), parse_response(data))
+
+    def test_malformed(self):
+        self.assertRaises(http_client.HTTPException, parse_response, b"")
+        self.assertRaises(http_client.HTTPException, parse_response,
+                          b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nok")
+
+    def test_check_status(self):
+        check_status(204, b"")
+        with self.assertRaises(DockerError) as cm:
+            check_status(404, b'{"message": "no such container"}')
+        self.assertEqual("no such container", cm.exception.message)
+
+
+class _ClosedSocket(object):
+    # Behaves like a socket the other end has closed.
+    def sendall(self, _data):
+        raise EnvironmentError(32, "Broken pipe")
+
+    def settimeout(self, _timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class _HalfClosedSocket(_ClosedSocket):
+    # Docker closed it after we sent the request.
+    def sendall(self, _data):
+        pass
+
+    def makefile(self, *_args, **_kwargs):
+        return io.BytesIO(b"")
@@ -0,0 +1,119 @@
+# coding:utf-8
+import io
+import os
+import json
+import select
+import shutil
+import tempfile
+import threading
+import unittest
+
+from six.moves import socketserver
+
+from captain_comeback.restart.docker_api import DockerError
+from captain_comeback.restart.docker_events import (DockerEventStream,
+                                                    iter_lines, parse_event,
+                                                    events_path,
+                                                    EVENT_RECONNECT)
+
+
+def chunk(data):
+    return "{0:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n"
+
+
+def event(action, container_id):
+    return json.dumps({"Type": "container", "Action": action,
+                       "Actor": {"ID": container_id}}).encode("utf-8")
+
+
+class FakeEventsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request_line = self.rfile.readline()
+        self.server.requests.append(request_line.split()[1].decode("ascii"))
+        while self.rfile.readline() not in (b"\r\n", b""):
+            pass
+
+        status, chunks = self.server.response
+        self.wfile.write("HTTP/1.1 {0} Whatever\r\n".format(status)
+                         .encode("ascii"))
+        self.wfile.write(b"Content-Type: application/json\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+        for data in chunks:
+            self.wfile.write(chunk(data))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class FakeEventsServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, FakeEventsHandler)
+        self.requests = []
+        self.response = (200, [])
+
+
+class DockerEventsTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp, "docker.sock")
+        self.server = FakeEventsServer(self.socket_path)
+        self.server_thread = threading.Thread(target=self.server.serve_forever,
+                                              args=(0.01,))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.stream = DockerEventStream(self.socket_path)
+
+    def tearDown(self):
+        self.stream.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_iter_lines_chunked(self):
+        # Events can be split across chunks, or share one
+        body = (chunk(b'{"a": 1}\n{"b"') + chunk(b': 2}\n') +
+                chunk(b'{"c": 3}') + b"0\r\n\r\n")
+        lines = list(iter_lines(io.BytesIO(body), True))
+        self.assertEqual([b'{"a": 1}', b'{"b": 2}', b'{"c": 3}'], lines)
+
+    def test_iter_lines_identity(self):
+        body = b'{"a": 1}\n\n{"b": 2}\n'
+        lines = list(iter_lines(io.BytesIO(body), False))
+        self.assertEqual([b'{"a": 1}', b'{"b": 2}'], lines)
+
+    def test_parse_event(self):
+        self.assertEqual(("die", "abc"), parse_event(event("die", "abc")))
+
+    def test_parse_event_legacy(self):
+        line = json.dumps({"status": "start", "id": "abc"}).encode("utf-8")
+        self.assertEqual(("start", "abc"), parse_event(line))
+
+    def test_parse_event_ignored(self):
+        self.assertIsNone(parse_event(event("exec_start: sh", "abc")))
+        self.assertIsNone(parse_event(b'{"Type": "network", '
+                                      b'"Action": "start"}'))
+        self.assertIsNone(parse_event(b"not json"))
+
+    def test_stream(self):
+        self.server.response = (200, [event("start", "foo") + b"\n",
+                                      event("die", "bar") + b"\n"])
+        self.stream.stream()
+
+        self.assertEqual([events_path()], self.server.requests)
+        r, _, _ = select.select([self.stream.fileno()], [], [], 0)
+        self.assertEqual([self.stream.fileno()], r)
+        self.assertEqual([(EVENT_RECONNECT, None), ("start", "foo"),
+                          ("die", "bar")], self.stream.drain())
+
+        # Draining acknowledges the events
+        r, _, _ = select.select([self.stream.fileno()], [], [], 0)
+        self.assertEqual([], r)
+        self.assertEqual([], self.stream.drain())
+
+    def test_stream_error(self):
+        self.server.response = (500, [b'{"message": "oops"}'])
+        with self.assertRaises(DockerError) as cm:
+            self.stream.stream()
+        self.assertEqual("oops", cm.exception.message)
+        self.assertEqual([], self.stream.drain())
@@ -0,0 +1,485 @@
+# coding:utf-8
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from six.moves import queue
+
+from captain_comeback.restart.engine import (RestartEngine, restart,
+                                             PRESSURE_ACTION_RESTART)
+from captain_comeback.restart.backends import RestartFailed
+from captain_comeback.restart.backoff import RestartBackoff, TokenBucket
+from captain_comeback.restart.freezer import CgroupFreezer
+from captain_comeback.restart.headroom import HeadroomBudget
+from captain_comeback.restart.limits import LimitJournal
+from captain_comeback.restart.policy import RestartPolicy
+from captain_comeback import metrics
+from captain_comeback.restart.messages import (RestartRequestedMessage,
+                                               RestartCompleteMessage,
+                                               RestartRetryMessage,
+                                               ContainerRestartedMessage)
+from captain_comeback.test.mocks import MockCgroup, MockBackend
+
+
+class MockFreezer(object):
+    def __init__(self, frozen=True):
+        self.frozen = frozen
+        self.calls = []
+
+    def freeze(self, cg):
+        self.calls.append(("freeze", cg.memory_limit))
+        return self.frozen
+
+    def thaw(self, cg):
+        self.calls.append(("thaw", cg.memory_limit))
+
+
+class EngineTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.restarts = []
+
+    def make_engine(self, **kwargs):
+        engine = RestartEngine(self.queue, 10, **kwargs)
+        engine._handle_restart_requested = self.restarts.append
+        return engine
+
+    def test_memory_pressure_log(self):
+        engine = self.make_engine()
+        engine._handle_memory_pressure(MockCgroup("foo"), "critical")
+        self.assertEqual([], self.restarts)
+
+    def test_memory_pressure_restart(self):
+        engine = self.make_engine(pressure_action=PRESSURE_ACTION_RESTART)
+        cg = MockCgroup("foo")
+        engine._handle_memory_pressure(cg, "critical")
+        self.assertEqual([cg], self.restarts)
+
+    def test_memory_pressure_already_restarting(self):
+        engine = self.make_engine(pressure_action=PRESSURE_ACTION_RESTART)
+        cg = MockCgroup("foo")
+        engine._running_restarts.add(cg)
+        engine._handle_memory_pressure(cg, "critical")
+        self.assertEqual([], self.restarts)
+
+    def test_restart_dedup(self):
+        # No backoff, so we can restart it again right away
+        engine = RestartEngine(self.queue, 10,
+                               backoff=RestartBackoff(base=0))
+        cg = MockCgroup("foo")
+        engine._handle_restart_requested(cg)
+        engine._handle_restart_requested(cg)
+        self.assertEqual(1, engine.pending_restarts())
+
+        engine._handle_restart_complete(cg)
+        engine._handle_restart_requested(cg)
+        self.assertEqual(2, engine.pending_restarts())
+
+    def test_restart_in_flight(self):
+        engine = RestartEngine(self.queue, 10)
+        cg = MockCgroup("foo")
+        engine._handle_restart_requested(cg)
+        self.assertTrue(cg.restart_in_flight)
+
+        engine._handle_restart_complete(cg)
+        self.assertFalse(cg.restart_in_flight)
+
+    def test_container_restarted(self):
+        engine = RestartEngine(self.queue, 10)
+        foo, bar = MockCgroup("foo"), MockCgroup("bar")
+        engine._handle_restart_requested(foo)
+        engine._handle_restart_requested(bar)
+
+        engine._handle_message(ContainerRestartedMessage("foo"))
+        self.assertEqual(set([bar]), engine._running_restarts)
+        self.assertFalse(foo.restart_in_flight)
+
+        # The worker no longer needs to restart it, and finishing a restart
+        # that's already complete is fine.
+        self.assertFalse(engine._still_needs_restart(foo))
+        self.assertTrue(engine._still_needs_restart(bar))
+        engine._handle_restart_complete(foo)
+
+    def test_container_restarted_unknown(self):
+        engine = RestartEngine(self.queue, 10)
+        engine._handle_message(ContainerRestartedMessage("foo"))
+        self.assertEqual(set(), engine._running_restarts)
+
+    def test_restart_priority(self):
+        priorities = {"low": 0, "high": 10}
+        engine = RestartEngine(self.queue, 10,
+                               priority=lambda cg: priorities[cg.name()])
+
+        first_low, high, second_low = [MockCgroup(n) for n in
+                                       ["low", "high", "low"]]
+        for cg in [first_low, high, second_low]:
+            engine._handle_restart_requested(cg)
+
+        order = [engine._pending_restarts.get_nowait()[2] for _ in range(3)]
+        self.assertEqual([high, first_low, second_low], order)
+
+    def test_restart_policy_priority(self):
+        engine = RestartEngine(self.queue, 10)
+        low, high = MockCgroup("low"), MockCgroup("high")
+        high.restart_policy = RestartPolicy(priority=10)
+        for cg in [low, high]:
+            engine._handle_restart_requested(cg)
+
+        order = [engine._pending_restarts.get_nowait()[2] for _ in range(2)]
+        self.assertEqual([high, low], order)
+
+    def test_restart_policy_never_restart(self):
+        engine = RestartEngine(self.queue, 10)
+        cg = MockCgroup("foo")
+        cg.restart_policy = RestartPolicy(never_restart=True)
+        cg.restart_in_flight = True
+
+        engine._handle_restart_requested(cg)
+        self.assertEqual(0, engine.pending_restarts())
+        self.assertFalse(cg.restart_in_flight)
+
+    def test_restart_policy_grace_period(self):
+        backend = MockBackend()
+        engine = RestartEngine(self.queue, 10, backend=backend)
+
+        cg = MockCgroup("foo")
+        engine._restart(cg)
+        cg.restart_policy = RestartPolicy(grace_period=0)
+        engine._restart(cg)
+        self.assertEqual([10, 0], backend.grace_periods)
+
+    def test_preemption(self):
+        # The host watchdog counts these: they're not OOM events, and the
+        # container isn't at its limit, so it gets no headroom.
+        backend = MockBackend()
+        engine = RestartEngine(self.queue, 10, backend=backend,
+                               headroom=HeadroomBudget(
+                                   free_memory=lambda: 10**9))
+        cg = MockCgroup("foo")
+        oom_events = metrics.OOM_EVENTS.value
+        engine._handle_message(RestartRequestedMessage(cg, preemption=True))
+        self.assertEqual(oom_events, metrics.OOM_EVENTS.value)
+
+        engine._restart(engine._pending_restarts.get_nowait()[2])
+        self.assertEqual([1000], backend.limits_during_restart)
+        engine._handle_restart_complete(cg)
+        self.assertEqual(set(), engine._preemptions)
+
+        # This one ran out of memory.
+        engine._handle_message(RestartRequestedMessage(MockCgroup("bar")))
+        self.assertEqual(oom_events + 1, metrics.OOM_EVENTS.value)
+        engine._restart(engine._pending_restarts.get_nowait()[2])
+        self.assertEqual([1000, 1100], backend.limits_during_restart)
+
+    def test_restart_backoff(self):
+        engine = RestartEngine(self.queue, 10,
+                               backoff=RestartBackoff(base=0.05))
+        cg = MockCgroup("foo")
+        engine._handle_restart_requested(cg, 123)
+        engine._handle_restart_complete(cg)
+
+        # Too soon: we wait, but the restart stays in flight meanwhile
+        engine._handle_restart_requested(cg)
+        self.assertEqual(1, engine.pending_restarts())
+        self.assertTrue(cg.restart_in_flight)
+        engine._handle_restart_requested(cg)
+
+        msg = engine._next_message()
+        self.assertIsInstance(msg, RestartRetryMessage)
+        engine._handle_message(msg)
+        self.assertEqual(2, engine.pending_restarts())
+        self.assertEqual({}, engine._deferred)
+
+    def test_restart_backoff_no_threads(self):
+        engine = RestartEngine(self.queue, 10,
+                               backoff=RestartBackoff(base=60))
+        cgs = [MockCgroup("cg-{0}".format(i)) for i in range(50)]
+        for cg in cgs:
+            engine._handle_restart_requested(cg)
+            engine._handle_restart_complete(cg)
+
+        threads = threading.active_count()
+        for cg in cgs:
+            engine._handle_restart_requested(cg)
+        self.assertEqual(50, len(engine._deferred))
+        self.assertEqual(threads, threading.active_count())
+
+    def test_next_message_skips_cancelled(self):
+        engine = RestartEngine(self.queue, 10)
+        foo, bar = MockCgroup("foo"), MockCgroup("bar")
+        engine._defer(0, RestartRetryMessage(foo, 1)).cancel()
+        engine._defer(0.01, RestartRetryMessage(bar, 1))
+
+        self.assertIs(bar, engine._next_message().cg)
+        self.assertEqual([], engine._timers)
+
+        # Queued messages aren't held up by timers
+        engine._defer(60, RestartRetryMessage(foo, 1))
+        self.queue.put(ContainerRestartedMessage("foo"))
+        self.assertEqual("foo", engine._next_message().name)
+
+    def test_restart_backoff_container_restarted(self):
+        engine = RestartEngine(self.queue, 10,
+                               backoff=RestartBackoff(base=60))
+        cg = MockCgroup("foo")
+        engine._handle_restart_requested(cg)
+        engine._handle_restart_complete(cg)
+        engine._handle_restart_requested(cg)
+
+        engine._handle_message(ContainerRestartedMessage("foo"))
+        self.assertEqual({}, engine._deferred)
+        self.assertFalse(cg.restart_in_flight)
+
+        # A retry that was already queued is dropped
+        engine._handle_restart_retry(cg, 123)
+        self.assertEqual(1, engine.pending_restarts())
+
+    def test_restart_quarantine(self):
+        engine = RestartEngine(self.queue, 10, backoff=RestartBackoff(
+            base=0, quarantine_after=2, quarantine_period=60))
+        cg = MockCgroup("foo")
+        for _ in range(2):
+            engine._handle_restart_requested(cg)
+            engine._handle_restart_complete(cg)
+
+        cg.restart_in_flight = True
+        engine._handle_restart_requested(cg)
+        self.assertEqual(2, engine.pending_restarts())
+        self.assertFalse(cg.restart_in_flight)
+        self.assertGreater(cg.quarantined_until, time.time() + 50)
+
+    def test_restart_flapping_last(self):
+        engine = RestartEngine(self.queue, 10,
+                               backoff=RestartBackoff(base=0))
+        flapping, healthy = MockCgroup("flapping"), MockCgroup("healthy")
+        engine._handle_restart_requested(flapping)
+        engine._handle_restart_complete(flapping)
+        engine._pending_restarts.get_nowait()
+
+        engine._handle_restart_requested(flapping, 1)
+        engine._handle_restart_requested(healthy, 2)
+        order = [engine._pending_restarts.get_nowait()[2] for _ in range(2)]
+        self.assertEqual([healthy, flapping], order)
+
+    def test_restart_rate_limit(self):
+        engine = RestartEngine(self.queue, 10, workers=1,
+                               rate_limit=TokenBucket(rate=20))
+        started = []
+        engine._restart = lambda cg: started.append(time.time())
+        engine.start_workers()
+
+        for name in ["foo", "bar", "baz"]:
+            engine._handle_restart_requested(MockCgroup(name))
+        deadline = time.time() + 5
+        while len(started) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(3, len(started))
+        self.assertGreaterEqual(started[2] - started[0], 0.09)
+
+    def test_restart_longest_waiting_first(self):
+        engine = RestartEngine(self.queue, 10)
+        foo, bar = MockCgroup("foo"), MockCgroup("bar")
+        engine._handle_restart_requested(foo, requested_at=20)
+        engine._handle_restart_requested(bar, requested_at=10)
+
+        order = [engine._pending_restarts.get_nowait()[2] for _ in range(2)]
+        self.assertEqual([bar, foo], order)
+
+    def test_restart_backpressure(self):
+        engine = RestartEngine(self.queue, 10, max_pending=1)
+        foo, bar = MockCgroup("foo"), MockCgroup("bar")
+        engine._handle_restart_requested(foo)
+        engine._handle_restart_requested(bar)
+
+        self.assertEqual(1, engine.pending_restarts())
+        self.assertNotIn(bar, engine._running_restarts)
+
+        # We don't count on bar asking again: we retry once there's room.
+        self.assertTrue(bar.restart_in_flight)
+        self.assertIn(bar, engine._deferred)
+        engine._handle_restart_requested(bar)
+        self.assertEqual(1, len(engine._timers))
+
+        engine._pending_restarts.get_nowait()
+        engine._handle_restart_retry(bar, 123)
+        self.assertIn(bar, engine._running_restarts)
+        self.assertEqual({}, engine._deferred)
+
+    def test_restart_backpressure_still_full(self):
+        engine = RestartEngine(self.queue, 10, max_pending=1)
+        foo, bar = MockCgroup("foo"), MockCgroup("bar")
+        engine._handle_restart_requested(foo)
+        engine._handle_restart_requested(bar)
+
+        engine._handle_restart_retry(bar, 123)
+        self.assertNotIn(bar, engine._running_restarts)
+        self.assertIn(bar, engine._deferred)
+
+    def test_restart_workers(self):
+        engine = RestartEngine(self.queue, 10, workers=2)
+        restarted = queue.Queue()
+
+        def fake_restart(cg):
+            restarted.put(cg)
+            if cg.name() == "bad":
+                raise Exception("oops")
+            self.queue.put(RestartCompleteMessage(cg))
+
+        engine._restart = fake_restart
+        engine.start_workers()
+        self.assertEqual(2, len(engine._worker_threads))
+
+        cgs = [MockCgroup("bad"), MockCgroup("foo"), MockCgroup("bar")]
+        for cg in cgs:
+            engine._handle_restart_requested(cg)
+
+        done = set([restarted.get(timeout=5) for _ in cgs])
+        self.assertEqual(set(cgs), done)
+
+        # Every restart is reported as complete, even failed ones
+        complete = set([self.queue.get(timeout=5).cg for _ in cgs])
+        self.assertEqual(set(cgs), complete)
+
+
+class RestartTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.tmp = tempfile.mkdtemp()
+        self.limits = LimitJournal(os.path.join(self.tmp, "limits.json"))
+        self.headroom = HeadroomBudget(free_memory=lambda: 10**9)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_restart_restores_memory_limit(self):
+        cg = MockCgroup("foo")
+        backend = MockBackend()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits)
+
+        self.assertEqual([1100], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual({}, self.limits.pending())
+        self.assertEqual(0, self.headroom.outstanding)
+        self.assertIsInstance(self.queue.get_nowait(), RestartCompleteMessage)
+
+    def test_restart_failed_restores_memory_limit(self):
+        cg = MockCgroup("foo")
+        restart(self.queue, 10, cg, MockBackend(fail=True), self.headroom,
+                self.limits)
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertIsInstance(self.queue.get_nowait(), RestartCompleteMessage)
+
+    def test_restart_journal_failed(self):
+        # We can't write the journal: the container still gets its headroom,
+        # and we still wait for the restart.
+        def fail(*args):
+            raise IOError(errno.ENOSPC, "No space left on device")
+        self.limits.record = fail
+        self.limits.forget = fail
+
+        cg = MockCgroup("foo")
+        backend = MockBackend()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits)
+        self.assertEqual([1100], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual(0, self.headroom.outstanding)
+        self.assertIsInstance(self.queue.get_nowait(), RestartCompleteMessage)
+
+    def test_restart_policy_headroom(self):
+        cg = MockCgroup("foo")
+        cg.restart_policy = RestartPolicy(headroom_fraction=0.5)
+        backend = MockBackend()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits)
+        self.assertEqual([1500], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+
+    def test_restart_no_headroom(self):
+        cg = MockCgroup("foo")
+        backend = MockBackend()
+        headroom = HeadroomBudget(free_memory=lambda: 0)
+        restart(self.queue, 10, cg, backend, headroom, self.limits)
+        self.assertEqual([1000], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+
+    def test_restart_freeze(self):
+        cg = MockCgroup("foo")
+        cg.usage = 600
+        cg.usage_in_bytes = lambda: cg.usage
+        backend = MockBackend()
+        freezer = MockFreezer()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits,
+                freezer=freezer)
+
+        # We only grant what it needs on top of its (frozen) usage, and thaw
+        # it once it has it.
+        self.assertEqual([("freeze", 1000), ("thaw", 1000)], freezer.calls)
+        self.assertEqual([1000], backend.limits_during_restart)
+
+        cg.usage = 1000
+        freezer = MockFreezer()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits,
+                freezer=freezer)
+        self.assertEqual([("freeze", 1000), ("thaw", 1100)], freezer.calls)
+        self.assertEqual([1000, 1100], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual(0, self.headroom.outstanding)
+
+    def test_restart_freeze_failed(self):
+        # If we couldn't freeze it, we size headroom as usual.
+        cg = MockCgroup("foo")
+        backend = MockBackend()
+        freezer = MockFreezer(frozen=False)
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits,
+                freezer=freezer)
+        self.assertEqual([("freeze", 1000), ("thaw", 1000)], freezer.calls)
+        self.assertEqual([1100], backend.limits_during_restart)
+        self.assertEqual(1000, cg.memory_limit)
+
+    def test_restart_freeze_under_oom(self):
+        # A v1 cgroup under OOM doesn't get frozen, so it has to be
+        # restarted before it gets its headroom, as if we weren't freezing.
+        events = []
+
+        class OrderedBackend(MockBackend):
+            def start_restart(self, cg, grace_period):
+                events.append("start")
+                return MockBackend.start_restart(self, cg, grace_period)
+
+        cg = MockCgroup("foo")
+        cg.is_under_oom = lambda: True
+
+        def set_memory_limit_in_bytes(new_limit):
+            events.append(("limit", new_limit))
+            cg.memory_limit = new_limit
+        cg.set_memory_limit_in_bytes = set_memory_limit_in_bytes
+
+        backend = OrderedBackend()
+        restart(self.queue, 10, cg, backend, self.headroom, self.limits,
+                freezer=CgroupFreezer())
+        self.assertEqual(["start", ("limit", 1100), ("limit", 1000)], events)
+        self.assertEqual([1100], backend.limits_during_restart)
+        self.assertEqual(0, self.headroom.outstanding)
+
+    def test_restart_freeze_start_failed(self):
+        cg = MockCgroup("foo")
+        restart(self.queue, 10, cg, MockBackend(RestartFailed("oops")),
+                self.headroom, self.limits, freezer=MockFreezer(False))
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual({}, self.limits.pending())
+        self.assertEqual(0, self.headroom.outstanding)
+        self.assertIsInstance(self.queue.get_nowait(), RestartCompleteMessage)
+
+    def test_restart_freeze_start_crashed(self):
+        # Not a RestartFailed: this is for the worker to deal with, but we
+        # still give the memory back.
+        cg = MockCgroup("foo")
+        with self.assertRaises(ValueError):
+            restart(self.queue, 10, cg, MockBackend(ValueError("oops")),
+                    self.headroom, self.limits, freezer=MockFreezer(False))
+        self.assertEqual(1000, cg.memory_limit)
+        self.assertEqual({}, self.limits.pending())
+        self.assertEqual(0, self.headroom.outstanding)
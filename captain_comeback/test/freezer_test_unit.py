@@ -0,0 +1,85 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from captain_comeback.cgroup import Cgroup
+from captain_comeback.cgroup_v2 import CgroupV2
+from captain_comeback.restart.freezer import CgroupFreezer, CgroupV2Freezer
+
+
+class CgroupFreezerTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.memory_mount = os.path.join(self.tmp, "memory")
+        self.freezer_mount = os.path.join(self.tmp, "freezer")
+        os.makedirs(os.path.join(self.memory_mount, "docker", "foo"))
+        os.makedirs(os.path.join(self.freezer_mount, "docker", "foo"))
+        self.cg = Cgroup(os.path.join(self.memory_mount, "docker", "foo"))
+        self.freezer = CgroupFreezer(self.memory_mount, self.freezer_mount,
+                                     timeout=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read_state(self):
+        with open(os.path.join(self.freezer_mount, "docker", "foo",
+                               "freezer.state")) as f:
+            return f.read()
+
+    def test_freeze_thaw(self):
+        self.assertTrue(self.freezer.freeze(self.cg))
+        self.assertEqual("FROZEN\n", self.read_state())
+        self.freezer.thaw(self.cg)
+        self.assertEqual("THAWED\n", self.read_state())
+
+    def test_freeze_under_oom(self):
+        # Its tasks wouldn't freeze until they get memory, so don't try.
+        with open(os.path.join(self.cg.path, "memory.oom_control"), "w") as f:
+            f.write("oom_kill_disable 1\nunder_oom 1\n")
+        self.assertFalse(self.freezer.freeze(self.cg))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.freezer_mount, "docker", "foo", "freezer.state")))
+
+    def test_freeze_missing(self):
+        shutil.rmtree(self.freezer_mount)
+        self.assertFalse(self.freezer.freeze(self.cg))
+        # Doesn't raise
+        self.freezer.thaw(self.cg)
+
+
+class StuckCgroupV2Freezer(CgroupV2Freezer):
+    # The kernel never reports the cgroup as frozen.
+    def _write_state(self, cg, frozen):
+        super(StuckCgroupV2Freezer, self)._write_state(cg, frozen)
+        with open(os.path.join(cg.path, "cgroup.events"), "w") as f:
+            f.write("populated 1\nfrozen 0\n")
+
+
+class CgroupV2FreezerTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.cg_path = tempfile.mkdtemp()
+        self.cg = CgroupV2(self.cg_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.cg_path)
+
+    def read_file(self, name):
+        with open(os.path.join(self.cg_path, name)) as f:
+            return f.read()
+
+    def test_freeze_thaw(self):
+        with open(os.path.join(self.cg_path, "cgroup.events"), "w") as f:
+            f.write("populated 1\nfrozen 1\n")
+
+        freezer = CgroupV2Freezer(timeout=0.05)
+        self.assertTrue(freezer.freeze(self.cg))
+        self.assertEqual("1\n", self.read_file("cgroup.freeze"))
+        freezer.thaw(self.cg)
+        self.assertEqual("0\n", self.read_file("cgroup.freeze"))
+
+    def test_freeze_timeout(self):
+        freezer = StuckCgroupV2Freezer(timeout=0.05)
+        self.assertFalse(freezer.freeze(self.cg))
+        self.assertEqual("1\n", self.read_file("cgroup.freeze"))
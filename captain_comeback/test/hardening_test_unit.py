@@ -0,0 +1,55 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from captain_comeback.hardening import (set_oom_score_adj, process_memory,
+                                        MemoryWatch)
+
+
+def write_status(path, rss_kb, locked_kb):
+    with open(path, "w") as f:
+        f.write("Name:\tpython\n")
+        f.write("VmLck:\t{0} kB\n".format(locked_kb))
+        f.write("VmRSS:\t{0} kB\n".format(rss_kb))
+
+
+class HardeningTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.status = os.path.join(self.tmp, "status")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_set_oom_score_adj(self):
+        # We can always set our own score to what it already is
+        with open("/proc/self/oom_score_adj") as f:
+            current = int(f.read())
+        set_oom_score_adj(current)
+        with open("/proc/self/oom_score_adj") as f:
+            self.assertEqual(current, int(f.read()))
+
+    def test_process_memory(self):
+        write_status(self.status, 10, 4)
+        self.assertEqual((10240, 4096), process_memory(self.status))
+
+    def test_process_memory_real(self):
+        rss, _ = process_memory()
+        self.assertGreater(rss, 0)
+
+    def test_memory_watch(self):
+        write_status(self.status, 10, 10)
+        watch = MemoryWatch(self.status)
+        watch.reset()
+        self.assertEqual(0, watch.check())
+
+        write_status(self.status, 12, 12)
+        self.assertEqual(2048, watch.check())
+        self.assertEqual(12288, watch.high_water)
+
+        # Shrinking doesn't move the high water mark
+        write_status(self.status, 11, 11)
+        self.assertEqual(1024, watch.check())
+        self.assertEqual(12288, watch.high_water)
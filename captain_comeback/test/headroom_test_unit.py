@@ -0,0 +1,61 @@
+# coding:utf-8
+import unittest
+
+from captain_comeback.restart.headroom import (HeadroomBudget,
+                                               HEADROOM_POLICY_ALL_OR_NOTHING)
+
+
+class HeadroomTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.free = 1000
+
+    def make_budget(self, **kwargs):
+        return HeadroomBudget(free_memory=lambda: self.free, **kwargs)
+
+    def test_reserve(self):
+        budget = self.make_budget()
+        self.assertEqual(100, budget.reserve(1000))
+        self.assertEqual(100, budget.outstanding)
+        budget.release(100)
+        self.assertEqual(0, budget.outstanding)
+
+    def test_reserve_fraction(self):
+        budget = self.make_budget(fraction=0.25)
+        self.assertEqual(250, budget.reserve(1000))
+
+    def test_reserve_fraction_override(self):
+        budget = self.make_budget(fraction=0.25)
+        self.assertEqual(500, budget.reserve(1000, 0.5))
+        self.assertEqual(0, budget.reserve(1000, 0))
+
+    def test_reserve_usage(self):
+        budget = self.make_budget()
+        self.assertEqual(100, budget.reserve(1000, usage=1000))
+        self.assertEqual(45, budget.reserve(1000, usage=950))
+        self.assertEqual(0, budget.reserve(1000, usage=500))
+        self.assertEqual(145, budget.outstanding)
+
+    def test_concurrent_reservations_share_budget(self):
+        budget = self.make_budget(fraction=0.5)
+        self.assertEqual(500, budget.reserve(1000))
+        self.assertEqual(500, budget.reserve(1000))
+        self.assertEqual(0, budget.reserve(1000))
+
+        budget.release(500)
+        self.assertEqual(500, budget.reserve(1000))
+
+    def test_reserve_all_or_nothing(self):
+        budget = self.make_budget(fraction=0.5,
+                                  policy=HEADROOM_POLICY_ALL_OR_NOTHING)
+        self.assertEqual(500, budget.reserve(1000))
+        self.assertEqual(0, budget.reserve(1000))
+
+    def test_reserve_min_free(self):
+        budget = self.make_budget(min_free=950)
+        self.assertEqual(50, budget.reserve(1000))
+
+    def test_reserve_no_free_memory(self):
+        self.free = 0
+        budget = self.make_budget()
+        self.assertEqual(0, budget.reserve(1000))
+        self.assertEqual(0, budget.outstanding)
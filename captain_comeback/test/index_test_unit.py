@@ -0,0 +1,519 @@
+# coding:utf-8
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from six.moves import queue
+
+import linuxfd
+
+from captain_comeback.cgroup import Cgroup
+from captain_comeback.index import CgroupIndex, Inotify
+from captain_comeback.restart.docker_events import (DockerEventStream,
+                                                    EVENT_START, EVENT_DIE,
+                                                    EVENT_DESTROY,
+                                                    EVENT_RESTART,
+                                                    EVENT_RECONNECT)
+from captain_comeback.restart.policy import RestartPolicy, PolicyResolver
+
+
+def write_memory_limit(path, memory_limit):
+    with open(os.path.join(path, "memory.limit_in_bytes"), "w") as f:
+        f.write("{0}\n".format(memory_limit))
+
+
+def write_oom_control(path, under_oom):
+    with open(os.path.join(path, "memory.oom_control"), "w") as f:
+        f.write("oom_kill_disable 1\nunder_oom {0}\n".format(under_oom))
+
+
+def write_procs(path, pids):
+    with open(os.path.join(path, "cgroup.procs"), "w") as f:
+        f.write("".join("{0}\n".format(pid) for pid in pids))
+
+
+def create_mock_cg(parent, name):
+    path = os.path.join(parent, name)
+    os.mkdir(path)
+
+    with open(os.path.join(path, "memory.oom_control"), "w") as f:
+        f.write("oom_kill_disable 0\nunder_oom 0\n")
+
+    with open(os.path.join(path, "memory.usage_in_bytes"), "w") as f:
+        f.write("0\n")
+
+    write_memory_limit(path, 9223372036854771712)
+
+    return path
+
+
+class IndexTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root_cg = tempfile.mkdtemp()
+        self.queue = queue.Queue()
+        self.index = CgroupIndex(self.root_cg, self.queue)
+        self.index.open()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root_cg)
+
+    def test_sync_registers_existing(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+        self.assertIn(path, self.index._path_hash)
+
+    def test_sync_ignores_files(self):
+        open(os.path.join(self.root_cg, "tasks"), "w").close()
+        self.index.sync()
+        self.assertEqual(0, len(self.index._path_hash))
+
+    def test_sync_does_not_rescan_every_time(self):
+        self.index.sync()
+        path = create_mock_cg(self.root_cg, "foo")
+
+        # Don't process the inotify event; the sync alone shouldn't find it.
+        self.index.sync()
+        self.assertNotIn(path, self.index._path_hash)
+
+        self.index.rescan()
+        self.assertIn(path, self.index._path_hash)
+
+    def test_register_failed(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        os.unlink(os.path.join(path, "memory.limit_in_bytes"))
+        cg = Cgroup(path, usage_thresholds=[0.5])
+
+        with self.assertRaises(EnvironmentError):
+            self.index.register(cg)
+        self.assertEqual({}, self.index._path_hash)
+        self.assertEqual({}, self.index._efd_hash)
+        self.assertIsNone(cg.oom_control)
+
+        # It's not half registered, so the next sync can try again
+        write_memory_limit(path, 1024)
+        self.index.sync()
+        self.assertIn(path, self.index._path_hash)
+
+    def test_inotify_registers_new(self):
+        self.index.sync()
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.poll(1)
+        self.assertIn(path, self.index._path_hash)
+        self.assertEqual(1, len(self.index._efd_hash))
+
+    def test_inotify_deregisters_deleted(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+
+        shutil.rmtree(path)
+        self.index.poll(1)
+        self.assertNotIn(path, self.index._path_hash)
+        self.assertEqual(0, len(self.index._efd_hash))
+
+    def test_inotify_ignores_files(self):
+        self.index.sync()
+        open(os.path.join(self.root_cg, "tasks"), "w").close()
+        self.index.poll(0.1)
+        self.assertEqual(0, len(self.index._path_hash))
+
+    def test_inotify_overflow_rescans(self):
+        self.index.sync()
+        path = create_mock_cg(self.root_cg, "foo")
+
+        # The kernel dropped the event for the new cgroup.
+        read = self.index.inotify.read
+
+        def overflowing_read(size):
+            read(size)
+            return ((None, "", linuxfd.IN_Q_OVERFLOW, 0),)
+
+        self.index.inotify.read = overflowing_read
+        self.index.poll(1)
+        self.assertNotIn(path, self.index._path_hash)
+
+        self.index.sync()
+        self.assertIn(path, self.index._path_hash)
+
+    def test_sync_slice_quota(self):
+        for i in range(5):
+            create_mock_cg(self.root_cg, "cg-{0}".format(i))
+        self.index.rescan()
+
+        self.index.begin_sync()
+        self.assertEqual(5, self.index.sync_pending())
+        self.assertEqual(3, self.index.sync_slice(2, 10))
+        self.assertEqual(1, self.index.sync_slice(2, 10))
+        self.assertEqual(0, self.index.sync_slice(2, 10))
+
+    def test_sync_slice_budget(self):
+        for i in range(5):
+            create_mock_cg(self.root_cg, "cg-{0}".format(i))
+        self.index.rescan()
+
+        # With no budget, we still make progress one cgroup at a time
+        self.index.begin_sync()
+        self.assertEqual(4, self.index.sync_slice(5, 0))
+
+    def test_sync_round_carries_over(self):
+        for i in range(3):
+            create_mock_cg(self.root_cg, "cg-{0}".format(i))
+        self.index.rescan()
+
+        self.index.begin_sync()
+        self.index.sync_slice(2, 10)
+
+        # The previous round isn't done, so this shouldn't start a new one
+        self.index.begin_sync()
+        self.assertEqual(1, self.index.sync_pending())
+
+        self.index.sync_slice(1, 10)
+        self.index.begin_sync()
+        self.assertEqual(3, self.index.sync_pending())
+
+    def test_sync_round_overrun_rescans(self):
+        for i in range(3):
+            create_mock_cg(self.root_cg, "cg-{0}".format(i))
+        self.index.rescan()
+        self.index.begin_sync()
+
+        # Rescans are due, even though the round isn't over
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index._next_rescan = 0
+        self.index.begin_sync()
+        self.assertIn(path, self.index._path_hash)
+        self.assertEqual(3, self.index.sync_pending())
+
+    def test_sync_slice_skips_removed(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.rescan()
+        self.index.begin_sync()
+
+        self.index.remove(self.index._path_hash[path])
+        self.assertEqual(0, self.index.sync_slice(1, 10))
+
+    def test_sync_rearms_thresholds(self):
+        self.index.usage_thresholds = [0.5]
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+
+        cg = self.index._path_hash[path]
+        self.assertIsNone(cg.threshold_event)
+        self.assertEqual(1, len(self.index._efd_hash))
+
+        write_memory_limit(path, 1024)
+        self.index.sync()
+        self.assertIsNotNone(cg.threshold_event)
+        self.assertIn(cg.threshold_event.fileno(), self.index._efd_hash)
+        self.assertEqual(2, len(self.index._efd_hash))
+
+    def test_poll_dispatches_once(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+        cg = self.index._path_hash[path]
+
+        write_oom_control(path, 1)
+        cg.event.write(1)
+        cg.event.write(1)
+        self.index.poll(1)
+
+        self.assertIs(cg, self.queue.get_nowait().cg)
+        self.assertTrue(self.queue.empty())
+
+    def test_poll_restart_in_flight(self):
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+        cg = self.index._path_hash[path]
+
+        write_oom_control(path, 1)
+        cg.event.write(1)
+        self.index.poll(1)
+        self.queue.get_nowait()
+
+        # Still under OOM, but we've already asked for a restart
+        cg.event.write(1)
+        self.index.poll(1)
+        self.index.sync()
+        self.assertTrue(self.queue.empty())
+
+        # The restart is over, but the cgroup is still under OOM
+        cg.restart_in_flight = False
+        cg.event.write(1)
+        self.index.poll(1)
+        self.assertIs(cg, self.queue.get_nowait().cg)
+
+
+class InotifyTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.inotify = Inotify(nonBlocking=True, closeOnExec=True)
+        self.inotify.add(self.root, linuxfd.IN_CREATE)
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.root)
+
+    def test_read(self):
+        os.mkdir(os.path.join(self.root, "foo"))
+        events = self.inotify.read(1024)
+        self.assertEqual([(self.root, "foo")], [e[:2] for e in events])
+
+    def test_read_overflow(self):
+        read = linuxfd.inotify_c.inotify_read
+        self.addCleanup(setattr, linuxfd.inotify_c, "inotify_read", read)
+        linuxfd.inotify_c.inotify_read = lambda fd, size: [
+            (-1, linuxfd.IN_Q_OVERFLOW, 0, "")]
+        self.assertEqual(((None, "", linuxfd.IN_Q_OVERFLOW, 0),),
+                         self.inotify.read(1024))
+
+    def test_read_unknown_watch(self):
+        read = linuxfd.inotify_c.inotify_read
+        self.addCleanup(setattr, linuxfd.inotify_c, "inotify_read", read)
+        linuxfd.inotify_c.inotify_read = lambda fd, size: [
+            (12345, linuxfd.IN_CREATE, 0, "foo")]
+        with self.assertRaises(KeyError):
+            self.inotify.read(1024)
+
+
+class IndexNestedTestUnit(unittest.TestCase):
+    # Laid out like Kubernetes: <qos>/<pod>/<container>
+    def setUp(self):
+        self.root_cg = tempfile.mkdtemp()
+        self.queue = queue.Queue()
+        self.index = CgroupIndex(self.root_cg, self.queue, max_depth=3)
+        self.index.open()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root_cg)
+
+    def make_pod(self, qos, pod):
+        path = os.path.join(self.root_cg, qos, pod)
+        os.makedirs(path)
+        return path
+
+    def registered(self):
+        return set(os.path.relpath(p, self.root_cg)
+                   for p in self.index._path_hash)
+
+    def test_registers_containers(self):
+        pod = self.make_pod("burstable", "pod1")
+        write_procs(create_mock_cg(pod, "app"), [123])
+        write_procs(create_mock_cg(pod, "pause"), [456])
+
+        self.index.sync()
+        self.assertEqual(set(["burstable/pod1/app", "burstable/pod1/pause"]),
+                         self.registered())
+
+    def test_ignores_too_deep(self):
+        pod = self.make_pod("burstable", "pod1")
+        app = create_mock_cg(pod, "app")
+        write_procs(create_mock_cg(app, "nested"), [123])
+
+        self.index.sync()
+        self.assertEqual(set(), self.registered())
+
+    def test_waits_for_tasks(self):
+        pod = self.make_pod("burstable", "pod1")
+        app = create_mock_cg(pod, "app")
+
+        self.index.sync()
+        self.assertEqual(set(), self.registered())
+
+        write_procs(app, [123])
+        self.index.sync()
+        self.assertEqual(set(["burstable/pod1/app"]), self.registered())
+
+    def test_stops_checking_intermediate_levels(self):
+        qos = os.path.join(self.root_cg, "guaranteed")
+        os.makedirs(qos)
+        ctr = create_mock_cg(qos, "ctr")
+        pod = self.make_pod("burstable", "pod1")
+        app = create_mock_cg(pod, "app")
+
+        # We keep checking on the deepest level, but only for a while on
+        # the others.
+        self.index.sync()
+        self.assertIsNone(self.index._unpopulated[app])
+        for path in [qos, ctr, os.path.dirname(pod), pod]:
+            self.assertIsNotNone(self.index._unpopulated[path])
+            self.index._unpopulated[path] = 0
+
+        self.index.sync()
+        self.assertEqual([app], list(self.index._unpopulated))
+
+        write_procs(ctr, [123])
+        self.index.sync()
+        self.assertEqual(set(), self.registered())
+
+        # Rescans still pick them up
+        self.index.rescan()
+        self.assertEqual(set(["guaranteed/ctr"]), self.registered())
+        self.assertNotIn(ctr, self.index._settled)
+
+    def test_inotify(self):
+        self.index.sync()
+
+        # Each level is watched as it appears
+        pod = self.make_pod("guaranteed", "pod1")
+        self.index.poll(1)
+        self.index.poll(0.1)
+        self.assertIn(pod, self.index._dirs)
+
+        app = create_mock_cg(pod, "app")
+        write_procs(app, [123])
+        self.index.poll(1)
+        self.index.sync()
+        self.assertEqual(set(["guaranteed/pod1/app"]), self.registered())
+
+        shutil.rmtree(os.path.join(self.root_cg, "guaranteed"))
+        self.index.poll(1)
+        self.assertEqual(set(), self.registered())
+        self.assertEqual([self.root_cg], list(self.index._dirs))
+
+    def test_multiple_roots(self):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        write_procs(create_mock_cg(other, "foo"), [123])
+
+        index = CgroupIndex([self.root_cg, other], self.queue)
+        index.open()
+        self.addCleanup(index.close)
+
+        create_mock_cg(self.root_cg, "bar")
+        index.sync()
+        self.assertEqual(set([os.path.join(other, "foo"),
+                              os.path.join(self.root_cg, "bar")]),
+                         set(index._path_hash))
+
+
+class IndexContainerEventsTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root_cg = tempfile.mkdtemp()
+        self.queue = queue.Queue()
+        self.events = DockerEventStream()
+        self.index = CgroupIndex(self.root_cg, self.queue,
+                                 container_events=self.events)
+
+    def tearDown(self):
+        self.index.close()
+        self.events.close()
+        shutil.rmtree(self.root_cg)
+
+    def test_start_registers(self):
+        # Created before we start watching, so only the event tells us
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.open()
+
+        self.events.push(EVENT_START, "foo")
+        self.index.poll(1)
+        self.assertIn(path, self.index._path_hash)
+
+    def test_start_ignores_missing(self):
+        self.index.open()
+        self.events.push(EVENT_START, "foo")
+        self.index.poll(1)
+        self.assertEqual({}, self.index._path_hash)
+
+    def test_die_deregisters(self):
+        self.index.open()
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+
+        # The cgroup is still around, but the container is gone
+        self.events.push(EVENT_DIE, "foo")
+        self.index.poll(1)
+        self.assertNotIn(path, self.index._path_hash)
+        self.assertEqual({}, self.index._efd_hash)
+
+    def test_die_while_restarting(self):
+        # Our own restart stops the container, but we still need the cgroup
+        # until it's done. Destroying the container is another matter.
+        self.index.open()
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+        self.index._path_hash[path].restart_in_flight = True
+
+        self.events.push(EVENT_DIE, "foo")
+        self.index.poll(1)
+        self.assertIn(path, self.index._path_hash)
+
+        self.events.push(EVENT_DESTROY, "foo")
+        self.index.poll(1)
+        self.assertNotIn(path, self.index._path_hash)
+
+    def test_restart(self):
+        self.index.open()
+        create_mock_cg(self.root_cg, "foo")
+        self.index.sync()
+
+        self.events.push(EVENT_RESTART, "foo")
+        self.index.poll(1)
+        self.assertEqual("foo", self.queue.get_nowait().name)
+
+    def test_restart_ignores_untracked(self):
+        self.index.open()
+        self.events.push(EVENT_RESTART, "foo")
+        self.index.poll(1)
+        self.assertTrue(self.queue.empty())
+
+    def test_reconnect_rescans(self):
+        self.index.open()
+        self.index.sync()
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.poll(1)
+        self.index.remove(self.index._path_hash[path])
+
+        self.events.push(EVENT_RECONNECT, None)
+        self.index.poll(1)
+        self.index.sync()
+        self.assertIn(path, self.index._path_hash)
+
+
+class IndexPolicyTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root_cg = tempfile.mkdtemp()
+        self.policy_file = os.path.join(self.root_cg, "policies.json")
+        self.queue = queue.Queue()
+        self.index = CgroupIndex(self.root_cg, self.queue,
+                                 policies=PolicyResolver(self.policy_file))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root_cg)
+
+    def write_policies(self, policies, mtime):
+        with open(self.policy_file, "w") as f:
+            json.dump(policies, f)
+        os.utime(self.policy_file, (mtime, mtime))
+
+    def test_register_resolves(self):
+        self.write_policies([{"match": "foo", "priority": 1}], 1000)
+        foo = create_mock_cg(self.root_cg, "foo")
+        bar = create_mock_cg(self.root_cg, "bar")
+        self.index.open()
+        self.index.sync()
+
+        self.assertEqual(RestartPolicy(priority=1),
+                         self.index._path_hash[foo].restart_policy)
+        self.assertEqual(RestartPolicy(),
+                         self.index._path_hash[bar].restart_policy)
+
+    def test_sync_reloads(self):
+        self.write_policies([], 1000)
+        path = create_mock_cg(self.root_cg, "foo")
+        self.index.open()
+        self.index.sync()
+
+        # We disabled the OOM killer for this one
+        write_oom_control(path, 0)
+
+        self.write_policies([{"match": "foo", "never_restart": True}], 2000)
+        self.index.sync()
+        cg = self.index._path_hash[path]
+        self.assertTrue(cg.restart_policy.never_restart)
+
+        # And now give it back to the OOM killer
+        with open(os.path.join(path, "memory.oom_control")) as f:
+            self.assertEqual("0\n", f.read())
@@ -0,0 +1,61 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from captain_comeback.cgroup import Cgroup
+from captain_comeback.restart.limits import LimitJournal
+
+
+class LimitsTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tmp, "state", "limits.json")
+        self.cg = Cgroup(os.path.join(self.tmp, "cg"))
+        os.mkdir(self.cg.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_memory_limit(self, memory_limit):
+        self.cg.set_memory_limit_in_bytes(memory_limit)
+
+    def test_record_persists(self):
+        LimitJournal(self.journal_path).record(self.cg, 1000, 1100)
+        journal = LimitJournal(self.journal_path)
+        self.assertEqual({self.cg.path: {"original": 1000, "raised_to": 1100}},
+                         journal.pending())
+
+        journal.forget(self.cg)
+        self.assertEqual({}, LimitJournal(self.journal_path).pending())
+
+    def test_restore_all(self):
+        self.write_memory_limit(1100)
+        LimitJournal(self.journal_path).record(self.cg, 1000, 1100)
+
+        journal = LimitJournal(self.journal_path)
+        journal.restore_all(Cgroup)
+        self.assertEqual(1000, self.cg.memory_limit_in_bytes())
+        self.assertEqual({}, journal.pending())
+
+    def test_restore_all_limit_changed(self):
+        self.write_memory_limit(2000)
+        journal = LimitJournal(self.journal_path)
+        journal.record(self.cg, 1000, 1100)
+        journal.restore_all(Cgroup)
+        self.assertEqual(2000, self.cg.memory_limit_in_bytes())
+        self.assertEqual({}, journal.pending())
+
+    def test_restore_all_cgroup_gone(self):
+        journal = LimitJournal(self.journal_path)
+        journal.record(self.cg, 1000, 1100)
+        os.rmdir(self.cg.path)
+        journal.restore_all(Cgroup)
+        self.assertEqual({}, journal.pending())
+
+    def test_corrupt_journal(self):
+        os.mkdir(os.path.dirname(self.journal_path))
+        with open(self.journal_path, "w") as f:
+            f.write("{")
+        self.assertEqual({}, LimitJournal(self.journal_path).pending())
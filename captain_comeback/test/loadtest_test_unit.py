@@ -0,0 +1,63 @@
+# coding:utf-8
+import random
+import unittest
+
+from captain_comeback.loadtest import (arrivals, run_storm, StubBackend,
+                                       PATTERN_BURST, PATTERN_POISSON,
+                                       PATTERN_REPEAT_OFFENDER)
+from captain_comeback.restart.backoff import RestartBackoff
+
+
+class LoadTestTestUnit(unittest.TestCase):
+    def test_arrivals_burst(self):
+        schedule = arrivals(PATTERN_BURST, 5, 3, 10, 1, 1, random.Random(0))
+        self.assertEqual([(0, 0), (0, 1), (0, 2), (0, 0), (0, 1)], schedule)
+
+    def test_arrivals_poisson(self):
+        schedule = arrivals(PATTERN_POISSON, 100, 10, 100, 1, 1,
+                            random.Random(0))
+        offsets = [offset for offset, _ in schedule]
+        self.assertEqual(sorted(offsets), offsets)
+        self.assertTrue(all(0 <= t < 10 for _, t in schedule))
+
+    def test_arrivals_repeat_offender(self):
+        schedule = arrivals(PATTERN_REPEAT_OFFENDER, 100, 10, 100, 2, 1,
+                            random.Random(0))
+        self.assertEqual(set([0, 1]), set(t for _, t in schedule))
+
+    def test_storm(self):
+        backend = StubBackend(0.01, failure_rate=0.5, rng=random.Random(0))
+        schedule = [(0, 0), (0, 0), (0, 1), (0, 2)]
+        result = run_storm(schedule, 3, backend, workers=2, timeout=10)
+
+        self.assertEqual(4, result["requests"])
+        self.assertEqual(3, result["restarts"])
+        self.assertEqual(3, result["restarts_completed"])
+        self.assertEqual(1, result["deduplicated"])
+        self.assertEqual(0, result["deferred"])
+        self.assertEqual(2, result["peak_concurrent_restarts"])
+        self.assertEqual(0, result["headroom_outstanding_bytes"])
+
+    def test_storm_backpressure(self):
+        backend = StubBackend(0.01)
+        schedule = [(0, i) for i in range(10)]
+        result = run_storm(schedule, 10, backend, workers=1, max_pending=2,
+                           timeout=10)
+        # Requests we couldn't take right away are retried, not dropped.
+        self.assertGreater(result["deferred"], 0)
+        self.assertEqual(10, result["restarts"])
+        self.assertEqual(10, result["restarts_completed"])
+
+    def test_storm_backoff(self):
+        backend = StubBackend(0.01)
+        schedule = [(0, 0), (0.2, 0)]
+        result = run_storm(schedule, 1, backend, workers=1, timeout=10,
+                           backoff=RestartBackoff(base=0.5))
+
+        # The storm isn't over until the retry is done.
+        self.assertEqual(2, result["requests"])
+        self.assertEqual(1, result["backed_off"])
+        self.assertEqual(1, result["retries"])
+        self.assertEqual(0, result["deferred"])
+        self.assertEqual(2, result["restarts"])
+        self.assertEqual(2, result["restarts_completed"])
@@ -0,0 +1,72 @@
+# coding:utf-8
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from captain_comeback.metrics import (Counter, Gauge, Histogram, Registry,
+                                      start_metrics_server)
+
+
+class MetricsTestUnit(unittest.TestCase):
+    def test_counter(self):
+        c = Counter("foo_total", "Foos")
+        c.inc()
+        c.inc(2)
+        self.assertEqual(["# HELP foo_total Foos",
+                          "# TYPE foo_total counter",
+                          "foo_total 3.0"], c.render())
+
+    def test_gauge(self):
+        g = Gauge("foo", "Foo")
+        g.set(4)
+        self.assertEqual("foo 4.0", g.render()[-1])
+
+    def test_histogram(self):
+        h = Histogram("foo_seconds", "Foo", label="phase", buckets=[1, 10])
+        h.observe(0.5, "a")
+        h.observe(1, "a")
+        h.observe(100, "a")
+        self.assertEqual([
+            "# HELP foo_seconds Foo",
+            "# TYPE foo_seconds histogram",
+            'foo_seconds_bucket{phase="a",le="1.0"} 2',
+            'foo_seconds_bucket{phase="a",le="10.0"} 2',
+            'foo_seconds_bucket{phase="a",le="+Inf"} 3',
+            'foo_seconds_sum{phase="a"} 101.5',
+            'foo_seconds_count{phase="a"} 3',
+        ], h.render())
+
+    def test_histogram_no_label(self):
+        h = Histogram("foo_seconds", "Foo", buckets=[1])
+        h.observe(2)
+        self.assertIn('foo_seconds_bucket{le="+Inf"} 1', h.render())
+        self.assertIn("foo_seconds_count 1", h.render())
+
+    def test_server(self):
+        registry = Registry()
+        registry.register(Counter("foo_total", "Foos")).inc()
+
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "metrics.sock")
+        server = start_metrics_server("unix:{0}".format(path), registry)
+
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmp)
+
+        self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+        self.assertIn(b"\nfoo_total 1.0\n", response)
@@ -0,0 +1,55 @@
+# coding:utf-8
+from captain_comeback.restart.backends import RestartFailed
+
+
+# Test doubles shared by the unit tests. Each test only pokes at the bits
+# it cares about, so these carry the union of what the tests need.
+class MockCgroup(object):
+    def __init__(self, name, memory_limit=1000):
+        self._name = name
+        self.path = "/mock/{0}".format(name)
+        self.memory_limit = memory_limit
+        self.restart_in_flight = False
+        self.quarantined_until = 0
+
+    def name(self):
+        return self._name
+
+    def pids(self):
+        return []
+
+    def procs(self):
+        return []
+
+    def memory_limit_in_bytes(self):
+        return self.memory_limit
+
+    def set_memory_limit_in_bytes(self, new_limit):
+        self.memory_limit = new_limit
+
+
+class MockRestart(object):
+    def __init__(self, backend, cg):
+        self.backend = backend
+        self.cg = cg
+
+    def wait(self):
+        self.backend.limits_during_restart.append(self.cg.memory_limit)
+        if self.backend.fail:
+            raise RestartFailed("oops")
+
+
+class MockBackend(object):
+    def __init__(self, fail_start=None, fail=False):
+        self.fail = fail
+        self.fail_start = fail_start
+        self.restarts = []
+        self.grace_periods = []
+        self.limits_during_restart = []
+
+    def start_restart(self, cg, grace_period):
+        self.restarts.append(cg.name())
+        self.grace_periods.append(grace_period)
+        if self.fail_start:
+            raise self.fail_start
+        return MockRestart(self, cg)
@@ -0,0 +1,158 @@
+# coding:utf-8
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from captain_comeback.restart.docker_api import DockerError
+from captain_comeback.restart.policy import (RestartPolicy, PolicyResolver,
+                                             DEFAULT_POLICY, policy_of,
+                                             parse_fields, label_fields,
+                                             load_policy_file)
+from captain_comeback.test.mocks import MockCgroup
+
+
+class FakeDockerClient(object):
+    def __init__(self, containers):
+        self.containers = containers
+        self.inspected = []
+
+    def inspect(self, container, _timeout=None):
+        self.inspected.append(container)
+        info = self.containers.get(container)
+        if info is None:
+            raise DockerError(404, "no such container")
+        if isinstance(info, Exception):
+            raise info
+        return info
+
+
+def container_info(name, labels):
+    return {"Name": "/" + name, "Config": {"Labels": labels}}
+
+
+class PolicyTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.policy_file = os.path.join(self.tmp, "policies.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_policies(self, policies, mtime=None):
+        with open(self.policy_file, "w") as f:
+            json.dump(policies, f)
+        if mtime is not None:
+            os.utime(self.policy_file, (mtime, mtime))
+
+    def test_parse_fields(self):
+        fields = parse_fields({"grace_period": "3", "priority": 5,
+                               "headroom_fraction": -1, "nope": 1,
+                               "never_restart": "yes"}, "test")
+        self.assertEqual({"grace_period": 3, "priority": 5,
+                          "never_restart": True}, fields)
+
+    def test_label_fields(self):
+        fields = label_fields({"captain-comeback.grace-period": "3",
+                               "captain-comeback.never-restart": "false",
+                               "captain-comeback.backend": "signal",
+                               "com.example.other": "1"}, "test")
+        self.assertEqual({"grace_period": 3, "never_restart": False,
+                          "backend": "signal"}, fields)
+
+    def test_policy_of(self):
+        cg = MockCgroup("foo")
+        self.assertIs(DEFAULT_POLICY, policy_of(cg))
+        cg.restart_policy = RestartPolicy(priority=1)
+        self.assertEqual(1, policy_of(cg).priority)
+
+    def test_load_policy_file(self):
+        self.write_policies([{"match": "web-*", "grace_period": 3},
+                             {"grace_period": 1}])
+        self.assertEqual([("web-*", {"grace_period": 3})],
+                         load_policy_file(self.policy_file))
+
+    def test_resolve_file(self):
+        self.write_policies([{"match": "web-*", "grace_period": 3},
+                             {"match": "*", "priority": 1}])
+        resolver = PolicyResolver(self.policy_file)
+        self.assertTrue(resolver.refresh())
+
+        # The first match wins
+        self.assertEqual(RestartPolicy(grace_period=3),
+                         resolver.resolve(MockCgroup("web-1")))
+        self.assertEqual(RestartPolicy(priority=1),
+                         resolver.resolve(MockCgroup("db-1")))
+
+    def test_resolve_labels(self):
+        self.write_policies([{"match": "web-*", "grace_period": 3,
+                              "priority": 2}])
+        client = FakeDockerClient({"abc": container_info("web-1", {
+            "captain-comeback.grace-period": "1"})})
+        resolver = PolicyResolver(self.policy_file, client)
+        resolver.refresh()
+
+        # Files match Docker names too, and labels win.
+        self.assertEqual(RestartPolicy(grace_period=1, priority=2),
+                         resolver.resolve(MockCgroup("abc")))
+
+    def test_resolve_caches_metadata(self):
+        client = FakeDockerClient({"abc": container_info("web-1", {})})
+        resolver = PolicyResolver(client=client)
+
+        for name in ["abc", "abc", "def", "def"]:
+            self.assertEqual(DEFAULT_POLICY,
+                             resolver.resolve(MockCgroup(name)))
+        self.assertEqual(["abc", "def"], client.inspected)
+
+        resolver.forget(MockCgroup("abc"))
+        resolver.resolve(MockCgroup("abc"))
+        self.assertEqual(["abc", "def", "abc"], client.inspected)
+
+    def test_resolve_retries_transient_failures(self):
+        now = [1000]
+        client = FakeDockerClient({"abc": IOError("timed out"),
+                                   "def": DockerError(500, "oops")})
+        resolver = PolicyResolver(client=client, retry_interval=10,
+                                  clock=lambda: now[0])
+        self.assertFalse(resolver.refresh())
+
+        resolver.resolve(MockCgroup("abc"))
+        self.assertTrue(resolver.refresh())
+
+        # We don't ask again right away, even for other containers
+        resolver.resolve(MockCgroup("abc"))
+        resolver.resolve(MockCgroup("def"))
+        self.assertEqual(["abc"], client.inspected)
+
+        now[0] += 10
+        client.containers["abc"] = container_info("web-1", {
+            "captain-comeback.never-restart": "true"})
+        self.assertTrue(resolver.resolve(MockCgroup("abc")).never_restart)
+        resolver.resolve(MockCgroup("def"))
+        self.assertEqual(["abc", "abc", "def"], client.inspected)
+
+        now[0] += 10
+        resolver.forget(MockCgroup("def"))
+        self.assertFalse(resolver.refresh())
+
+    def test_refresh(self):
+        resolver = PolicyResolver(self.policy_file)
+        self.assertFalse(resolver.refresh())
+
+        self.write_policies([{"match": "*", "priority": 1}], mtime=1000)
+        self.assertTrue(resolver.refresh())
+        self.assertFalse(resolver.refresh())
+        self.assertEqual(1, resolver.resolve(MockCgroup("foo")).priority)
+
+        # Broken files don't replace what we had
+        with open(self.policy_file, "w") as f:
+            f.write("nope")
+        os.utime(self.policy_file, (2000, 2000))
+        self.assertFalse(resolver.refresh())
+        self.assertEqual(1, resolver.resolve(MockCgroup("foo")).priority)
+
+        os.unlink(self.policy_file)
+        self.assertTrue(resolver.refresh())
+        self.assertEqual(DEFAULT_POLICY, resolver.resolve(MockCgroup("foo")))
@@ -0,0 +1,116 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from six.moves import queue
+
+from captain_comeback.cgroup import Cgroup
+from captain_comeback.cli import start_shards
+from captain_comeback.index import CgroupIndex
+from captain_comeback.restart.messages import (RestartRequestedMessage,
+                                               ContainerRestartedMessage,
+                                               MemoryPressureMessage)
+from captain_comeback.restart.policy import RestartPolicy
+from captain_comeback.shard import (shard_of, encode_message, Coordinator,
+                                    MESSAGE_RESTART)
+from captain_comeback.test.index_test_unit import (create_mock_cg,
+                                                   write_oom_control)
+
+
+class ShardTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.root_cg = tempfile.mkdtemp()
+        self.job_queue = queue.Queue()
+        self.upstream = queue.Queue()
+        self.downstreams = [queue.Queue(), queue.Queue()]
+        self.coordinator = Coordinator(self.job_queue, Cgroup, self.upstream,
+                                       self.downstreams)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_cg)
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of("foo", 7), shard_of(u"foo", 7))
+        shards = set(shard_of("cg-{0}".format(i), 4) for i in range(100))
+        self.assertEqual(set(range(4)), shards)
+
+    def test_index_shard(self):
+        names = ["cg-{0}".format(i) for i in range(10)]
+        for name in names:
+            create_mock_cg(self.root_cg, name)
+
+        index = CgroupIndex(self.root_cg, self.job_queue, shard=(1, 3))
+        index.open()
+        index.sync()
+        registered = set(os.path.basename(p) for p in index._path_hash)
+        index.close()
+
+        self.assertEqual(set(n for n in names if shard_of(n, 3) == 1),
+                         registered)
+
+    def test_coordinator_restart(self):
+        path = os.path.join(self.root_cg, "foo")
+        policy = RestartPolicy(priority=5)
+        msg = self.coordinator.decode_message(
+            1, (MESSAGE_RESTART, path, 123, policy))
+
+        self.assertIsInstance(msg, RestartRequestedMessage)
+        self.assertEqual(123, msg.created_at)
+        self.assertEqual("foo", msg.cg.name())
+        self.assertTrue(msg.cg.restart_in_flight)
+        self.assertEqual(policy, msg.cg.restart_policy)
+
+        # We get the same cgroup while the restart is in flight
+        again = self.coordinator.decode_message(
+            1, (MESSAGE_RESTART, path, 124, policy))
+        self.assertIs(msg.cg, again.cg)
+
+        # Releasing tells the shard, and forgets the cgroup
+        msg.cg.restart_in_flight = False
+        self.assertEqual((path, 0), self.downstreams[1].get_nowait())
+        self.assertTrue(self.downstreams[0].empty())
+        self.assertEqual({}, self.coordinator._proxies)
+
+    def test_coordinator_restarted(self):
+        payload = encode_message(ContainerRestartedMessage("foo"))
+        msg = self.coordinator.decode_message(0, payload)
+
+        self.assertIsInstance(msg, ContainerRestartedMessage)
+        self.assertEqual("foo", msg.name)
+        self.assertEqual({}, self.coordinator._proxies)
+
+    def test_coordinator_pressure(self):
+        path = os.path.join(self.root_cg, "foo")
+        cg = Cgroup(path)
+        cg.restart_policy = RestartPolicy(never_restart=True)
+        payload = encode_message(MemoryPressureMessage(cg, "low"))
+        msg = self.coordinator.decode_message(0, payload)
+
+        self.assertIsInstance(msg, MemoryPressureMessage)
+        self.assertEqual("low", msg.level)
+        self.assertTrue(msg.cg.restart_policy.never_restart)
+        self.assertFalse(msg.cg.restart_in_flight)
+        self.assertEqual({}, self.coordinator._proxies)
+
+    def test_shards(self):
+        paths = set()
+        for i in range(6):
+            path = create_mock_cg(self.root_cg, "cg-{0}".format(i))
+            write_oom_control(path, 1)
+            paths.add(path)
+
+        upstream, downstreams, processes = start_shards(
+            2, [self.root_cg], Cgroup, 60, None, None, 60, 0, False, False,
+            None, 1, None, False)
+
+        try:
+            messages = [upstream.get(timeout=10) for _ in paths]
+            self.assertEqual(paths, set(p[1] for _, p in messages))
+            for shard, payload in messages:
+                self.assertEqual(shard, shard_of(os.path.basename(payload[1]),
+                                                 2))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
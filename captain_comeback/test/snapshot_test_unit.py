@@ -0,0 +1,66 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from captain_comeback.restart.snapshot import TaskSnapshotter, PAGE_SIZE
+
+
+class SnapshotTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_root)
+
+    def make_task(self, pid, rss_pages, cmdline):
+        path = os.path.join(self.proc_root, str(pid))
+        os.mkdir(path)
+        with open(os.path.join(path, "statm"), "w") as f:
+            f.write("1000 {0} 10 1 0 50 0\n".format(rss_pages))
+        with open(os.path.join(path, "cmdline"), "wb") as f:
+            f.write(b"\0".join(cmdline) + b"\0")
+
+    def test_snapshot(self):
+        self.make_task(1, 10, [b"init"])
+        self.make_task(2, 30, [b"python", b"-c", b"hog()"])
+
+        snapshotter = TaskSnapshotter(proc_root=self.proc_root)
+        top, seen, truncated = snapshotter.snapshot([1, 2])
+
+        self.assertEqual(2, seen)
+        self.assertFalse(truncated)
+        self.assertEqual([2, 1], [t.pid for t in top])
+        self.assertEqual(30 * PAGE_SIZE, top[0].rss)
+        self.assertEqual(["python", "-c", "hog()"], top[0].cmdline)
+
+    def test_snapshot_top_n(self):
+        for pid in range(1, 6):
+            self.make_task(pid, pid, [b"task"])
+
+        snapshotter = TaskSnapshotter(top_n=2, proc_root=self.proc_root)
+        top, seen, _ = snapshotter.snapshot(range(1, 6))
+
+        self.assertEqual(5, seen)
+        self.assertEqual([5, 4], [t.pid for t in top])
+
+    def test_snapshot_exited_task(self):
+        self.make_task(1, 10, [b"init"])
+        snapshotter = TaskSnapshotter(proc_root=self.proc_root)
+        top, seen, _ = snapshotter.snapshot([1, 2])
+        self.assertEqual(1, seen)
+        self.assertEqual([1], [t.pid for t in top])
+
+    def test_snapshot_budget(self):
+        self.make_task(1, 10, [b"init"])
+        snapshotter = TaskSnapshotter(budget=0, proc_root=self.proc_root)
+        top, seen, truncated = snapshotter.snapshot([1])
+        self.assertTrue(truncated)
+        self.assertEqual(0, seen)
+
+    def test_snapshot_self(self):
+        top, _, _ = TaskSnapshotter().snapshot([os.getpid()])
+        self.assertEqual(1, len(top))
+        self.assertGreater(top[0].rss, 0)
+        self.assertTrue(top[0].cmdline)
@@ -0,0 +1,142 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from six.moves import queue
+
+from captain_comeback.index import CgroupIndex
+from captain_comeback.watchdog import HostMemoryWatchdog
+from captain_comeback.restart.messages import RestartRequestedMessage
+from captain_comeback.restart.policy import RestartPolicy
+from captain_comeback.test.index_test_unit import create_mock_cg
+
+
+MEMINFO = """MemTotal:        8000000 kB
+MemFree:          100000 kB
+MemAvailable:    {0} kB
+Buffers:           10000 kB
+"""
+
+
+class MockCgroup(object):
+    def __init__(self, name, rss, priority=0):
+        self._name = name
+        self.rss = rss
+        self.restart_in_flight = False
+        self.restart_policy = RestartPolicy(priority=priority)
+        self.oom_killer_only = False
+
+    def name(self):
+        return self._name
+
+    def rss_in_bytes(self):
+        if self.rss is None:
+            raise EnvironmentError("gone")
+        return self.rss
+
+    def left_to_oom_killer(self):
+        return self.oom_killer_only
+
+
+class WatchdogTestUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.meminfo = os.path.join(self.tmp, "meminfo")
+        self.queue = queue.Queue()
+        self.set_available(1000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def set_available(self, kb):
+        with open(self.meminfo, "w") as f:
+            f.write(MEMINFO.format(kb))
+
+    def make_watchdog(self, min_available, **kwargs):
+        watchdog = HostMemoryWatchdog(min_available,
+                                      meminfo_path=self.meminfo, **kwargs)
+        watchdog.open()
+        self.addCleanup(watchdog.close)
+        return watchdog
+
+    def restarted(self):
+        names = []
+        while not self.queue.empty():
+            msg = self.queue.get_nowait()
+            self.assertIsInstance(msg, RestartRequestedMessage)
+            self.assertTrue(msg.cg.restart_in_flight)
+            self.assertTrue(msg.preemption)
+            names.append(msg.cg.name())
+        return names
+
+    def test_available(self):
+        watchdog = self.make_watchdog(1)
+        self.assertEqual(1000000 * 1024, watchdog.available())
+        self.set_available(10)
+        self.assertEqual(10 * 1024, watchdog.available())
+
+    def test_enough_memory(self):
+        watchdog = self.make_watchdog(1000 * 1024)
+        watchdog.check([MockCgroup("foo", 100)], self.queue)
+        self.assertEqual([], self.restarted())
+
+    def test_low_memory(self):
+        self.set_available(100)
+        watchdog = self.make_watchdog(1000 * 1024)
+        cgs = [MockCgroup("small", 100), MockCgroup("large", 1000),
+               MockCgroup("important", 10000, priority=10)]
+        watchdog.check(cgs, self.queue)
+        self.assertEqual(["large"], self.restarted())
+
+    def test_skips_ineligible(self):
+        self.set_available(100)
+        watchdog = self.make_watchdog(1000 * 1024, max_victims=10)
+        in_flight, left, gone, empty = [MockCgroup(n, rss) for n, rss in [
+            ("in_flight", 1000), ("left", 1000), ("gone", None),
+            ("empty", 0)]]
+        in_flight.restart_in_flight = True
+        left.oom_killer_only = True
+
+        watchdog.check([in_flight, left, gone, empty], self.queue)
+        self.assertEqual([], self.restarted())
+
+    def test_target(self):
+        self.set_available(100)
+        watchdog = self.make_watchdog(200 * 1024,
+                                      target_available=400 * 1024,
+                                      max_victims=10)
+        cgs = [MockCgroup(str(i), 100 * 1024) for i in range(5)]
+        watchdog.check(cgs, self.queue)
+        self.assertEqual(3, len(self.restarted()))
+
+    def test_waits_for_victims(self):
+        self.set_available(100)
+        watchdog = self.make_watchdog(1000 * 1024)
+        foo, bar = MockCgroup("foo", 1000), MockCgroup("bar", 100)
+
+        watchdog.check([foo, bar], self.queue)
+        self.assertEqual(["foo"], self.restarted())
+        watchdog.check([foo, bar], self.queue)
+        self.assertEqual([], self.restarted())
+
+        # Still low on memory once it's done
+        foo.restart_in_flight = False
+        watchdog.check([foo, bar], self.queue)
+        self.assertEqual(["foo"], self.restarted())
+
+    def test_index(self):
+        root_cg = os.path.join(self.tmp, "root")
+        os.mkdir(root_cg)
+        path = create_mock_cg(root_cg, "foo")
+        with open(os.path.join(path, "memory.stat"), "w") as f:
+            f.write("cache 100\nrss 1000\n")
+
+        self.set_available(100)
+        watchdog = HostMemoryWatchdog(1000 * 1024, meminfo_path=self.meminfo)
+        index = CgroupIndex(root_cg, self.queue, host_watchdog=watchdog)
+        index.open()
+        self.addCleanup(index.close)
+
+        index.sync()
+        self.assertEqual(["foo"], self.restarted())
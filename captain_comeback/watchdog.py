@@ -0,0 +1,217 @@
+# coding:utf-8
+import os
+import errno
+import logging
+import select
+
+import linuxfd
+
+from captain_comeback import metrics
+from captain_comeback.cgroup import open_control, pread_all, O_CLOEXEC
+from captain_comeback.restart.engine import default_priority
+from captain_comeback.restart.messages import RestartRequestedMessage
+
+
+logger = logging.getLogger()
+
+
+# Container limits are often overcommitted, in which case the host can run
+# out of memory while no container is at its limit, and the kernel's OOM
+# killer picks a victim for us (possibly in a container that was behaving).
+# The watchdog keeps an eye on how much memory the host has available, and
+# when it gets too low, restarts the containers we can best spare (lowest
+# priority first, then largest) before the kernel has to step in.
+#
+# We check at every sync, which only costs a read of /proc/meminfo, and also
+# whenever the kernel tells us memory is getting tight (see the triggers
+# below), so that we don't have to sync often to react in time.
+
+DEFAULT_MEMINFO = "/proc/meminfo"
+MEMINFO_AVAILABLE = b"MemAvailable:"
+
+# Disabled by default
+DEFAULT_HOST_MIN_AVAILABLE = 0
+DEFAULT_HOST_MAX_VICTIMS = 1
+
+DEFAULT_PSI_MEMORY = "/proc/pressure/memory"
+# Wake us up when tasks were stalled on memory for 100ms over 1s.
+DEFAULT_PSI_STALL_US = 100000
+DEFAULT_PSI_WINDOW_US = 1000000
+
+
+class PressureLevelTrigger(object):
+    # cgroup v1: the root memory cgroup's pressure level notifications.
+    EVENT_MASK = select.EPOLLIN
+
+    def __init__(self, root_cg_path, level):
+        self.root_cg_path = root_cg_path
+        self.level = level
+        self.event = None
+        self.control = None
+
+    def open(self):
+        self.control = open_control(
+            os.path.join(self.root_cg_path, "memory.pressure_level"))
+        self.event = linuxfd.eventfd(initval=0, nonBlocking=True,
+                                     closeOnExec=True)
+        req = "{0} {1} {2}".format(self.event.fileno(), self.control,
+                                   self.level)
+        with open(os.path.join(self.root_cg_path, "cgroup.event_control"),
+                  "w") as f:
+            f.write(req)
+
+    def fileno(self):
+        return self.event.fileno()
+
+    def ack(self):
+        try:
+            self.event.read()
+        except EnvironmentError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self.control)
+        self.event.close()
+
+
+class PsiTrigger(object):
+    # cgroup v2 (or any kernel with PSI): a pressure stall trigger. The
+    # kernel reports it through POLLPRI, and reading it isn't needed.
+    EVENT_MASK = select.EPOLLPRI
+
+    def __init__(self, path=DEFAULT_PSI_MEMORY, stall_us=DEFAULT_PSI_STALL_US,
+                 window_us=DEFAULT_PSI_WINDOW_US):
+        self.path = path
+        self.stall_us = stall_us
+        self.window_us = window_us
+        self.fd = None
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK | O_CLOEXEC)
+        try:
+            req = "some {0} {1}\0".format(self.stall_us, self.window_us)
+            os.write(self.fd, req.encode("ascii"))
+        except EnvironmentError:
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def ack(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HostMemoryWatchdog(object):
+    def __init__(self, min_available, target_available=None, trigger=None,
+                 max_victims=DEFAULT_HOST_MAX_VICTIMS,
+                 meminfo_path=DEFAULT_MEMINFO, priority=default_priority):
+        assert min_available > 0, "min_available must be > 0"
+        assert max_victims > 0, "max_victims must be > 0"
+        self.min_available = min_available
+        # Once we start, free up enough to get back to this much.
+        self.target_available = max(target_available or 0, min_available)
+        self.trigger = trigger
+        self.max_victims = max_victims
+        self.meminfo_path = meminfo_path
+        self.priority = priority
+        self.meminfo = None
+        # Restarts we asked for and haven't completed yet
+        self._victims = []
+
+    def open(self):
+        self.meminfo = open_control(self.meminfo_path)
+
+        if self.trigger is not None:
+            try:
+                self.trigger.open()
+            except EnvironmentError as e:
+                # Syncs will have to do.
+                logger.warning("host: memory pressure notifications "
+                               "unavailable: %s", e)
+                self.trigger = None
+
+    def close(self):
+        if self.trigger is not None:
+            self.trigger.close()
+        os.close(self.meminfo)
+        self.meminfo = None
+
+    def fileno(self):
+        if self.trigger is None:
+            return None
+        return self.trigger.fileno()
+
+    def available(self):
+        for line in pread_all(self.meminfo).splitlines():
+            if line.startswith(MEMINFO_AVAILABLE):
+                # In kB
+                return int(line.split()[1]) * 1024
+        raise ValueError("{0} not found".format(MEMINFO_AVAILABLE))
+
+    def ack(self):
+        logger.debug("host: memory pressure notification")
+        self.trigger.ack()
+
+    def check(self, cgroups, job_queue):
+        available = self.available()
+        metrics.HOST_AVAILABLE_BYTES.set(available)
+        if available >= self.min_available:
+            return
+
+        # Give the restarts we already asked for a chance to free memory
+        # before we look for more victims.
+        self._victims = [cg for cg in self._victims if cg.restart_in_flight]
+        if self._victims:
+            logger.debug("host: low on memory, %s restarts in flight",
+                         len(self._victims))
+            return
+
+        victims = self.pick_victims(cgroups,
+                                    self.target_available - available)
+        if not victims:
+            logger.warning("host: low on memory (%s available), but "
+                           "there is no container to restart", available)
+            return
+
+        logger.warning("host: low on memory (%s available, want %s), "
+                       "restarting %s", available, self.target_available,
+                       ", ".join(cg.name() for cg, _ in victims))
+
+        for cg, rss in victims:
+            logger.info("%s: restarting to free host memory (rss: %s)",
+                        cg.name(), rss)
+            metrics.HOST_PREEMPTIONS.inc()
+            cg.restart_in_flight = True
+            job_queue.put(RestartRequestedMessage(cg, preemption=True))
+            self._victims.append(cg)
+
+    def pick_victims(self, cgroups, wanted):
+        # Returns (cgroup, rss) pairs for the containers to restart.
+        candidates = []
+        for cg in cgroups:
+            if cg.restart_in_flight or cg.left_to_oom_killer():
+                continue
+            try:
+                rss = cg.rss_in_bytes()
+            except (EnvironmentError, ValueError) as e:
+                logger.debug("%s: failed to read rss: %s", cg.name(), e)
+                continue
+            if rss > 0:
+                candidates.append((cg, rss))
+
+        # Lowest priority first, then whoever frees up the most.
+        candidates.sort(key=lambda c: (self.priority(c[0]), -c[1]))
+
+        victims = []
+        freed = 0
+        for cg, rss in candidates:
+            if freed >= wanted or len(victims) >= self.max_victims:
+                break
+            victims.append((cg, rss))
+            freed += rss
+        return victims